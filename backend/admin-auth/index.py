@@ -3,6 +3,13 @@ import os
 import psycopg2
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -61,28 +68,24 @@ def handler(event, context):
     if event.get('httpMethod') != 'POST':
         return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
 
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    conn = get_connection()
     cur = conn.cursor()
     client_ip = get_client_ip(event)
     if check_rate_limit(cur, conn, client_ip, 'admin-auth', 5, 60):
         cur.close()
         conn.close()
         return {'statusCode': 429, 'headers': headers, 'body': json.dumps({'error': 'Too many requests'})}
-    cur.close()
-    conn.close()
 
     raw_body = event.get('body') or '{}'
     body = json.loads(raw_body) if isinstance(raw_body, str) and raw_body.strip() else {}
     email = body.get('email', '').strip().lower()
 
     if not email or '@' not in email:
+        cur.close()
+        conn.close()
         return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Invalid email'})}
 
-    dsn = os.environ['DATABASE_URL']
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
 
     cur.execute(
         "SELECT id, email FROM {schema}.admins WHERE email = '{email}'".format(
@@ -3,6 +3,13 @@ import os
 import psycopg2
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -57,9 +64,8 @@ def handler(event, context):
         }
 
     headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
-    dsn = os.environ['DATABASE_URL']
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    conn = psycopg2.connect(dsn)
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -132,6 +138,7 @@ def handler(event, context):
         if action == 'wipe_all':
             cur.execute("DELETE FROM {s}.game_history".format(s=schema))
             cur.execute("DELETE FROM {s}.online_games".format(s=schema))
+            cur.execute("DELETE FROM {s}.online_game_moves".format(s=schema))
             cur.execute("DELETE FROM {s}.matchmaking_queue".format(s=schema))
             cur.execute("DELETE FROM {s}.game_invites".format(s=schema))
             cur.execute("DELETE FROM {s}.chat_messages".format(s=schema))
@@ -1,9 +1,29 @@
 import json
 import os
+import time
 import psycopg2
 from datetime import datetime, timezone, timedelta
 
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
 MSK = timezone(timedelta(hours=3))
+CHUNK_SIZE = int(os.environ.get('DECAY_CHUNK_SIZE', '5000'))
+TIME_BUDGET = float(os.environ.get('DECAY_TIME_BUDGET', '20'))
+
+
+def esc(val):
+    return str(val).replace("'", "''")
 
 
 def get_client_ip(event):
@@ -46,7 +66,13 @@ def check_rate_limit(cur, conn, ip, endpoint, max_requests, window_seconds):
 
 
 def handler(event: dict, context) -> dict:
-    """Ежедневное снижение рейтинга всех игроков. Срабатывает раз в сутки после 00:00 МСК."""
+    """Перенос накопленного ежедневного снижения рейтинга в users.rating.
+
+    Снижение считается при чтении по decay_anchor_date, поэтому каждую ночь
+    запускать это не нужно. Перенос нужен перед сменой daily_decay или
+    min_rating: прошедшие дни будут сняты по старым значениям.
+    Игроки обходятся порциями по id; вызов, не уложившийся в TIME_BUDGET,
+    возвращает reason = in_progress, следующий продолжает с контрольной точки."""
     if event.get('httpMethod') == 'OPTIONS':
         return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
@@ -55,68 +81,119 @@ def handler(event: dict, context) -> dict:
     if event.get('httpMethod') != 'POST':
         return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
     client_ip = get_client_ip(event)
     if check_rate_limit(cur, conn, client_ip, 'apply-daily-decay', 5, 60):
         cur.close()
         conn.close()
         return {'statusCode': 429, 'headers': headers, 'body': json.dumps({'error': 'Too many requests'})}
-    cur.close()
-    conn.close()
 
     now_msk = datetime.now(MSK)
     today_msk = now_msk.strftime('%Y-%m-%d')
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-
-    cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating', 'last_decay_date')")
-    settings = {r[0]: r[1] for r in cur.fetchall()}
-
-    last_decay_date = settings.get('last_decay_date', '2000-01-01')
+    cur.execute("SELECT value FROM rating_settings WHERE key = 'last_decay_date'")
+    row = cur.fetchone()
+    last_decay_date = row[0] if row else '2000-01-01'
 
     if last_decay_date >= today_msk:
         cur.close()
         conn.close()
         return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'applied': False, 'reason': 'already_applied_today', 'last_decay_date': last_decay_date, 'today': today_msk})}
 
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating')")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+
     decay = abs(int(settings.get('daily_decay', '1')))
     min_rating = int(settings.get('min_rating', '500'))
 
-    if decay == 0:
-        cur.execute("UPDATE rating_settings SET value = '%s', updated_at = NOW() WHERE key = 'last_decay_date'" % today_msk)
-        conn.commit()
-        cur.close()
-        conn.close()
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'applied': True, 'affected': 0, 'decay': 0})}
-
+    # Строка прогона фиксирует параметры: продолжение после сбоя снижает так же
     cur.execute(
-        """UPDATE users SET rating = GREATEST(rating - %d, %d), updated_at = NOW()
-        WHERE rating > %d
-          AND id NOT IN (
-            SELECT DISTINCT user_id FROM game_history
-            WHERE created_at >= TIMESTAMP '%s 00:00:00' AND created_at < TIMESTAMP '%s 00:00:00' + INTERVAL '1 day'
-          )
-        RETURNING id"""
-        % (decay, min_rating, min_rating, today_msk, today_msk)
+        "INSERT INTO rating_decay_runs (run_date, decay, min_rating) VALUES ('%s', %d, %d) ON CONFLICT (run_date) DO NOTHING"
+        % (today_msk, decay, min_rating)
     )
-    affected = len(cur.fetchall())
+    conn.commit()
 
-    cur.execute("UPDATE rating_settings SET value = '%s', updated_at = NOW() WHERE key = 'last_decay_date'" % today_msk)
+    started = time.monotonic()
+    scanned_now = 0
+    while True:
+        # Каждая порция — своя транзакция. Строка прогона под блокировкой служит
+        # и контрольной точкой, и защитой от двух одновременных вызовов
+        cur.execute(
+            "SELECT decay, min_rating, last_user_id, scanned, affected, finished_at FROM rating_decay_runs WHERE run_date = '%s' FOR UPDATE SKIP LOCKED"
+            % today_msk
+        )
+        run = cur.fetchone()
+        if run is None:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'applied': False, 'reason': 'in_progress', 'today': today_msk})}
+        decay, min_rating, last_user_id, scanned, affected, finished_at = run
+        if finished_at is not None:
+            conn.rollback()
+            break
 
-    conn.commit()
+        # Keyset-порция по первичному ключу; сыгравшие сегодня уже имеют
+        # decay_anchor_date = сегодня и не меняются. Блокируются только строки порции
+        cur.execute(
+            """WITH batch AS (
+                SELECT id FROM users WHERE id > '%s' ORDER BY id LIMIT %d
+            ), upd AS (
+                UPDATE users u SET
+                    rating = CASE WHEN u.rating > %d THEN GREATEST(u.rating - %d * (DATE '%s' - u.decay_anchor_date), %d) ELSE u.rating END,
+                    decay_anchor_date = DATE '%s', updated_at = NOW()
+                FROM batch b
+                WHERE u.id = b.id AND u.decay_anchor_date < DATE '%s'
+                RETURNING 1
+            )
+            SELECT (SELECT MAX(id) FROM batch), (SELECT COUNT(*) FROM batch), (SELECT COUNT(*) FROM upd)"""
+            % (esc(last_user_id), CHUNK_SIZE, min_rating, decay, today_msk, min_rating, today_msk, today_msk)
+        )
+        last_id, chunk_scanned, chunk_affected = cur.fetchone()
+
+        if last_id is None:
+            cur.execute("UPDATE rating_decay_runs SET finished_at = NOW(), updated_at = NOW() WHERE run_date = '%s'" % today_msk)
+            cur.execute("UPDATE rating_settings SET value = '%s', updated_at = NOW() WHERE key = 'last_decay_date'" % today_msk)
+            cur.execute("DELETE FROM rating_decay_runs WHERE run_date < DATE '%s' - INTERVAL '30 days'" % today_msk)
+            cur.execute("""SELECT pg_notify('settings_events', '{"table": "rating_settings"}')""")
+            conn.commit()
+            break
+
+        scanned += chunk_scanned
+        affected += chunk_affected
+        scanned_now += chunk_scanned
+        cur.execute(
+            "UPDATE rating_decay_runs SET last_user_id = '%s', scanned = %d, affected = %d, updated_at = NOW() WHERE run_date = '%s'"
+            % (esc(last_id), scanned, affected, today_msk)
+        )
+        conn.commit()
+
+        if time.monotonic() - started >= TIME_BUDGET:
+            break
+
+    elapsed = time.monotonic() - started
+    cur.execute("SELECT scanned, affected, finished_at FROM rating_decay_runs WHERE run_date = '%s'" % today_msk)
+    scanned, affected, finished_at = cur.fetchone()
     cur.close()
     conn.close()
 
+    done = finished_at is not None
     return {
         'statusCode': 200,
         'headers': headers,
         'body': json.dumps({
-            'applied': True,
+            'applied': done,
+            'reason': None if done else 'in_progress',
             'affected': affected,
+            'scanned': scanned,
             'decay': decay,
             'min_rating': min_rating,
-            'date': today_msk
+            'date': today_msk,
+            'elapsed_ms': int(elapsed * 1000),
+            'rows_per_sec': int(scanned_now / elapsed) if elapsed > 0 else 0
         })
-    }
\ No newline at end of file
+    }
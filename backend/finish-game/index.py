@@ -1,6 +1,20 @@
 import json
 import os
 import psycopg2
+from datetime import datetime, timezone, timedelta
+
+import rating_engine
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
 
 
 def get_client_ip(event):
@@ -42,8 +56,332 @@ def check_rate_limit(cur, conn, ip, endpoint, max_requests, window_seconds):
         return False
 
 
+MAX_BATCH = 50
+MSK = timezone(timedelta(hours=3))
+
+
+def online_game_id_of(game):
+    """id онлайн-партии, из которой прислан результат; 0 — не онлайн, None — неверный id."""
+    value = game.get('online_game_id')
+    if value in (None, ''):
+        return 0
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+# Числовые поля партии и их верхняя граница
+INT_FIELDS = {'opponent_rating': 10000, 'moves_count': 10000, 'duration_seconds': 7 * 24 * 3600}
+
+
+def int_field(game, key):
+    """Целое поле партии или None, если оно не задано; ValueError — не число или вне 0..INT_FIELDS[key]."""
+    value = game.get(key)
+    if value in (None, ''):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(key)
+    if not 0 <= value <= INT_FIELDS[key]:
+        raise ValueError(key)
+    return value
+
+
+def game_error(game, bot_games=()):
+    """Причина, по которой партию нельзя учесть, или None.
+    bot_games — id онлайн-партий игрока с ботом (их результат присылает клиент)."""
+    if game.get('result') not in ('win', 'loss', 'draw'):
+        return 'valid result required'
+    for key in INT_FIELDS:
+        try:
+            int_field(game, key)
+        except ValueError:
+            return 'invalid %s' % key
+    # Онлайн-партии учитывает online-move при завершении — здесь только бот и офлайн
+    if game.get('opponent_type', 'bot') not in ('bot', 'offline'):
+        return 'online games are rated by the server'
+    online_game_id = online_game_id_of(game)
+    if online_game_id is None:
+        return 'invalid online_game_id'
+    # Онлайн-партию с живым соперником учитывает сервер; из онлайн-партий принимаются только партии с ботом
+    if online_game_id and online_game_id not in bot_games:
+        return 'online games are rated by the server'
+    return None
+
+
+def online_bot_games(cur, user_id, games):
+    """Из присланных online_game_id — id партий игрока с ботом."""
+    ids = {online_game_id_of(g) for g in games} - {0, None}
+    if not ids:
+        return set()
+    cur.execute(
+        "SELECT id FROM online_games WHERE id IN (%s) AND is_bot_game = TRUE AND (white_user_id = '%s' OR black_user_id = '%s')"
+        % (', '.join(str(i) for i in sorted(ids)), esc(user_id), esc(user_id))
+    )
+    return {r[0] for r in cur.fetchall()}
+
+
+def esc(val):
+    return str(val).replace("'", "''")
+
+
+def load_rating_settings(cur):
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    return {
+        'win_points': int(settings.get('win_points', '25')),
+        'loss_points': int(settings.get('loss_points', '15')),
+        'draw_points': int(settings.get('draw_points', '5')),
+        'initial_rating': int(settings.get('initial_rating', '1200')),
+        'min_rating': int(settings.get('min_rating', '500')),
+        'daily_decay': abs(int(settings.get('daily_decay', '1'))),
+        'today': datetime.now(MSK).strftime('%Y-%m-%d'),
+        'engine': rating_engine.get_engine(settings),
+    }
+
+
+def effective_rating_sql(settings):
+    """Рейтинг с ещё не учтённым ежедневным снижением: по daily_decay за каждый
+    день после decay_anchor_date, но не ниже min_rating."""
+    return "CASE WHEN rating > {m} THEN GREATEST(rating - {d} * GREATEST(DATE '{t}' - decay_anchor_date, 0), {m}) ELSE rating END".format(
+        d=settings['daily_decay'], m=settings['min_rating'], t=settings['today'])
+
+
+def history_literals(user_id, game, client_game_id):
+    """SQL-литералы строки game_history, кроме рейтинговых колонок. Числовые поля уже проверил game_error."""
+    difficulty = game.get('difficulty')
+    opponent_rating = int_field(game, 'opponent_rating')
+    duration_seconds = int_field(game, 'duration_seconds')
+    return {
+        'user_id': "'%s'" % esc(user_id),
+        'opponent_name': "'%s'" % esc(game.get('opponent_name', '')),
+        'opponent_type': "'%s'" % esc(game.get('opponent_type', 'bot')),
+        'opponent_rating': str(opponent_rating) if opponent_rating else 'NULL',
+        'result': "'%s'" % game['result'],
+        'user_color': "'black'" if game.get('user_color') == 'black' else "'white'",
+        'time_control': "'%s'" % esc(game.get('time_control', '10+0')),
+        'difficulty': "'%s'" % esc(difficulty) if difficulty else 'NULL',
+        'moves_count': str(int_field(game, 'moves_count') or 0),
+        'move_history': "'%s'" % esc(game.get('move_history') or ''),
+        'move_times': "'%s'" % esc(game.get('move_times') or ''),
+        'duration_seconds': str(duration_seconds) if duration_seconds else 'NULL',
+        'end_reason': "'%s'" % esc(game.get('end_reason', 'checkmate')),
+        'client_game_id': "'%s'" % esc(client_game_id) if client_game_id else 'NULL',
+    }
+
+
+HISTORY_COLUMNS = (
+    'user_id, opponent_name, opponent_type, opponent_rating, result, user_color, time_control, difficulty, '
+    'moves_count, move_history, move_times, rating_before, rating_after, rating_change, duration_seconds, '
+    'end_reason, client_game_id'
+)
+
+# Одна партия — один запрос: старый рейтинг берётся из заблокированной строки (old)
+# вместе с накопленным снижением, UPDATE записывает новый рейтинг и сдвигает
+# decay_anchor_date на сегодня, счётчики меняет относительно текущих значений; новый игрок
+# создаётся сразу с итоговыми значениями (ins), строка истории пишется из того,
+# что вернул UPDATE или INSERT. Уже записанный client_game_id (dup) ничего не меняет.
+APPLY_ONE_SQL = """
+WITH dup AS (
+    SELECT id, rating_before, rating_after, rating_change FROM game_history
+    WHERE user_id = %(user_id)s AND client_game_id = %(client_game_id)s
+), old AS (
+    SELECT id, %(current_rating)s AS rating FROM users WHERE id = %(user_id)s FOR UPDATE
+), upd AS (
+    UPDATE users u SET
+        rating = GREATEST(old.rating + %(delta)s, %(min_rating)d),
+        decay_anchor_date = DATE %(today)s,
+        games_played = u.games_played + 1,
+        wins = u.wins + %(win)d,
+        losses = u.losses + %(loss)d,
+        draws = u.draws + %(draw)d,
+        updated_at = NOW()
+    FROM old
+    WHERE u.id = old.id AND NOT EXISTS (SELECT 1 FROM dup)
+    RETURNING old.rating AS rating_before, u.rating AS rating_after, u.games_played, u.wins, u.losses, u.draws
+), ins AS (
+    INSERT INTO users (id, username, avatar, rating, games_played, wins, losses, draws)
+    SELECT %(user_id)s, %(username)s, %(avatar)s, GREATEST(%(initial_rating)d + %(first_delta)s, %(min_rating)d),
+           1, %(win)d, %(loss)d, %(draw)d
+    WHERE NOT EXISTS (SELECT 1 FROM old) AND NOT EXISTS (SELECT 1 FROM dup)
+    ON CONFLICT (id) DO NOTHING
+    RETURNING %(initial_rating)d AS rating_before, rating AS rating_after, games_played, wins, losses, draws
+), res AS (
+    SELECT * FROM upd UNION ALL SELECT * FROM ins
+), hist AS (
+    INSERT INTO game_history (%(columns)s)
+    SELECT %(user_id)s, %(opponent_name)s, %(opponent_type)s, %(opponent_rating)s, %(result)s, %(user_color)s,
+           %(time_control)s, %(difficulty)s, %(moves_count)s, %(move_history)s, %(move_times)s,
+           res.rating_before, res.rating_after, res.rating_after - res.rating_before,
+           %(duration_seconds)s, %(end_reason)s, %(client_game_id)s
+    FROM res
+    RETURNING id
+)
+SELECT hist.id, res.rating_before, res.rating_after, res.rating_after - res.rating_before,
+       res.games_played, res.wins, res.losses, res.draws, FALSE
+FROM hist, res
+UNION ALL
+SELECT dup.id, dup.rating_before, dup.rating_after, dup.rating_change, u.games_played, u.wins, u.losses, u.draws, TRUE
+FROM dup JOIN users u ON u.id = %(user_id)s
+"""
+
+
+def opponent_rating_of(game):
+    try:
+        return int_field(game, 'opponent_rating') or None
+    except ValueError:
+        return None
+
+
+def apply_one_game(cur, conn, user_id, username, avatar, game, settings):
+    """Одна партия одним запросом. Возвращает (результат, итоговая статистика)
+    или None, если строку игрока вставил конкурентный запрос — тогда его стоит повторить.
+    Движок, который не выражается в SQL (Glicko-2), идёт через apply_games."""
+    result = game['result']
+    engine = settings['engine']
+    opponent_rating = opponent_rating_of(game)
+    delta = engine.sql_delta('old.rating', 'u.games_played', opponent_rating, result)
+    if delta is None:
+        results, totals = apply_games(cur, user_id, username, avatar, [game], settings)
+        return results[0], totals
+    first_delta = engine.sql_delta(str(settings['initial_rating']), '0', opponent_rating, result)
+    client_game_id = str(game.get('client_game_id') or '')[:64] or None
+    params = dict(history_literals(user_id, game, client_game_id),
+                  username="'%s'" % esc(username), avatar="'%s'" % esc(avatar), columns=HISTORY_COLUMNS,
+                  delta=delta, first_delta=first_delta,
+                  current_rating=effective_rating_sql(settings), today="'%s'" % settings['today'],
+                  min_rating=settings['min_rating'], initial_rating=settings['initial_rating'],
+                  win=result == 'win', loss=result == 'loss', draw=result == 'draw')
+    try:
+        cur.execute(APPLY_ONE_SQL % params)
+        row = cur.fetchone()
+    except psycopg2.IntegrityError:
+        # Тот же client_game_id записал параллельный повтор
+        conn.rollback()
+        return None
+    if row is None:
+        conn.rollback()
+        return None
+    entry = {'client_game_id': client_game_id, 'game_id': row[0], 'rating_before': row[1],
+             'rating_after': row[2], 'rating_change': row[3]}
+    if row[8]:
+        entry['duplicate'] = True
+    return entry, {'rating': row[2], 'games_played': row[4], 'wins': row[5], 'losses': row[6], 'draws': row[7]}
+
+
+def apply_games(cur, user_id, username, avatar, games, settings):
+    """Учитывает партии игрока по порядку в текущей транзакции: один UPDATE users
+    и один INSERT на все новые строки game_history. Партии с client_game_id,
+    уже записанным ранее или повторённым в пакете, рейтинг не меняют —
+    для них возвращается сохранённый результат с duplicate = True.
+    Возвращает (результаты по партиям, итоговая статистика игрока)."""
+    engine = settings['engine']
+    initial_rating = settings['initial_rating']
+    min_rating = settings['min_rating']
+
+    cur.execute(
+        "INSERT INTO users (id, username, avatar, rating, games_played, wins, losses, draws) VALUES ('%s', '%s', '%s', %d, 0, 0, 0, 0) ON CONFLICT (id) DO NOTHING"
+        % (esc(user_id), esc(username), esc(avatar), initial_rating)
+    )
+    # Блокировка строки игрока упорядочивает конкурентные повторы одного пакета
+    cur.execute(
+        "SELECT %s, games_played, wins, losses, draws, rating_deviation, rating_volatility FROM users WHERE id = '%s' FOR UPDATE"
+        % (effective_rating_sql(settings), esc(user_id))
+    )
+    rating, games_played, wins, losses, draws, rd, volatility = cur.fetchone()
+    player = rating_engine.PlayerRating(rating, games_played, rd, volatility)
+
+    client_ids = [str(g.get('client_game_id'))[:64] for g in games if g.get('client_game_id')]
+    stored = {}
+    batch = {}
+    if client_ids:
+        cur.execute(
+            "SELECT client_game_id, id, rating_before, rating_after, rating_change FROM game_history WHERE user_id = '%s' AND client_game_id IN (%s)"
+            % (esc(user_id), ', '.join("'%s'" % esc(c) for c in client_ids))
+        )
+        stored = {r[0]: {'game_id': r[1], 'rating_before': r[2], 'rating_after': r[3], 'rating_change': r[4]}
+                  for r in cur.fetchall()}
+
+    bot_games = online_bot_games(cur, user_id, games)
+    results = []
+    inserted = []
+    repeats = []
+    rows = []
+    for game in games:
+        client_game_id = str(game.get('client_game_id') or '')[:64] or None
+        error = game_error(game, bot_games)
+        if error:
+            results.append({'client_game_id': client_game_id, 'error': error})
+            continue
+        if client_game_id in stored:
+            results.append(dict(stored[client_game_id], client_game_id=client_game_id, duplicate=True))
+            continue
+        if client_game_id in batch:
+            repeats.append(len(results))
+            results.append(batch[client_game_id])
+            continue
+
+        result = game['result']
+        if result == 'win':
+            wins += 1
+        elif result == 'loss':
+            losses += 1
+        else:
+            draws += 1
+
+        current_rating = player.rating
+        player = engine.rate(player, result, opponent_rating_of(game))
+        player.rating = max(player.rating, min_rating)
+        rating = player.rating
+        rating_change = rating - current_rating
+        games_played = player.games_played
+
+        entry = {'client_game_id': client_game_id, 'game_id': None, 'rating_before': current_rating,
+                 'rating_after': rating, 'rating_change': rating_change}
+        results.append(entry)
+        inserted.append(entry)
+        if client_game_id:
+            batch[client_game_id] = entry
+
+        lit = history_literals(user_id, game, client_game_id)
+        rows.append(
+            "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %d, %d, %d, %s, %s, %s)" % (
+                lit['user_id'], lit['opponent_name'], lit['opponent_type'], lit['opponent_rating'],
+                lit['result'], lit['user_color'], lit['time_control'], lit['difficulty'],
+                lit['moves_count'], lit['move_history'], lit['move_times'],
+                current_rating, rating, rating_change,
+                lit['duration_seconds'], lit['end_reason'], lit['client_game_id']
+            )
+        )
+
+    if rows:
+        cur.execute(
+            "UPDATE users SET rating = %d, games_played = %d, wins = %d, losses = %d, draws = %d, rating_deviation = %s, rating_volatility = %s, decay_anchor_date = DATE '%s', updated_at = NOW() WHERE id = '%s'"
+            % (rating, games_played, wins, losses, draws,
+               'NULL' if player.rd is None else '%.4f' % player.rd,
+               'NULL' if player.volatility is None else '%.6f' % player.volatility, settings['today'], esc(user_id))
+        )
+        cur.execute(
+            "INSERT INTO game_history (%s) VALUES %s RETURNING id" % (HISTORY_COLUMNS, ', '.join(rows))
+        )
+        for entry, (game_id,) in zip(inserted, cur.fetchall()):
+            entry['game_id'] = game_id
+
+    for i in repeats:
+        results[i] = dict(results[i], duplicate=True)
+
+    return results, {'rating': rating, 'games_played': games_played, 'wins': wins, 'losses': losses, 'draws': draws}
+
+
 def handler(event: dict, context) -> dict:
-    """Завершение партии: обновление рейтинга игрока и запись в историю"""
+    """Завершение партии: обновление рейтинга игрока и запись в историю.
+    Пакетный режим: {"user_id", "games": [...]} — партии, накопленные офлайн."""
     if event.get('httpMethod') == 'OPTIONS':
         return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
@@ -52,140 +390,66 @@ def handler(event: dict, context) -> dict:
     if event.get('httpMethod') != 'POST':
         return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
     client_ip = get_client_ip(event)
     if check_rate_limit(cur, conn, client_ip, 'finish-game', 10, 60):
         cur.close()
         conn.close()
         return {'statusCode': 429, 'headers': headers, 'body': json.dumps({'error': 'Too many requests'})}
-    cur.close()
-    conn.close()
 
     body = json.loads(event.get('body', '{}'))
     user_id = body.get('user_id', '')
     username = body.get('username', 'Player')
     avatar = body.get('avatar', '')
-    result = body.get('result', '')
-    opponent_name = body.get('opponent_name', '')
-    opponent_type = body.get('opponent_type', 'bot')
-    opponent_rating = body.get('opponent_rating')
-    user_color = body.get('user_color', 'white')
-    time_control = body.get('time_control', '10+0')
-    difficulty = body.get('difficulty')
-    moves_count = body.get('moves_count', 0)
-    move_history = body.get('move_history', '')
-    move_times = body.get('move_times', '')
-    duration_seconds = body.get('duration_seconds')
-    end_reason = body.get('end_reason', 'checkmate')
-
-    if not user_id or result not in ('win', 'loss', 'draw'):
-        return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'user_id and valid result required'})}
-
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-
-    cur.execute("SELECT id, rating, games_played, wins, losses, draws FROM users WHERE id = '%s'" % user_id.replace("'", "''"))
-    user = cur.fetchone()
+    games = body.get('games')
 
-    cur.execute("SELECT key, value FROM rating_settings")
-    settings_rows = cur.fetchall()
-    settings = {r[0]: r[1] for r in settings_rows}
-
-    win_points = int(settings.get('win_points', '25'))
-    loss_points = int(settings.get('loss_points', '15'))
-    draw_points = int(settings.get('draw_points', '5'))
-    initial_rating = int(settings.get('initial_rating', '1200'))
-    min_rating = int(settings.get('min_rating', '500'))
-
-    if not user:
-        cur.execute(
-            "INSERT INTO users (id, username, avatar, rating, games_played, wins, losses, draws) VALUES ('%s', '%s', '%s', %d, 0, 0, 0, 0)"
-            % (user_id.replace("'", "''"), username.replace("'", "''"), avatar.replace("'", "''"), initial_rating)
-        )
+    if games is not None:
+        if not user_id or not isinstance(games, list) or not games or not all(isinstance(g, dict) for g in games):
+            cur.close()
+            conn.close()
+            return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'user_id and non-empty games array required'})}
+        if len(games) > MAX_BATCH:
+            cur.close()
+            conn.close()
+            return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'too many games', 'max': MAX_BATCH})}
+        results, totals = apply_games(cur, user_id, username, avatar, games, load_rating_settings(cur))
         conn.commit()
-        current_rating = initial_rating
-        games_played = 0
-        wins = 0
-        losses = 0
-        draws = 0
-    else:
-        current_rating = user[1]
-        games_played = user[2]
-        wins = user[3]
-        losses = user[4]
-        draws = user[5]
-
-    if result == 'win':
-        rating_change = win_points
-        wins += 1
-    elif result == 'loss':
-        rating_change = -loss_points
-        losses += 1
-    else:
-        rating_change = draw_points
-        draws += 1
-
-    new_rating = current_rating + rating_change
-    if new_rating < min_rating:
-        new_rating = min_rating
-        rating_change = new_rating - current_rating
-
-    games_played += 1
-
-    cur.execute(
-        "UPDATE users SET rating = %d, games_played = %d, wins = %d, losses = %d, draws = %d, updated_at = NOW() WHERE id = '%s'"
-        % (new_rating, games_played, wins, losses, draws, user_id.replace("'", "''"))
-    )
+        cur.close()
+        conn.close()
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps(dict(totals, results=results))}
 
-    move_history_escaped = move_history.replace("'", "''") if move_history else ''
-    move_times_escaped = move_times.replace("'", "''") if move_times else ''
-    opponent_name_escaped = opponent_name.replace("'", "''")
-    difficulty_val = "'%s'" % difficulty.replace("'", "''") if difficulty else 'NULL'
-    opponent_rating_val = str(opponent_rating) if opponent_rating else 'NULL'
-    duration_val = str(duration_seconds) if duration_seconds else 'NULL'
+    if not user_id or body.get('result') not in ('win', 'loss', 'draw'):
+        cur.close()
+        conn.close()
+        return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'user_id and valid result required'})}
 
-    cur.execute(
-        """INSERT INTO game_history 
-        (user_id, opponent_name, opponent_type, opponent_rating, result, user_color, time_control, difficulty, moves_count, move_history, move_times, rating_before, rating_after, rating_change, duration_seconds, end_reason)
-        VALUES ('%s', '%s', '%s', %s, '%s', '%s', '%s', %s, %d, '%s', '%s', %d, %d, %d, %s, '%s')
-        RETURNING id"""
-        % (
-            user_id.replace("'", "''"),
-            opponent_name_escaped,
-            opponent_type.replace("'", "''"),
-            opponent_rating_val,
-            result,
-            user_color,
-            time_control.replace("'", "''"),
-            difficulty_val,
-            moves_count,
-            move_history_escaped,
-            move_times_escaped,
-            current_rating,
-            new_rating,
-            rating_change,
-            duration_val,
-            end_reason.replace("'", "''")
-        )
-    )
-    game_id = cur.fetchone()[0]
+    error = game_error(body, online_bot_games(cur, user_id, [body]))
+    if error:
+        cur.close()
+        conn.close()
+        return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': error})}
 
+    settings = load_rating_settings(cur)
+    applied = apply_one_game(cur, conn, user_id, username, avatar, body, settings)
+    if applied is None:
+        applied = apply_one_game(cur, conn, user_id, username, avatar, body, settings)
+    if applied is None:
+        cur.close()
+        conn.close()
+        return {'statusCode': 409, 'headers': headers, 'body': json.dumps({'error': 'concurrent update, retry'})}
     conn.commit()
     cur.close()
     conn.close()
 
+    result, totals = applied
+    response = dict(totals, game_id=result['game_id'], rating_before=result['rating_before'],
+                    rating_after=result['rating_after'], rating_change=result['rating_change'])
+    del response['rating']
+    if result.get('duplicate'):
+        response['duplicate'] = True
     return {
         'statusCode': 200,
         'headers': headers,
-        'body': json.dumps({
-            'game_id': game_id,
-            'rating_before': current_rating,
-            'rating_after': new_rating,
-            'rating_change': rating_change,
-            'games_played': games_played,
-            'wins': wins,
-            'losses': losses,
-            'draws': draws
-        })
-    }
\ No newline at end of file
+        'body': json.dumps(response)
+    }
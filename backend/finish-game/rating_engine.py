@@ -0,0 +1,163 @@
+"""Формулы рейтинга. Движок выбирается настройкой rating_engine в rating_settings:
+
+* fixed   — прежние фиксированные win_points / loss_points / draw_points;
+* elo     — ожидаемый результат по разнице рейтингов, K зависит от опыта
+            игрока: elo_k_provisional первые elo_provisional_games партий,
+            elo_k_master от elo_master_rating, иначе elo_k;
+* glicko2 — Glicko-2 (Glickman, 2012), каждая партия — отдельный период;
+            отклонение и волатильность игрока хранятся в users.
+
+Движок получает текущее состояние игрока и рейтинг соперника и возвращает
+новое состояние; ограничение снизу min_rating накладывает вызывающий код.
+Если рейтинг соперника неизвестен (партии с ботом без opponent_rating),
+соперник считается равным игроку. Округление везде — floor(x + 0.5), так же,
+как в SQL-выражении Elo и в numpy-пересчёте rating_replay.
+
+Копия лежит в backend/online-move (рейтинг онлайн-партий) — файлы должны совпадать.
+"""
+import math
+
+DEFAULT_RD = 350.0
+DEFAULT_VOLATILITY = 0.06
+GLICKO_SCALE = 173.7178
+SCORES = {'win': 1.0, 'draw': 0.5, 'loss': 0.0}
+
+
+class PlayerRating:
+    __slots__ = ('rating', 'games_played', 'rd', 'volatility')
+
+    def __init__(self, rating, games_played=0, rd=None, volatility=None):
+        self.rating = rating
+        self.games_played = games_played
+        self.rd = rd
+        self.volatility = volatility
+
+
+def round_half_up(x):
+    return int(math.floor(x + 0.5))
+
+
+def setting(settings, key, default, cast=int):
+    try:
+        return cast(settings.get(key, default))
+    except (TypeError, ValueError):
+        return cast(default)
+
+
+class FixedPoints:
+    name = 'fixed'
+
+    def __init__(self, settings):
+        self.points = {
+            'win': setting(settings, 'win_points', 25),
+            'loss': -setting(settings, 'loss_points', 15),
+            'draw': setting(settings, 'draw_points', 5),
+        }
+
+    def rate(self, player, result, opponent_rating=None, opponent_rd=None):
+        return PlayerRating(player.rating + self.points[result], player.games_played + 1, player.rd, player.volatility)
+
+    def sql_delta(self, rating, games_played, opponent_rating, result):
+        return str(self.points[result])
+
+
+class Elo:
+    name = 'elo'
+
+    def __init__(self, settings):
+        self.k = setting(settings, 'elo_k', 20)
+        self.k_provisional = setting(settings, 'elo_k_provisional', 40)
+        self.k_master = setting(settings, 'elo_k_master', 10)
+        self.provisional_games = setting(settings, 'elo_provisional_games', 30)
+        self.master_rating = setting(settings, 'elo_master_rating', 2400)
+
+    def k_factor(self, rating, games_played):
+        if games_played < self.provisional_games:
+            return self.k_provisional
+        if rating >= self.master_rating:
+            return self.k_master
+        return self.k
+
+    def rate(self, player, result, opponent_rating=None, opponent_rd=None):
+        opponent = player.rating if opponent_rating is None else opponent_rating
+        expected = 1.0 / (1.0 + 10 ** ((opponent - player.rating) / 400.0))
+        delta = round_half_up(self.k_factor(player.rating, player.games_played) * (SCORES[result] - expected))
+        return PlayerRating(player.rating + delta, player.games_played + 1, player.rd, player.volatility)
+
+    def sql_delta(self, rating, games_played, opponent_rating, result):
+        """То же, что rate(), выражением SQL над колонками rating и games_played."""
+        opponent = rating if opponent_rating is None else '%d' % opponent_rating
+        k = 'CASE WHEN %s < %d THEN %d WHEN %s >= %d THEN %d ELSE %d END' % (
+            games_played, self.provisional_games, self.k_provisional,
+            rating, self.master_rating, self.k_master, self.k)
+        return 'FLOOR((%s) * (%s - 1.0 / (1.0 + POWER(10.0, (%s - %s) / 400.0))) + 0.5)::int' % (
+            k, SCORES[result], opponent, rating)
+
+
+class Glicko2:
+    name = 'glicko2'
+
+    def __init__(self, settings):
+        self.tau = setting(settings, 'glicko_tau', 0.5, float)
+        self.default_rd = setting(settings, 'glicko_default_rd', DEFAULT_RD, float)
+        self.default_volatility = setting(settings, 'glicko_default_volatility', DEFAULT_VOLATILITY, float)
+
+    def rate(self, player, result, opponent_rating=None, opponent_rd=None):
+        rd = player.rd if player.rd is not None else self.default_rd
+        sigma = player.volatility if player.volatility is not None else self.default_volatility
+        mu = player.rating / GLICKO_SCALE
+        phi = rd / GLICKO_SCALE
+        mu_j = (player.rating if opponent_rating is None else opponent_rating) / GLICKO_SCALE
+        phi_j = (opponent_rd if opponent_rd is not None else self.default_rd) / GLICKO_SCALE
+
+        g = 1.0 / math.sqrt(1.0 + 3.0 * phi_j ** 2 / math.pi ** 2)
+        e = 1.0 / (1.0 + math.exp(-g * (mu - mu_j)))
+        v = 1.0 / (g ** 2 * e * (1.0 - e))
+        delta = v * g * (SCORES[result] - e)
+
+        # Новая волатильность — корень f(x) = 0 методом Иллинойса
+        a = math.log(sigma ** 2)
+        tau2 = self.tau ** 2
+
+        def f(x):
+            ex = math.exp(x)
+            return ex * (delta ** 2 - phi ** 2 - v - ex) / (2.0 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau2
+
+        big_a = a
+        if delta ** 2 > phi ** 2 + v:
+            big_b = math.log(delta ** 2 - phi ** 2 - v)
+        else:
+            k = 1
+            while f(a - k * self.tau) < 0:
+                k += 1
+            big_b = a - k * self.tau
+        f_a, f_b = f(big_a), f(big_b)
+        for _ in range(100):
+            if abs(big_b - big_a) <= 1e-6:
+                break
+            c = big_a + (big_a - big_b) * f_a / (f_b - f_a)
+            f_c = f(c)
+            if f_c * f_b <= 0:
+                big_a, f_a = big_b, f_b
+            else:
+                f_a /= 2.0
+            big_b, f_b = c, f_c
+        new_sigma = math.exp(big_a / 2.0)
+
+        phi_star = math.sqrt(phi ** 2 + new_sigma ** 2)
+        new_phi = 1.0 / math.sqrt(1.0 / phi_star ** 2 + 1.0 / v)
+        new_mu = mu + new_phi ** 2 * g * (SCORES[result] - e)
+        return PlayerRating(round_half_up(new_mu * GLICKO_SCALE), player.games_played + 1,
+                            new_phi * GLICKO_SCALE, new_sigma)
+
+    def sql_delta(self, rating, games_played, opponent_rating, result):
+        return None
+
+
+ENGINES = {engine.name: engine for engine in (FixedPoints, Elo, Glicko2)}
+
+
+def get_engine(settings, name=None):
+    """Движок по имени или по настройке rating_engine; неизвестное имя — fixed."""
+    name = name or settings.get('rating_engine') or 'fixed'
+    return ENGINES.get(str(name), FixedPoints)(settings)
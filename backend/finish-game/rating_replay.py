@@ -0,0 +1,227 @@
+"""Пересчёт рейтингов всех игроков по game_history с другой формулой.
+
+Нужен, чтобы оценить новую формулу (rating_engine) до переключения
+настройки rating_engine: ничего не пишет в БД, только считает.
+
+Партии проигрываются в хронологическом порядке каждого игрока против
+сохранённого opponent_rating. Партии разных игроков друг от друга не
+зависят, поэтому расчёт идёт «раундами»: в раунде k обновляются k-е партии
+всех игроков сразу, векторно в numpy. Число итераций — максимум партий у
+одного игрока, а не число партий. Ежедневное снижение рейтинга не повторяется.
+
+    python rating_replay.py --engine elo --set elo_k=24 --csv out.csv
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+
+import rating_engine
+
+GLICKO_SCALE = rating_engine.GLICKO_SCALE
+SCORES = rating_engine.SCORES
+
+
+class Games:
+    """Партии из game_history в виде массивов, по порядку created_at, id."""
+
+    def __init__(self, user_ids, user_idx, opponent_rating, score):
+        self.user_ids = user_ids                  # индекс -> users.id
+        self.user_idx = user_idx                  # int32 на партию
+        self.opponent_rating = opponent_rating    # float64, NaN — неизвестен
+        self.score = score                        # 1 / 0.5 / 0
+
+
+def load_games(conn):
+    cur = conn.cursor(name='rating_replay')
+    cur.itersize = 100000
+    cur.execute(
+        "SELECT user_id, opponent_rating, result FROM game_history "
+        "WHERE result IN ('win', 'loss', 'draw') ORDER BY created_at, id"
+    )
+    index = {}
+    user_idx = []
+    opponent_rating = []
+    score = []
+    for user_id, opp, result in cur:
+        user_idx.append(index.setdefault(user_id, len(index)))
+        opponent_rating.append(np.nan if opp is None else opp)
+        score.append(SCORES[result])
+    cur.close()
+    conn.rollback()
+    user_ids = np.empty(len(index), dtype=object)
+    for user_id, i in index.items():
+        user_ids[i] = user_id
+    return Games(user_ids, np.asarray(user_idx, dtype=np.int32),
+                 np.asarray(opponent_rating, dtype=np.float64), np.asarray(score, dtype=np.float64))
+
+
+def rounds(user_idx):
+    """Номера партий, сгруппированные по раундам: в каждом раунде игрок встречается не больше раза."""
+    n = len(user_idx)
+    if n == 0:
+        return []
+    order = np.argsort(user_idx, kind='stable')
+    sorted_users = user_idx[order]
+    starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+    counts = np.diff(np.r_[starts, n])
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n) - np.repeat(starts, counts)
+    by_rank = np.argsort(rank, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(rank))]
+    return [by_rank[bounds[k]:bounds[k + 1]] for k in range(len(bounds) - 1)]
+
+
+def _fixed(engine, state, u, opp, s):
+    points = engine.points
+    return state['rating'][u] + np.where(s == 1.0, points['win'], np.where(s == 0.0, points['loss'], points['draw']))
+
+
+def _elo(engine, state, u, opp, s):
+    r = state['rating'][u]
+    games = state['games'][u]
+    k = np.where(games < engine.provisional_games, engine.k_provisional,
+                 np.where(r >= engine.master_rating, engine.k_master, engine.k))
+    expected = 1.0 / (1.0 + 10.0 ** ((opp - r) / 400.0))
+    return r + np.floor(k * (s - expected) + 0.5)
+
+
+def _glicko2(engine, state, u, opp, s):
+    r = state['rating'][u]
+    phi = state['rd'][u] / GLICKO_SCALE
+    sigma = state['volatility'][u]
+    mu = r / GLICKO_SCALE
+    mu_j = opp / GLICKO_SCALE
+    phi_j = engine.default_rd / GLICKO_SCALE
+
+    g = 1.0 / np.sqrt(1.0 + 3.0 * phi_j ** 2 / np.pi ** 2)
+    e = 1.0 / (1.0 + np.exp(-g * (mu - mu_j)))
+    v = 1.0 / (g ** 2 * e * (1.0 - e))
+    delta = v * g * (s - e)
+
+    a = np.log(sigma ** 2)
+    tau = engine.tau
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta ** 2 - phi ** 2 - v - ex) / (2.0 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau ** 2
+
+    big_a = a.copy()
+    wide = delta ** 2 > phi ** 2 + v
+    big_b = np.where(wide, np.log(np.where(wide, delta ** 2 - phi ** 2 - v, 1.0)), a - tau)
+    k = np.ones_like(a)
+    pending = ~wide & (f(a - tau) < 0)
+    while pending.any():
+        k = np.where(pending, k + 1, k)
+        big_b = np.where(pending, a - k * tau, big_b)
+        pending = pending & (f(big_b) < 0)
+    f_a, f_b = f(big_a), f(big_b)
+    for _ in range(100):
+        active = np.abs(big_b - big_a) > 1e-6
+        if not active.any():
+            break
+        c = big_a + (big_a - big_b) * f_a / np.where(active, f_b - f_a, 1.0)
+        f_c = f(c)
+        swap = f_c * f_b <= 0
+        big_a = np.where(active & swap, big_b, big_a)
+        f_a = np.where(active, np.where(swap, f_b, f_a / 2.0), f_a)
+        big_b = np.where(active, c, big_b)
+        f_b = np.where(active, f_c, f_b)
+    new_sigma = np.exp(big_a / 2.0)
+
+    phi_star = np.sqrt(phi ** 2 + new_sigma ** 2)
+    new_phi = 1.0 / np.sqrt(1.0 / phi_star ** 2 + 1.0 / v)
+    state['rd'][u] = new_phi * GLICKO_SCALE
+    state['volatility'][u] = new_sigma
+    return np.floor((mu + new_phi ** 2 * g * (s - e)) * GLICKO_SCALE + 0.5)
+
+
+STEPS = {'fixed': _fixed, 'elo': _elo, 'glicko2': _glicko2}
+
+
+def new_state(engine, ratings, games_played, rd=None, volatility=None):
+    """Состояние игроков для advance(); rd и volatility нужны только Glicko-2 (NaN — по умолчанию)."""
+    state = {
+        'rating': np.asarray(ratings, dtype=np.float64).copy(),
+        'games': np.asarray(games_played, dtype=np.int64).copy(),
+    }
+    if engine.name == 'glicko2':
+        n = len(state['rating'])
+        state['rd'] = np.full(n, engine.default_rd) if rd is None else np.where(np.isnan(rd), engine.default_rd, rd)
+        state['volatility'] = (np.full(n, engine.default_volatility) if volatility is None
+                               else np.where(np.isnan(volatility), engine.default_volatility, volatility))
+    return state
+
+
+def advance(state, engine, user_idx, opponent_rating, score, min_rating):
+    """Проигрывает партии (в хронологическом порядке) поверх state, меняя его на месте."""
+    step = STEPS[engine.name]
+    for idx in rounds(user_idx):
+        u = user_idx[idx]
+        opp = opponent_rating[idx]
+        opp = np.where(np.isnan(opp), state['rating'][u], opp)
+        state['rating'][u] = np.maximum(step(engine, state, u, opp, score[idx]), min_rating)
+        state['games'][u] += 1
+    return state
+
+
+def replay(games, engine, initial_rating, min_rating):
+    """Итоговые рейтинги и число партий каждого игрока (массивы по games.user_ids)."""
+    n_users = len(games.user_ids)
+    state = new_state(engine, np.full(n_users, float(initial_rating)), np.zeros(n_users, dtype=np.int64))
+    advance(state, engine, games.user_idx, games.opponent_rating, games.score, min_rating)
+    return state['rating'].astype(np.int64), state['games']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--engine', choices=sorted(rating_engine.ENGINES), help='по умолчанию — из rating_settings')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='переопределить настройку рейтинга, например elo_k=24')
+    parser.add_argument('--csv', help='записать user_id, текущий и пересчитанный рейтинг')
+    args = parser.parse_args(argv)
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    cur.execute("SELECT key, value FROM rating_settings")
+    settings = {r[0]: r[1] for r in cur.fetchall()}
+    for item in args.set:
+        key, _, value = item.partition('=')
+        settings[key.strip()] = value.strip()
+    engine = rating_engine.get_engine(settings, args.engine)
+    initial_rating = int(settings.get('initial_rating', '1200'))
+    min_rating = int(settings.get('min_rating', '500'))
+
+    started = time.monotonic()
+    games = load_games(conn)
+    loaded = time.monotonic()
+    ratings, played = replay(games, engine, initial_rating, min_rating)
+    done = time.monotonic()
+
+    cur.execute("SELECT id, rating FROM users")
+    current = dict(cur.fetchall())
+    conn.close()
+    now = np.array([current.get(uid, initial_rating) for uid in games.user_ids], dtype=np.int64)
+    diff = ratings - now
+
+    print('engine=%s games=%d users=%d load=%.2fs replay=%.2fs (%.0f games/s)' % (
+        engine.name, len(games.score), len(games.user_ids), loaded - started, done - loaded,
+        len(games.score) / max(done - loaded, 1e-9)))
+    if len(ratings):
+        print('rating p10/p50/p90: %d / %d / %d' % tuple(np.percentile(ratings, [10, 50, 90])))
+        print('change vs current: mean %+.1f, |max| %d' % (diff.mean(), np.abs(diff).max()))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['user_id', 'games', 'current_rating', 'replayed_rating'])
+            for row in zip(games.user_ids, played, now, ratings):
+                writer.writerow(row)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
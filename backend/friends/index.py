@@ -3,7 +3,37 @@ import os
 import psycopg2
 import random
 import string
-from datetime import datetime, timedelta
+from datetime import datetime, timezone, timedelta
+
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
+MSK = timezone(timedelta(hours=3))
+
+
+def effective_rating_sql(cur, prefix=''):
+    """Выражение рейтинга с накопленным ежедневным снижением: daily_decay за каждый
+    день после decay_anchor_date, но не ниже min_rating."""
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating')")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    decay = abs(int(settings.get('daily_decay', '1')))
+    min_rating = int(settings.get('min_rating', '500'))
+    today = datetime.now(MSK).strftime('%Y-%m-%d')
+    return "CASE WHEN {p}rating > {m} THEN GREATEST({p}rating - {d} * GREATEST(DATE '{t}' - {p}decay_anchor_date, 0), {m}) ELSE {p}rating END".format(
+        p=prefix, d=decay, m=min_rating, t=today)
 
 
 def esc(val):
@@ -60,7 +90,7 @@ def handler(event: dict, context) -> dict:
         return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
     headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -125,11 +155,11 @@ def handler(event: dict, context) -> dict:
             else:
                 code = row[0]
             cur.execute(
-                """SELECT u.id, u.username, u.avatar, u.rating, u.city, u.last_online, u.user_code, f.status
+                """SELECT u.id, u.username, u.avatar, %s, u.city, u.last_online, u.user_code, f.status
                    FROM friends f
                    JOIN users u ON u.id = f.friend_id
                    WHERE f.user_id = '%s' AND f.status = 'confirmed'
-                   ORDER BY u.last_online DESC NULLS LAST""" % esc(user_id))
+                   ORDER BY u.last_online DESC NULLS LAST""" % (effective_rating_sql(cur, 'u.'), esc(user_id)))
             f_rows = cur.fetchall()
             now = datetime.utcnow()
             friends = []
@@ -139,11 +169,11 @@ def handler(event: dict, context) -> dict:
                 friends.append({'id': r[0], 'username': r[1], 'avatar': r[2] or '', 'rating': r[3], 'city': r[4] or '',
                                 'status': 'online' if is_online else 'offline', 'user_code': r[6] or ''})
             cur.execute(
-                """SELECT u.id, u.username, u.avatar, u.rating, u.city, u.user_code
+                """SELECT u.id, u.username, u.avatar, %s, u.city, u.user_code
                    FROM friends f JOIN users u ON u.id = f.user_id
                    WHERE f.friend_id = '%s' AND f.status = 'pending'
                    AND NOT EXISTS (SELECT 1 FROM friends f2 WHERE f2.user_id = '%s' AND f2.friend_id = f.user_id)
-                   ORDER BY f.created_at DESC""" % (esc(user_id), esc(user_id)))
+                   ORDER BY f.created_at DESC""" % (effective_rating_sql(cur, 'u.'), esc(user_id), esc(user_id)))
             p_rows = cur.fetchall()
             pending = []
             for r in p_rows:
@@ -158,7 +188,7 @@ def handler(event: dict, context) -> dict:
                 cur.close()
                 conn.close()
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'code required'})}
-            cur.execute("SELECT id, username, avatar, rating, city, user_code FROM users WHERE user_code = '%s'" % esc(code))
+            cur.execute("SELECT id, username, avatar, %s, city, user_code FROM users WHERE user_code = '%s'" % (effective_rating_sql(cur), esc(code)))
             row = cur.fetchone()
             cur.close()
             conn.close()
@@ -174,7 +204,7 @@ def handler(event: dict, context) -> dict:
                 cur.close()
                 conn.close()
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'friend_id required'})}
-            cur.execute("SELECT id, username, avatar, rating, city, games_played, wins, losses, draws, last_online FROM users WHERE id = '%s'" % esc(friend_id))
+            cur.execute("SELECT id, username, avatar, %s, city, games_played, wins, losses, draws, last_online FROM users WHERE id = '%s'" % (effective_rating_sql(cur), esc(friend_id)))
             row = cur.fetchone()
             cur.close()
             conn.close()
@@ -211,11 +241,11 @@ def handler(event: dict, context) -> dict:
 
         if action == 'pending':
             cur.execute(
-                """SELECT u.id, u.username, u.avatar, u.rating, u.city, u.user_code
+                """SELECT u.id, u.username, u.avatar, %s, u.city, u.user_code
                    FROM friends f JOIN users u ON u.id = f.user_id
                    WHERE f.friend_id = '%s' AND f.status = 'pending'
                    AND NOT EXISTS (SELECT 1 FROM friends f2 WHERE f2.user_id = '%s' AND f2.friend_id = f.user_id)
-                   ORDER BY f.created_at DESC""" % (esc(user_id), esc(user_id)))
+                   ORDER BY f.created_at DESC""" % (effective_rating_sql(cur, 'u.'), esc(user_id), esc(user_id)))
             rows = cur.fetchall()
             cur.close()
             conn.close()
@@ -225,11 +255,11 @@ def handler(event: dict, context) -> dict:
             return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'pending': pending})}
 
         cur.execute(
-            """SELECT u.id, u.username, u.avatar, u.rating, u.city, u.last_online, u.user_code, f.status
+            """SELECT u.id, u.username, u.avatar, %s, u.city, u.last_online, u.user_code, f.status
                FROM friends f
                JOIN users u ON u.id = f.friend_id
                WHERE f.user_id = '%s' AND f.status = 'confirmed'
-               ORDER BY u.last_online DESC NULLS LAST""" % esc(user_id))
+               ORDER BY u.last_online DESC NULLS LAST""" % (effective_rating_sql(cur, 'u.'), esc(user_id)))
         rows = cur.fetchall()
         cur.close()
         conn.close()
@@ -259,7 +289,7 @@ def handler(event: dict, context) -> dict:
                 conn.close()
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'friend_code required'})}
 
-            cur.execute("SELECT id, username, avatar, rating, city, user_code FROM users WHERE user_code = '%s'" % esc(friend_code))
+            cur.execute("SELECT id, username, avatar, %s, city, user_code FROM users WHERE user_code = '%s'" % (effective_rating_sql(cur), esc(friend_code)))
             friend_row = cur.fetchone()
             if not friend_row:
                 cur.close()
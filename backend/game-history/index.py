@@ -1,6 +1,37 @@
 import json
 import os
 import psycopg2
+from datetime import datetime, timezone, timedelta
+
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
+MSK = timezone(timedelta(hours=3))
+
+
+def effective_rating_sql(cur, prefix=''):
+    """Выражение рейтинга с накопленным ежедневным снижением: daily_decay за каждый
+    день после decay_anchor_date, но не ниже min_rating."""
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating')")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    decay = abs(int(settings.get('daily_decay', '1')))
+    min_rating = int(settings.get('min_rating', '500'))
+    today = datetime.now(MSK).strftime('%Y-%m-%d')
+    return "CASE WHEN {p}rating > {m} THEN GREATEST({p}rating - {d} * GREATEST(DATE '{t}' - {p}decay_anchor_date, 0), {m}) ELSE {p}rating END".format(
+        p=prefix, d=decay, m=min_rating, t=today)
 
 
 def get_client_ip(event):
@@ -58,12 +89,12 @@ def handler(event: dict, context) -> dict:
     if not user_id:
         return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'user_id required'})}
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
 
     cur.execute(
-        "SELECT id, username, avatar, rating, games_played, wins, losses, draws FROM users WHERE id = '%s'"
-        % user_id.replace("'", "''")
+        "SELECT id, username, avatar, %s, games_played, wins, losses, draws FROM users WHERE id = '%s'"
+        % (effective_rating_sql(cur), user_id.replace("'", "''"))
     )
     user_row = cur.fetchone()
 
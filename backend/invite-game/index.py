@@ -1,9 +1,40 @@
 import json
 import os
 import psycopg2
+from datetime import datetime, timezone, timedelta
 import random
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
+MSK = timezone(timedelta(hours=3))
+
+
+def effective_rating_sql(cur, prefix=''):
+    """Выражение рейтинга с накопленным ежедневным снижением: daily_decay за каждый
+    день после decay_anchor_date, но не ниже min_rating."""
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating')")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    decay = abs(int(settings.get('daily_decay', '1')))
+    min_rating = int(settings.get('min_rating', '500'))
+    today = datetime.now(MSK).strftime('%Y-%m-%d')
+    return "CASE WHEN {p}rating > {m} THEN GREATEST({p}rating - {d} * GREATEST(DATE '{t}' - {p}decay_anchor_date, 0), {m}) ELSE {p}rating END".format(
+        p=prefix, d=decay, m=min_rating, t=today)
+
+
 def esc(val):
     return str(val).replace("'", "''")
 
@@ -61,7 +92,7 @@ def handler(event: dict, context) -> dict:
         return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
     headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -139,7 +170,7 @@ def handler(event: dict, context) -> dict:
             if not from_user_id or not to_user_id:
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'from_user_id and to_user_id required'})}
 
-            cur.execute("SELECT id, username, avatar, rating FROM users WHERE id = '%s'" % esc(from_user_id))
+            cur.execute("SELECT id, username, avatar, %s FROM users WHERE id = '%s'" % (effective_rating_sql(cur), esc(from_user_id)))
             sender = cur.fetchone()
             if not sender:
                 return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'sender not found'})}
@@ -184,7 +215,7 @@ def handler(event: dict, context) -> dict:
             if invite[8] != 'pending':
                 return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'invite already processed'})}
 
-            cur.execute("SELECT id, username, avatar, rating FROM users WHERE id = '%s'" % esc(user_id))
+            cur.execute("SELECT id, username, avatar, %s FROM users WHERE id = '%s'" % (effective_rating_sql(cur), esc(user_id)))
             accepter = cur.fetchone()
             if not accepter:
                 return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'user not found'})}
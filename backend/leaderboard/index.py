@@ -1,6 +1,33 @@
 import json
 import os
 import psycopg2
+from datetime import datetime, timezone, timedelta
+
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
+MSK = timezone(timedelta(hours=3))
+
+
+def decay_settings(cur, schema):
+    """(daily_decay, min_rating, сегодня по МСК) для рейтинга с накопленным снижением."""
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM {s}.rating_settings WHERE key IN ('daily_decay', 'min_rating')".format(s=schema))
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    return (abs(int(settings.get('daily_decay', '1'))), int(settings.get('min_rating', '500')),
+            datetime.now(MSK).strftime('%Y-%m-%d'))
 
 
 def handler(event, context):
@@ -18,9 +45,8 @@ def handler(event, context):
         }
 
     headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
-    dsn = os.environ['DATABASE_URL']
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    conn = psycopg2.connect(dsn)
+    conn = get_connection()
     cur = conn.cursor()
 
     qs = event.get('queryStringParameters') or {}
@@ -28,11 +54,19 @@ def handler(event, context):
     region = qs.get('region', '')
     limit = min(int(qs.get('limit', '10')), 50)
 
+    # Рейтинг — с ежедневным снижением за дни после decay_anchor_date. Порядок по нему
+    # совпадает с порядком по rating + decay * (decay_anchor_date - 2000-01-01): это
+    # выражение без «сегодня» и настроек, его покрывает idx_users_decayed_rating
+    decay, min_rating, today = decay_settings(cur, schema)
+    rating_expr = "CASE WHEN rating > %d THEN GREATEST(rating - %d * GREATEST(DATE '%s' - decay_anchor_date, 0), %d) ELSE rating END" % (
+        min_rating, decay, today, min_rating)
+    order_key = "(rating + %d * (decay_anchor_date - DATE '2000-01-01'))" % decay if decay else "rating"
+
     def fetch_top(where_clause=''):
-        sql = "SELECT username, rating, city, avatar FROM {s}.users".format(s=schema)
+        sql = "SELECT username, {r}, city, avatar FROM {s}.users".format(r=rating_expr, s=schema)
         if where_clause:
             sql += " WHERE " + where_clause
-        sql += " ORDER BY rating DESC LIMIT %d" % limit
+        sql += " ORDER BY %s DESC LIMIT %d" % (order_key, limit)
         cur.execute(sql)
         rows = cur.fetchall()
         result = []
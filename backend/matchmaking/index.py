@@ -2,6 +2,29 @@ import json
 import os
 import psycopg2
 import random
+from datetime import datetime, timezone, timedelta
+
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import matchmaking_engine
+except ImportError:
+    matchmaking_engine = None
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+QUEUE_EVENTS_CHANNEL = 'matchmaking_queue_events'
+HEARTBEAT_FILTER = "AND last_heartbeat > NOW() - INTERVAL '10 seconds'"
+
+MSK = timezone(timedelta(hours=3))
 
 BOT_NAMES = [
     'Бот Каспаров', 'Бот Карлсен', 'Бот Фишер', 'Бот Таль',
@@ -16,10 +39,43 @@ def get_initial_time(time_control):
     return mapping.get(time_control, 600)
 
 
+def effective_rating_sql(cur, prefix=''):
+    """Выражение рейтинга с накопленным ежедневным снижением: daily_decay за каждый
+    день после decay_anchor_date, но не ниже min_rating."""
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating')")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    decay = abs(int(settings.get('daily_decay', '1')))
+    min_rating = int(settings.get('min_rating', '500'))
+    today = datetime.now(MSK).strftime('%Y-%m-%d')
+    return "CASE WHEN {p}rating > {m} THEN GREATEST({p}rating - {d} * GREATEST(DATE '{t}' - {p}decay_anchor_date, 0), {m}) ELSE {p}rating END".format(
+        p=prefix, d=decay, m=min_rating, t=today)
+
+
 def esc(val):
     return str(val).replace("'", "''")
 
 
+def history_sql(game_id):
+    """move_history из журнала online_game_moves, пока партия не завершена."""
+    return (
+        "CASE WHEN move_history <> '' THEN move_history ELSE "
+        "(SELECT COALESCE(string_agg(move, ',' ORDER BY ply), '') FROM online_game_moves WHERE game_id = %d) END"
+        % game_id
+    )
+
+
+def game_etag(game_id, move_number, status, rematch_status):
+    return '"%d-%d-%s-%s"' % (game_id, move_number or 0, status or '', rematch_status or '')
+
+
+def get_if_none_match(event):
+    hdrs = event.get('headers') or {}
+    return hdrs.get('If-None-Match', hdrs.get('if-none-match', ''))
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -59,27 +115,148 @@ def check_rate_limit(cur, conn, ip, endpoint, max_requests, window_seconds):
         return False
 
 
-def create_game(cur, conn, headers, user_id, username, avatar, user_rating, matched, time_control, opponent_type, is_bot=False):
-    matched_uid, matched_name, matched_avatar, matched_rating = matched
+def engine_ready():
+    return matchmaking_engine is not None and matchmaking_engine.is_ready()
 
-    assign_white = random.random() < 0.5
-    initial_time = get_initial_time(time_control)
 
-    if assign_white:
-        w_uid, w_name, w_avatar, w_rating = user_id, username, avatar, user_rating
-        b_uid, b_name, b_avatar, b_rating = matched_uid, matched_name, matched_avatar or '', matched_rating
+def notify_queue(cur, op, **payload):
+    """Событие очереди для in-memory индексов всех воркеров (доставляется при commit)."""
+    payload['op'] = op
+    cur.execute("SELECT pg_notify('%s', '%s')" % (QUEUE_EVENTS_CHANNEL, esc(json.dumps(payload))))
+    if engine_ready():
+        matchmaking_engine.apply_event(payload)
+
+
+def search_stages(search_stage, city, region):
+    """Каскад стадий поиска: город → регион → рейтинг ±50 → любой онлайн."""
+    stages = []
+    if search_stage == 'city' and city:
+        stages.append('city')
+    if search_stage in ('city', 'region') and region:
+        stages.append('region')
+    if search_stage in ('city', 'region', 'rating', 'any'):
+        stages.append('rating')
+    if search_stage == 'any':
+        stages.append('any')
+    return stages
+
+
+CLAIM_COLUMNS = "user_id, username, avatar, rating, time_control"
+
+
+def claim_nearest_sql(cur, stage, user_id, user_rating, time_control, city, region):
+    """Забирает ближайшую заявку одним DELETE: занятые другими поисками строки пропускаются."""
+    if stage == 'city':
+        where = "time_control = '%s' AND city = '%s'" % (esc(time_control), esc(city))
+    elif stage == 'region':
+        where = "time_control = '%s' AND region = '%s'" % (esc(time_control), esc(region))
+    elif stage == 'rating':
+        where = "time_control = '%s' AND rating >= %d AND rating <= %d" % (esc(time_control), user_rating - 50, user_rating + 50)
     else:
-        w_uid, w_name, w_avatar, w_rating = matched_uid, matched_name, matched_avatar or '', matched_rating
-        b_uid, b_name, b_avatar, b_rating = user_id, username, avatar, user_rating
+        where = "TRUE"
+    cur.execute(
+        "DELETE FROM matchmaking_queue WHERE user_id = (SELECT user_id FROM matchmaking_queue WHERE user_id != '%s' AND %s %s ORDER BY ABS(rating - %d) LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING %s"
+        % (esc(user_id), where, HEARTBEAT_FILTER, user_rating, CLAIM_COLUMNS)
+    )
+    return cur.fetchone()
+
+
+def find_candidates_engine(stage, user_id, user_rating, time_control, city, region):
+    exclude = {user_id}
+    if stage == 'city':
+        return matchmaking_engine.nearest(('city', time_control, city), user_rating, exclude)
+    if stage == 'region':
+        return matchmaking_engine.nearest(('region', time_control, region), user_rating, exclude)
+    if stage == 'rating':
+        return matchmaking_engine.nearest(('tc', time_control), user_rating, exclude,
+                                          rating_min=user_rating - 50, rating_max=user_rating + 50)
+    return matchmaking_engine.nearest(('all',), user_rating, exclude)
+
+
+def claim_candidate(cur, candidate_uid):
+    """Индекс может отставать на доли секунды — заявку забираем по ключу, только если она жива и свободна."""
+    cur.execute(
+        "DELETE FROM matchmaking_queue WHERE user_id = (SELECT user_id FROM matchmaking_queue WHERE user_id = '%s' %s FOR UPDATE SKIP LOCKED) RETURNING %s"
+        % (esc(candidate_uid), HEARTBEAT_FILTER, CLAIM_COLUMNS)
+    )
+    return cur.fetchone()
+
+
+def claim_match(cur, user_id, user_rating, time_control, city, region, search_stage):
+    """Ищет и сразу забирает соперника в текущей транзакции. Забранная строка
+    удалена, но до commit остаётся заблокированной — второй поиск её не увидит."""
+    use_engine = engine_ready()
+    for stage in search_stages(search_stage, city, region):
+        if use_engine:
+            for candidate in find_candidates_engine(stage, user_id, user_rating, time_control, city, region):
+                row = claim_candidate(cur, candidate[0])
+                if row:
+                    return row, stage
+        else:
+            row = claim_nearest_sql(cur, stage, user_id, user_rating, time_control, city, region)
+            if row:
+                return row, stage
+    return None, None
+
+
+def get_queue_count(cur, time_control):
+    if engine_ready():
+        return matchmaking_engine.count(time_control)
+    cur.execute("SELECT COUNT(*) FROM matchmaking_queue WHERE time_control = '%s'" % esc(time_control))
+    return cur.fetchone()[0]
+
+
+def find_pending_game(cur, user_id):
+    """Партия, созданная соперником, который забрал нашу заявку, пока мы ждали следующего опроса.
 
+    Реванши и партии по приглашению создаются не из очереди — их не считаем."""
+    cur.execute(
+        """SELECT id, white_user_id, white_username, white_avatar, white_rating, black_username, black_avatar, black_rating
+        FROM online_games
+        WHERE (white_user_id = '%s' OR black_user_id = '%s') AND status = 'playing' AND is_bot_game = FALSE
+          AND rematch_of IS NULL AND opponent_type <> 'friend'
+          AND move_number = 0 AND created_at > NOW() - INTERVAL '15 seconds'
+        ORDER BY id DESC LIMIT 1"""
+        % (esc(user_id), esc(user_id))
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    is_white = row[1] == user_id
+    return {
+        'status': 'matched',
+        'game_id': row[0],
+        'player_color': 'white' if is_white else 'black',
+        'opponent_name': row[5] if is_white else row[2],
+        'opponent_rating': row[7] if is_white else row[4],
+        'opponent_avatar': (row[6] if is_white else row[3]) or ''
+    }
+
+
+def insert_game(cur, white, black, time_control, opponent_type, is_bot=False):
+    """white/black — (user_id, username, avatar, rating). Возвращает id партии, без commit."""
+    w_uid, w_name, w_avatar, w_rating = white
+    b_uid, b_name, b_avatar, b_rating = black
+    initial_time = get_initial_time(time_control)
     cur.execute(
         """INSERT INTO online_games (white_user_id, white_username, white_avatar, white_rating, black_user_id, black_username, black_avatar, black_rating, time_control, opponent_type, is_bot_game, white_time, black_time)
         VALUES ('%s', '%s', '%s', %d, '%s', '%s', '%s', %d, '%s', '%s', %s, %d, %d) RETURNING id"""
-        % (esc(w_uid), esc(w_name), esc(w_avatar), w_rating,
-           esc(b_uid), esc(b_name), esc(b_avatar), b_rating,
+        % (esc(w_uid), esc(w_name), esc(w_avatar or ''), w_rating,
+           esc(b_uid), esc(b_name), esc(b_avatar or ''), b_rating,
            esc(time_control), esc(opponent_type), 'TRUE' if is_bot else 'FALSE', initial_time, initial_time)
     )
-    game_id = cur.fetchone()[0]
+    return cur.fetchone()[0]
+
+
+def create_game(cur, conn, headers, user_id, username, avatar, user_rating, matched, time_control, opponent_type, is_bot=False):
+    matched_uid, matched_name, matched_avatar, matched_rating = matched
+
+    assign_white = random.random() < 0.5
+    me = (user_id, username, avatar, user_rating)
+    if assign_white:
+        game_id = insert_game(cur, me, matched, time_control, opponent_type, is_bot)
+    else:
+        game_id = insert_game(cur, matched, me, time_control, opponent_type, is_bot)
     conn.commit()
 
     player_color = 'white' if assign_white else 'black'
@@ -98,32 +275,129 @@ def create_game(cur, conn, headers, user_id, username, avatar, user_rating, matc
     }
 
 
+PAIRING_LOCK_KEY = 7301  # pg_advisory_xact_lock: один тик на весь кластер шлюзов
+
+
+def pair_line(entries, max_gap=None):
+    """Оптимальные пары на отсортированном по рейтингу списке: максимум пар,
+    при равенстве — минимальная суммарная разница рейтингов. На прямой
+    оптимальные пары всегда соседние, поэтому хватает линейной динамики."""
+    entries = sorted(entries, key=lambda e: e['rating'])
+    n = len(entries)
+    best = [(0, 0)] * (n + 1)  # (-пар, сумма разниц) для первых i заявок
+    take = [False] * (n + 1)
+    for i in range(1, n + 1):
+        best[i] = best[i - 1]
+        if i >= 2:
+            gap = entries[i - 1]['rating'] - entries[i - 2]['rating']
+            if max_gap is None or gap <= max_gap:
+                cand = (best[i - 2][0] - 1, best[i - 2][1] + gap)
+                if cand < best[i]:
+                    best[i] = cand
+                    take[i] = True
+    pairs = []
+    i = n
+    while i >= 2:
+        if take[i]:
+            pairs.append((entries[i - 2], entries[i - 1]))
+            i -= 2
+        else:
+            i -= 1
+    return pairs
+
+
+def plan_pairings(entries):
+    """Глобальные пары для тика с учётом стадий поиска: сначала внутри города,
+    затем региона, затем по рейтингу ±50 в одном контроле, затем «любой»."""
+    left = {e['user_id']: e for e in entries}
+    pairs = []
+
+    def run(stage, bucket_key, max_gap=None):
+        buckets = {}
+        for e in left.values():
+            if stage not in search_stages(e['search_stage'], e['city'], e['region']):
+                continue
+            buckets.setdefault(bucket_key(e), []).append(e)
+        for bucket in buckets.values():
+            for a, b in pair_line(bucket, max_gap):
+                left.pop(a['user_id'], None)
+                left.pop(b['user_id'], None)
+                pairs.append((a, b, stage))
+
+    run('city', lambda e: (e['time_control'], e['city']))
+    run('region', lambda e: (e['time_control'], e['region']))
+    run('rating', lambda e: e['time_control'], max_gap=50)
+    run('any', lambda e: 'all')
+    return pairs
+
+
+def run_pairing_tick(conn):
+    """Пакетный проход по очереди: все живые заявки читаются одним запросом,
+    пары создаются партиями в одной транзакции. Игроки забирают партию
+    следующим опросом (find_pending_game). Возвращает число созданных партий."""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_xact_lock(%d)" % PAIRING_LOCK_KEY)
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        cur.close()
+        return 0
+    cur.execute(
+        "SELECT user_id, username, avatar, rating, time_control, opponent_type, city, region, search_stage FROM matchmaking_queue WHERE TRUE %s FOR UPDATE SKIP LOCKED"
+        % HEARTBEAT_FILTER
+    )
+    entries = [
+        {'user_id': r[0], 'username': r[1], 'avatar': r[2] or '', 'rating': r[3], 'time_control': r[4],
+         'opponent_type': r[5], 'city': r[6] or '', 'region': r[7] or '', 'search_stage': r[8] or 'city'}
+        for r in cur.fetchall()
+    ]
+    pairs = plan_pairings(entries)
+    if not pairs:
+        conn.rollback()
+        cur.close()
+        return 0
+
+    paired = []
+    for a, b, stage in pairs:
+        if random.random() < 0.5:
+            a, b = b, a
+        insert_game(cur, (a['user_id'], a['username'], a['avatar'], a['rating']),
+                    (b['user_id'], b['username'], b['avatar'], b['rating']),
+                    a['time_control'], a['opponent_type'])
+        paired.extend([a['user_id'], b['user_id']])
+    cur.execute(
+        "DELETE FROM matchmaking_queue WHERE user_id IN (%s)" % ', '.join("'%s'" % esc(uid) for uid in paired)
+    )
+    notify_queue(cur, 'leave', user_ids=paired)
+    conn.commit()
+    cur.close()
+    return len(pairs)
+
+
 def handler(event: dict, context) -> dict:
     """Матчмейкинг с каскадным поиском: город → регион → рейтинг ±50 → любой онлайн"""
     if event.get('httpMethod') == 'OPTIONS':
-        return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
+        return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id, If-None-Match', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
-    headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
+    headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json', 'Access-Control-Expose-Headers': 'ETag'}
 
     client_ip = get_client_ip(event)
     if event.get('httpMethod') == 'POST':
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cur = conn.cursor()
         if check_rate_limit(cur, conn, client_ip, 'matchmaking', 20, 60):
             cur.close()
             conn.close()
             return {'statusCode': 429, 'headers': headers, 'body': json.dumps({'error': 'Too many requests'})}
-        cur.close()
-        conn.close()
 
     if event.get('httpMethod') == 'DELETE':
         body = json.loads(event.get('body', '{}'))
         user_id = body.get('user_id', '')
         if not user_id:
             return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'user_id required'})}
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cur = conn.cursor()
         cur.execute("DELETE FROM matchmaking_queue WHERE user_id = '%s'" % esc(user_id))
+        notify_queue(cur, 'leave', user_ids=[user_id])
         conn.commit()
         cur.close()
         conn.close()
@@ -134,25 +408,35 @@ def handler(event: dict, context) -> dict:
         game_id = qs.get('game_id', '')
         user_id = qs.get('user_id', '')
         if game_id:
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_connection()
             cur = conn.cursor()
-            cur.execute("SELECT id, white_user_id, white_username, white_avatar, white_rating, black_user_id, black_username, black_avatar, black_rating, time_control, status, is_bot_game, current_player, white_time, black_time, move_history, board_state, winner, end_reason FROM online_games WHERE id = %d" % int(game_id))
+            if_none_match = get_if_none_match(event)
+            if if_none_match:
+                cur.execute("SELECT move_number, status, rematch_status FROM online_games WHERE id = %d" % int(game_id))
+                head = cur.fetchone()
+                if head and game_etag(int(game_id), *head) == if_none_match:
+                    cur.close()
+                    conn.close()
+                    return {'statusCode': 304, 'headers': dict(headers, ETag=if_none_match), 'body': ''}
+            cur.execute("SELECT id, white_user_id, white_username, white_avatar, white_rating, black_user_id, black_username, black_avatar, black_rating, time_control, status, is_bot_game, current_player, white_time, black_time, %s, board_state, winner, end_reason, move_number, rematch_status FROM online_games WHERE id = %d" % (history_sql(int(game_id)), int(game_id)))
             row = cur.fetchone()
             cur.close()
             conn.close()
             if not row:
                 return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'game not found'})}
-            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
+            etag = game_etag(row[0], row[19], row[10], row[20])
+            return {'statusCode': 200, 'headers': dict(headers, ETag=etag), 'body': json.dumps({
                 'game': {
                     'id': row[0], 'white_user_id': row[1], 'white_username': row[2], 'white_avatar': row[3], 'white_rating': row[4],
                     'black_user_id': row[5], 'black_username': row[6], 'black_avatar': row[7], 'black_rating': row[8],
                     'time_control': row[9], 'status': row[10], 'is_bot_game': row[11], 'current_player': row[12],
-                    'white_time': row[13], 'black_time': row[14], 'move_history': row[15], 'board_state': row[16],
+                    'white_time': row[13], 'black_time': row[14], 'move_history': row[15],
+                    'board_state': None if row[11] else row[16],
                     'winner': row[17], 'end_reason': row[18]
                 }
             })}
         if user_id:
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_connection()
             cur = conn.cursor()
             cur.execute("SELECT id FROM matchmaking_queue WHERE user_id = '%s'" % esc(user_id))
             in_queue = cur.fetchone()
@@ -177,13 +461,13 @@ def handler(event: dict, context) -> dict:
     search_stage = body.get('search_stage', 'city')
 
     if not user_id:
+        cur.close()
+        conn.close()
         return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'user_id required'})}
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-
     if action == 'play_bot':
         cur.execute("DELETE FROM matchmaking_queue WHERE user_id = '%s'" % esc(user_id))
+        notify_queue(cur, 'leave', user_ids=[user_id])
         bot_name = random.choice(BOT_NAMES)
         bot_rating = user_rating + random.randint(-30, 30)
         result = create_game(cur, conn, headers, user_id, username, avatar, user_rating,
@@ -192,60 +476,55 @@ def handler(event: dict, context) -> dict:
         conn.close()
         return result
 
-    cur.execute("SELECT id FROM matchmaking_queue WHERE user_id = '%s'" % esc(user_id))
-    already_in = cur.fetchone()
-
-    match = None
-    matched_stage = None
-
-    HEARTBEAT_FILTER = "AND last_heartbeat > NOW() - INTERVAL '10 seconds'"
-
-    if search_stage == 'city' and city:
-        cur.execute(
-            "SELECT user_id, username, avatar, rating, time_control FROM matchmaking_queue WHERE user_id != '%s' AND time_control = '%s' AND city = '%s' %s ORDER BY ABS(rating - %d) LIMIT 1"
-            % (esc(user_id), esc(time_control), esc(city), HEARTBEAT_FILTER, user_rating)
-        )
-        match = cur.fetchone()
-        if match:
-            matched_stage = 'city'
-
-    if not match and search_stage in ('city', 'region') and region:
-        cur.execute(
-            "SELECT user_id, username, avatar, rating, time_control FROM matchmaking_queue WHERE user_id != '%s' AND time_control = '%s' AND region = '%s' %s ORDER BY ABS(rating - %d) LIMIT 1"
-            % (esc(user_id), esc(time_control), esc(region), HEARTBEAT_FILTER, user_rating)
-        )
-        match = cur.fetchone()
-        if match:
-            matched_stage = 'region'
+    # Чистим «мертвые» записи старше 15 сек (с индексом в памяти — не на каждом запросе)
+    if not engine_ready() or matchmaking_engine.should_sweep():
+        cur.execute("DELETE FROM matchmaking_queue WHERE last_heartbeat < NOW() - INTERVAL '15 seconds' RETURNING user_id")
+        dead = [r[0] for r in cur.fetchall()]
+        if dead:
+            notify_queue(cur, 'leave', user_ids=dead)
+        conn.commit()
 
-    if not match and search_stage in ('city', 'region', 'rating', 'any'):
-        rating_min = user_rating - 50
-        rating_max = user_rating + 50
-        cur.execute(
-            "SELECT user_id, username, avatar, rating, time_control FROM matchmaking_queue WHERE user_id != '%s' AND time_control = '%s' AND rating >= %d AND rating <= %d %s ORDER BY ABS(rating - %d) LIMIT 1"
-            % (esc(user_id), esc(time_control), rating_min, rating_max, HEARTBEAT_FILTER, user_rating)
-        )
-        match = cur.fetchone()
-        if match:
-            matched_stage = 'rating'
+    cur.execute("SELECT id, rating FROM matchmaking_queue WHERE user_id = '%s'" % esc(user_id))
+    already_in = cur.fetchone()
 
-    if not match and search_stage == 'any':
-        cur.execute(
-            "SELECT user_id, username, avatar, rating, time_control FROM matchmaking_queue WHERE user_id != '%s' %s ORDER BY ABS(rating - %d) LIMIT 1"
-            % (esc(user_id), HEARTBEAT_FILTER, user_rating)
-        )
-        match = cur.fetchone()
-        if match:
-            matched_stage = 'any'
+    if not already_in:
+        pending = find_pending_game(cur, user_id)
+        if pending:
+            conn.commit()
+            cur.close()
+            conn.close()
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps(pending)}
+        # Рейтинг для подбора — из users с накопленным ежедневным снижением,
+        # а не тот, что клиент запомнил до него
+        cur.execute("SELECT %s FROM users WHERE id = '%s'" % (effective_rating_sql(cur), esc(user_id)))
+        row = cur.fetchone()
+        if row:
+            user_rating = row[0]
+    else:
+        user_rating = already_in[1]
+        # Свою заявку блокируем на время поиска; если она уже заблокирована,
+        # нас прямо сейчас забирает другой поиск — партию заберём следующим опросом
+        cur.execute("SELECT id FROM matchmaking_queue WHERE user_id = '%s' FOR UPDATE SKIP LOCKED" % esc(user_id))
+        if not cur.fetchone():
+            conn.rollback()
+            queue_count = get_queue_count(cur, time_control)
+            cur.close()
+            conn.close()
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
+                'status': 'searching',
+                'search_stage': search_stage,
+                'queue_count': queue_count
+            })}
 
-    # Чистим «мертвые» записи старше 15 сек
-    cur.execute("DELETE FROM matchmaking_queue WHERE last_heartbeat < NOW() - INTERVAL '15 seconds'")
-    conn.commit()
+    match, matched_stage = claim_match(cur, user_id, user_rating, time_control, city, region, search_stage)
 
     if match:
         matched_uid, matched_name, matched_avatar, matched_rating, matched_tc = match
 
-        cur.execute("DELETE FROM matchmaking_queue WHERE user_id IN ('%s', '%s')" % (esc(user_id), esc(matched_uid)))
+        # Заявка соперника уже удалена claim_match; своя удаляется и партия
+        # создаётся в той же транзакции (commit внутри create_game)
+        cur.execute("DELETE FROM matchmaking_queue WHERE user_id = '%s'" % esc(user_id))
+        notify_queue(cur, 'leave', user_ids=[user_id, matched_uid])
 
         result = create_game(cur, conn, headers, user_id, username, avatar, user_rating,
                              (matched_uid, matched_name, matched_avatar, matched_rating),
@@ -259,18 +538,20 @@ def handler(event: dict, context) -> dict:
 
     if not already_in:
         cur.execute(
-            "INSERT INTO matchmaking_queue (user_id, username, avatar, rating, opponent_type, time_control, city, region, last_heartbeat) VALUES ('%s', '%s', '%s', %d, '%s', '%s', '%s', '%s', NOW()) ON CONFLICT (user_id) DO UPDATE SET rating = %d, opponent_type = '%s', time_control = '%s', city = '%s', region = '%s', created_at = NOW(), last_heartbeat = NOW()"
+            "INSERT INTO matchmaking_queue (user_id, username, avatar, rating, opponent_type, time_control, city, region, search_stage, last_heartbeat) VALUES ('%s', '%s', '%s', %d, '%s', '%s', '%s', '%s', '%s', NOW()) ON CONFLICT (user_id) DO UPDATE SET rating = %d, opponent_type = '%s', time_control = '%s', city = '%s', region = '%s', search_stage = '%s', created_at = NOW(), last_heartbeat = NOW()"
             % (esc(user_id), esc(username), esc(avatar), user_rating,
-               esc(opponent_type), esc(time_control), esc(city), esc(region),
-               user_rating, esc(opponent_type), esc(time_control), esc(city), esc(region))
+               esc(opponent_type), esc(time_control), esc(city), esc(region), esc(search_stage),
+               user_rating, esc(opponent_type), esc(time_control), esc(city), esc(region), esc(search_stage))
         )
+        notify_queue(cur, 'join', user_id=user_id, username=username, avatar=avatar, rating=user_rating,
+                     time_control=time_control, city=city, region=region)
         conn.commit()
     else:
-        cur.execute("UPDATE matchmaking_queue SET last_heartbeat = NOW() WHERE user_id = '%s'" % esc(user_id))
+        cur.execute("UPDATE matchmaking_queue SET last_heartbeat = NOW(), search_stage = '%s' WHERE user_id = '%s'" % (esc(search_stage), esc(user_id)))
+        notify_queue(cur, 'beat', user_id=user_id)
         conn.commit()
 
-    cur.execute("SELECT COUNT(*) FROM matchmaking_queue WHERE time_control = '%s'" % esc(time_control))
-    queue_count = cur.fetchone()[0]
+    queue_count = get_queue_count(cur, time_control)
 
     cur.close()
     conn.close()
@@ -0,0 +1,493 @@
+"""Шахматное ядро для проверки ходов онлайн-партий на сервере.
+
+Позиция хранится битбордами: 12 целых по 64 бита (цвет × фигура), клетка
+a1 = 0, h8 = 63. Атаки коней, королей и пешек берутся из таблиц, атаки
+дальнобойных фигур — лучами с поиском первой блокирующей фигуры
+(младший/старший бит). Легальность хода — псевдолегальная генерация плюс
+проверка, что после хода свой король не под боем.
+
+Ходы снаружи записываются как на клиенте: «e2-e4»; превращение пешки по
+умолчанию в ферзя, «e7-e8n» — в другую фигуру.
+
+Каждая позиция несёт 64-битный Zobrist-ключ (Position.key), который
+обновляется инкрементально в make_move. По нему online-move ищет
+троекратное повторение, а клиент может сверять позицию с серверной.
+Взятие на проходе входит в ключ, только если оно реально возможно.
+
+Замер скорости: python chess_core.py (perft из начальной позиции и kiwipete,
+время проверки одного хода в микросекундах).
+"""
+import random
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+PIECE_CHARS = 'pnbrqk'
+PROMO_CHARS = {'n': KNIGHT, 'b': BISHOP, 'r': ROOK, 'q': QUEEN}
+
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+FULL = (1 << 64) - 1
+
+CASTLE_WK, CASTLE_WQ, CASTLE_BK, CASTLE_BQ = 1, 2, 4, 8
+
+
+class IllegalMove(ValueError):
+    pass
+
+
+def _square(text):
+    if len(text) != 2 or text[0] not in 'abcdefgh' or text[1] not in '12345678':
+        raise IllegalMove('bad square: %s' % text)
+    return (ord(text[1]) - 49) * 8 + ord(text[0]) - 97
+
+
+def square_name(sq):
+    return 'abcdefgh'[sq & 7] + str((sq >> 3) + 1)
+
+
+def _steps(sq, deltas):
+    r, f = sq >> 3, sq & 7
+    mask = 0
+    for dr, df in deltas:
+        rr, ff = r + dr, f + df
+        if 0 <= rr < 8 and 0 <= ff < 8:
+            mask |= 1 << (rr * 8 + ff)
+    return mask
+
+
+def _ray(sq, dr, df):
+    r, f = (sq >> 3) + dr, (sq & 7) + df
+    mask = 0
+    while 0 <= r < 8 and 0 <= f < 8:
+        mask |= 1 << (r * 8 + f)
+        r += dr
+        f += df
+    return mask
+
+
+KNIGHT_ATTACKS = [_steps(s, ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))) for s in range(64)]
+KING_ATTACKS = [_steps(s, ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))) for s in range(64)]
+PAWN_ATTACKS = [
+    [_steps(s, ((1, -1), (1, 1))) for s in range(64)],
+    [_steps(s, ((-1, -1), (-1, 1))) for s in range(64)],
+]
+
+# Лучи: «положительные» направления растут по номеру клетки (первый блокер —
+# младший бит), «отрицательные» убывают (первый блокер — старший бит)
+_N, _E, _NE, _NW = ([_ray(s, dr, df) for s in range(64)] for dr, df in ((1, 0), (0, 1), (1, 1), (1, -1)))
+_S, _W, _SW, _SE = ([_ray(s, dr, df) for s in range(64)] for dr, df in ((-1, 0), (0, -1), (-1, -1), (-1, 1)))
+ROOK_POS, ROOK_NEG = (_N, _E), (_S, _W)
+BISHOP_POS, BISHOP_NEG = (_NE, _NW), (_SW, _SE)
+
+# При ходе с/на клетку права на рокировку умножаются на маску
+CASTLE_MASK = [15] * 64
+CASTLE_MASK[0] = 15 ^ CASTLE_WQ
+CASTLE_MASK[7] = 15 ^ CASTLE_WK
+CASTLE_MASK[4] = 15 ^ (CASTLE_WK | CASTLE_WQ)
+CASTLE_MASK[56] = 15 ^ CASTLE_BQ
+CASTLE_MASK[63] = 15 ^ CASTLE_BK
+CASTLE_MASK[60] = 15 ^ (CASTLE_BK | CASTLE_BQ)
+
+
+# Фиксированное зерно: ключи должны совпадать во всех воркерах и между релизами
+_rng = random.Random(0x5EED2024)
+Z_PIECE = [[_rng.getrandbits(64) for _ in range(64)] for _ in range(12)]
+Z_CASTLE = [_rng.getrandbits(64) for _ in range(16)]
+Z_EP = [_rng.getrandbits(64) for _ in range(8)]
+Z_SIDE = _rng.getrandbits(64)
+
+
+def _ep_key(bb, side, ep):
+    if ep >= 0 and PAWN_ATTACKS[side ^ 1][ep] & bb[side * 6 + PAWN]:
+        return Z_EP[ep & 7]
+    return 0
+
+
+def _full_key(bb, side, castling, ep):
+    key = Z_CASTLE[castling] ^ _ep_key(bb, side, ep)
+    if side == BLACK:
+        key ^= Z_SIDE
+    for i in range(12):
+        b = bb[i]
+        while b:
+            lsb = b & -b
+            key ^= Z_PIECE[i][lsb.bit_length() - 1]
+            b ^= lsb
+    return key
+
+
+def signed64(key):
+    """Ключ для колонки BIGINT."""
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def _slide(sq, occ, pos_rays, neg_rays):
+    att = 0
+    for rays in pos_rays:
+        ray = rays[sq]
+        blockers = ray & occ
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        att |= ray
+    for rays in neg_rays:
+        ray = rays[sq]
+        blockers = ray & occ
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        att |= ray
+    return att
+
+
+def rook_attacks(sq, occ):
+    return _slide(sq, occ, ROOK_POS, ROOK_NEG)
+
+
+def bishop_attacks(sq, occ):
+    return _slide(sq, occ, BISHOP_POS, BISHOP_NEG)
+
+
+def encode_move(frm, to, promo=0):
+    return frm | (to << 6) | (promo << 12)
+
+
+def move_name(move):
+    frm, to, promo = move & 63, (move >> 6) & 63, move >> 12
+    text = square_name(frm) + '-' + square_name(to)
+    if promo and promo != QUEEN:
+        text += PIECE_CHARS[promo]
+    return text
+
+
+class Position:
+    __slots__ = ('bb', 'occ', 'side', 'castling', 'ep', 'halfmove', 'fullmove', 'key')
+
+    def __init__(self, bb, occ, side, castling, ep, halfmove, fullmove, key=None):
+        self.bb = bb
+        self.occ = occ
+        self.side = side
+        self.castling = castling
+        self.ep = ep
+        self.halfmove = halfmove
+        self.fullmove = fullmove
+        self.key = _full_key(bb, side, castling, ep) if key is None else key
+
+    # --- FEN ---
+
+    @classmethod
+    def from_fen(cls, fen):
+        parts = fen.split()
+        if len(parts) < 4:
+            raise ValueError('bad fen: %s' % fen)
+        bb = [0] * 12
+        rows = parts[0].split('/')
+        if len(rows) != 8:
+            raise ValueError('bad fen: %s' % fen)
+        for i, row in enumerate(rows):
+            rank = 7 - i
+            f = 0
+            for ch in row:
+                if ch.isdigit():
+                    f += int(ch)
+                    continue
+                piece = PIECE_CHARS.index(ch.lower())
+                color = WHITE if ch.isupper() else BLACK
+                bb[color * 6 + piece] |= 1 << (rank * 8 + f)
+                f += 1
+        occ = [bb[0] | bb[1] | bb[2] | bb[3] | bb[4] | bb[5], bb[6] | bb[7] | bb[8] | bb[9] | bb[10] | bb[11]]
+        castling = 0
+        for ch, bit in (('K', CASTLE_WK), ('Q', CASTLE_WQ), ('k', CASTLE_BK), ('q', CASTLE_BQ)):
+            if ch in parts[2]:
+                castling |= bit
+        ep = _square(parts[3]) if parts[3] != '-' else -1
+        halfmove = int(parts[4]) if len(parts) > 4 else 0
+        fullmove = int(parts[5]) if len(parts) > 5 else 1
+        return cls(bb, occ, WHITE if parts[1] == 'w' else BLACK, castling, ep, halfmove, fullmove)
+
+    def fen(self):
+        rows = []
+        for rank in range(7, -1, -1):
+            row = ''
+            empty = 0
+            for f in range(8):
+                bit = 1 << (rank * 8 + f)
+                ch = ''
+                for i in range(12):
+                    if self.bb[i] & bit:
+                        ch = PIECE_CHARS[i % 6]
+                        if i < 6:
+                            ch = ch.upper()
+                        break
+                if ch:
+                    if empty:
+                        row += str(empty)
+                        empty = 0
+                    row += ch
+                else:
+                    empty += 1
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = ''.join(ch for ch, bit in (('K', CASTLE_WK), ('Q', CASTLE_WQ), ('k', CASTLE_BK), ('q', CASTLE_BQ))
+                           if self.castling & bit) or '-'
+        ep = square_name(self.ep) if self.ep >= 0 else '-'
+        return '%s %s %s %s %d %d' % ('/'.join(rows), 'wb'[self.side], castling, ep, self.halfmove, self.fullmove)
+
+    # --- атаки ---
+
+    def is_attacked(self, sq, by):
+        bb = self.bb
+        o = by * 6
+        if PAWN_ATTACKS[by ^ 1][sq] & bb[o + PAWN]:
+            return True
+        if KNIGHT_ATTACKS[sq] & bb[o + KNIGHT]:
+            return True
+        if KING_ATTACKS[sq] & bb[o + KING]:
+            return True
+        occ = self.occ[0] | self.occ[1]
+        diag = bb[o + BISHOP] | bb[o + QUEEN]
+        if diag and bishop_attacks(sq, occ) & diag:
+            return True
+        line = bb[o + ROOK] | bb[o + QUEEN]
+        if line and rook_attacks(sq, occ) & line:
+            return True
+        return False
+
+    def king_square(self, color):
+        return self.bb[color * 6 + KING].bit_length() - 1
+
+    def in_check(self, color=None):
+        color = self.side if color is None else color
+        return self.is_attacked(self.king_square(color), color ^ 1)
+
+    # --- генерация ходов ---
+
+    def pseudo_moves(self):
+        us, them = self.side, self.side ^ 1
+        bb = self.bb
+        o = us * 6
+        own, enemy = self.occ[us], self.occ[them]
+        occ = own | enemy
+        empty = ~occ & FULL
+        moves = []
+        add = moves.append
+
+        pawns = bb[o + PAWN]
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            cap_l = ((pawns & ~FILE_A) << 7) & FULL
+            cap_r = ((pawns & ~FILE_H) << 9) & FULL
+            push_d, dbl_d, l_d, r_d = 8, 16, 7, 9
+            promo_rank = RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            cap_l = (pawns & ~FILE_A) >> 9
+            cap_r = (pawns & ~FILE_H) >> 7
+            push_d, dbl_d, l_d, r_d = -8, -16, -9, -7
+            promo_rank = RANK_1
+        ep_bit = (1 << self.ep) if self.ep >= 0 else 0
+        for targets, delta in ((single, push_d), (cap_l & (enemy | ep_bit), l_d), (cap_r & (enemy | ep_bit), r_d)):
+            while targets:
+                lsb = targets & -targets
+                to = lsb.bit_length() - 1
+                targets ^= lsb
+                frm = to - delta
+                if lsb & promo_rank:
+                    for promo in (QUEEN, ROOK, BISHOP, KNIGHT):
+                        add(frm | (to << 6) | (promo << 12))
+                else:
+                    add(frm | (to << 6))
+        while double:
+            lsb = double & -double
+            to = lsb.bit_length() - 1
+            double ^= lsb
+            add((to - dbl_d) | (to << 6))
+
+        not_own = ~own & FULL
+        for piece in (KNIGHT, BISHOP, ROOK, QUEEN, KING):
+            pieces = bb[o + piece]
+            while pieces:
+                lsb = pieces & -pieces
+                frm = lsb.bit_length() - 1
+                pieces ^= lsb
+                if piece == KNIGHT:
+                    targets = KNIGHT_ATTACKS[frm]
+                elif piece == BISHOP:
+                    targets = bishop_attacks(frm, occ)
+                elif piece == ROOK:
+                    targets = rook_attacks(frm, occ)
+                elif piece == QUEEN:
+                    targets = bishop_attacks(frm, occ) | rook_attacks(frm, occ)
+                else:
+                    targets = KING_ATTACKS[frm]
+                targets &= not_own
+                while targets:
+                    t = targets & -targets
+                    targets ^= t
+                    add(frm | ((t.bit_length() - 1) << 6))
+
+        if self.castling:
+            if us == WHITE:
+                if self.castling & CASTLE_WK and not occ & 0x60 and not self.is_attacked(4, them) \
+                        and not self.is_attacked(5, them) and not self.is_attacked(6, them):
+                    add(4 | (6 << 6))
+                if self.castling & CASTLE_WQ and not occ & 0x0E and not self.is_attacked(4, them) \
+                        and not self.is_attacked(3, them) and not self.is_attacked(2, them):
+                    add(4 | (2 << 6))
+            else:
+                if self.castling & CASTLE_BK and not occ & (0x60 << 56) and not self.is_attacked(60, them) \
+                        and not self.is_attacked(61, them) and not self.is_attacked(62, them):
+                    add(60 | (62 << 6))
+                if self.castling & CASTLE_BQ and not occ & (0x0E << 56) and not self.is_attacked(60, them) \
+                        and not self.is_attacked(59, them) and not self.is_attacked(58, them):
+                    add(60 | (58 << 6))
+        return moves
+
+    def piece_at(self, sq, color):
+        bit = 1 << sq
+        o = color * 6
+        for piece in range(6):
+            if self.bb[o + piece] & bit:
+                return piece
+        return -1
+
+    def make_move(self, move):
+        """Новая позиция после хода (исходная не меняется). Легальность не проверяется."""
+        frm, to, promo = move & 63, (move >> 6) & 63, move >> 12
+        us, them = self.side, self.side ^ 1
+        bb = self.bb[:]
+        occ = self.occ[:]
+        fb, tb = 1 << frm, 1 << to
+        piece = self.piece_at(frm, us)
+        o, e = us * 6, them * 6
+        key = self.key ^ Z_SIDE ^ _ep_key(bb, us, self.ep)
+
+        captured = self.piece_at(to, them) if occ[them] & tb else -1
+        if captured >= 0:
+            bb[e + captured] ^= tb
+            occ[them] ^= tb
+            key ^= Z_PIECE[e + captured][to]
+        elif piece == PAWN and to == self.ep:
+            cap_sq = to - 8 if us == WHITE else to + 8
+            bb[e + PAWN] ^= 1 << cap_sq
+            occ[them] ^= 1 << cap_sq
+            key ^= Z_PIECE[e + PAWN][cap_sq]
+            captured = PAWN
+
+        bb[o + piece] ^= fb
+        bb[o + (promo or piece)] |= tb
+        occ[us] ^= fb | tb
+        key ^= Z_PIECE[o + piece][frm] ^ Z_PIECE[o + (promo or piece)][to]
+
+        if piece == KING and abs(to - frm) == 2:
+            rook_from, rook_to = (frm + 3, frm + 1) if to > frm else (frm - 4, frm - 1)
+            rb = (1 << rook_from) | (1 << rook_to)
+            bb[o + ROOK] ^= rb
+            occ[us] ^= rb
+            key ^= Z_PIECE[o + ROOK][rook_from] ^ Z_PIECE[o + ROOK][rook_to]
+
+        castling = self.castling & CASTLE_MASK[frm] & CASTLE_MASK[to]
+        ep = (frm + to) >> 1 if piece == PAWN and abs(to - frm) == 16 else -1
+        key ^= Z_CASTLE[self.castling] ^ Z_CASTLE[castling] ^ _ep_key(bb, them, ep)
+        halfmove = 0 if piece == PAWN or captured >= 0 else self.halfmove + 1
+        return Position(bb, occ, them, castling, ep, halfmove, self.fullmove + us, key)
+
+    def is_legal(self, move):
+        after = self.make_move(move)
+        return not after.is_attacked(after.king_square(self.side), after.side), after
+
+    def legal_moves(self):
+        return [m for m in self.pseudo_moves() if self.is_legal(m)[0]]
+
+    def has_legal_move(self):
+        for m in self.pseudo_moves():
+            if self.is_legal(m)[0]:
+                return True
+        return False
+
+    def outcome(self):
+        """'checkmate' | 'stalemate' | None — для стороны, которой ходить."""
+        if self.has_legal_move():
+            return None
+        return 'checkmate' if self.in_check() else 'stalemate'
+
+    def parse_move(self, text):
+        """«e2-e4» / «e2e4» / «e7-e8n» → (код хода, позиция после). IllegalMove, если ход невозможен."""
+        text = text.strip().lower().replace('-', '')
+        if len(text) not in (4, 5):
+            raise IllegalMove('bad move: %s' % text)
+        frm, to = _square(text[:2]), _square(text[2:4])
+        promo = PROMO_CHARS.get(text[4], -1) if len(text) == 5 else QUEEN
+        if promo < 0:
+            raise IllegalMove('bad promotion: %s' % text)
+        for m in self.pseudo_moves():
+            if m & 63 != frm or (m >> 6) & 63 != to:
+                continue
+            if m >> 12 and m >> 12 != promo:
+                continue
+            ok, after = self.is_legal(m)
+            if ok:
+                return m, after
+            break
+        raise IllegalMove('illegal move: %s' % text)
+
+
+def start_position():
+    return Position.from_fen(START_FEN)
+
+
+def replay(moves, position=None):
+    """Позиция после списка ходов в клиентской записи."""
+    pos = position or start_position()
+    for text in moves:
+        pos = pos.parse_move(text)[1]
+    return pos
+
+
+def perft(pos, depth):
+    if depth == 0:
+        return 1
+    nodes = 0
+    for m in pos.pseudo_moves():
+        ok, after = pos.is_legal(m)
+        if ok:
+            nodes += 1 if depth == 1 else perft(after, depth - 1)
+    return nodes
+
+
+if __name__ == '__main__':
+    import time
+
+    KIWIPETE = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'
+    cases = [(START_FEN, 1, 20), (START_FEN, 2, 400), (START_FEN, 3, 8902), (START_FEN, 4, 197281),
+             (KIWIPETE, 1, 48), (KIWIPETE, 2, 2039), (KIWIPETE, 3, 97862)]
+    for fen, depth, expected in cases:
+        started = time.perf_counter()
+        nodes = perft(Position.from_fen(fen), depth)
+        elapsed = time.perf_counter() - started
+        print('perft %-7s d=%d nodes=%-7d %s  %.0f nodes/s' % (
+            'start' if fen == START_FEN else 'kiwipete', depth, nodes,
+            'ok' if nodes == expected else 'FAIL (%d)' % expected, nodes / elapsed if elapsed else 0))
+
+    # Проверка одного хода так, как её делает online-move: разбор, ход, итог партии
+    game = ['e2-e4', 'e7-e5', 'g1-f3', 'b8-c6', 'f1-b5', 'a7-a6', 'b5-a4', 'g8-f6', 'e1-g1', 'f8-e7']
+    positions = []
+    pos = start_position()
+    for text in game:
+        positions.append((pos, text))
+        pos = pos.parse_move(text)[1]
+    rounds = 2000
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for pos, text in positions:
+            pos.parse_move(text)[1].outcome()
+    per_move = (time.perf_counter() - started) / (rounds * len(positions)) * 1e6
+    print('validate move + outcome: %.1f us' % per_move)
@@ -1,7 +1,432 @@
 import json
 import os
+import select
 import psycopg2
 import time as time_module
+import uuid
+
+import chess_core
+import rating_engine
+
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    from pg_notify import watch as hub_watch
+except ImportError:
+    hub_watch = None
+
+try:
+    import game_cache
+except ImportError:
+    game_cache = None
+
+try:
+    import signal_mailbox
+except ImportError:
+    signal_mailbox = None
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
+GAME_EVENTS_CHANNEL = 'online_game_events'
+LONG_POLL_MAX_TIMEOUT = 25
+SINCE_MOVE_MAX_DELTA = 40
+START_KEY = chess_core.start_position().key
+MAX_LAG_COMPENSATION_MS = 300
+SIGNAL_EVENTS_CHANNEL = 'game_signal_events'
+SIGNAL_TTL_SECONDS = 60
+SIGNAL_BATCH = 20
+MAX_NOTIFY_PAYLOAD = 7900
+
+
+class ListenWatch:
+    """Ожидание NOTIFY на собственном соединении — когда функция работает без шлюза."""
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self.conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        self.conn.autocommit = True
+        cur = self.conn.cursor()
+        cur.execute('LISTEN %s' % GAME_EVENTS_CHANNEL)
+        cur.close()
+
+    def wait(self, timeout):
+        deadline = time_module.monotonic() + timeout
+        while True:
+            remaining = deadline - time_module.monotonic()
+            if remaining <= 0:
+                return False
+            if select.select([self.conn], [], [], remaining) == ([], [], []):
+                return False
+            self.conn.poll()
+            while self.conn.notifies:
+                n = self.conn.notifies.pop(0)
+                try:
+                    if json.loads(n.payload).get('game_id') == self.game_id:
+                        return True
+                except ValueError:
+                    pass
+
+    def close(self):
+        self.conn.close()
+
+
+def open_game_watch(game_id):
+    watch = hub_watch(GAME_EVENTS_CHANNEL, game_id) if hub_watch else None
+    return watch or ListenWatch(game_id)
+
+
+def notify_game(cur, game_id, event, move_number=None, **extra):
+    """Уведомление уходит слушателям при commit текущей транзакции."""
+    payload = dict(extra, game_id=game_id, event=event)
+    if move_number is not None:
+        payload['move_number'] = move_number
+    cur.execute("SELECT pg_notify('%s', '%s')" % (GAME_EVENTS_CHANNEL, json.dumps(payload).replace("'", "''")))
+
+
+def notify_signal(cur, game_id, op, **payload):
+    payload = dict(payload, game_id=game_id, op=op)
+    cur.execute("SELECT pg_notify('%s', '%s')" % (SIGNAL_EVENTS_CHANNEL, json.dumps(payload).replace("'", "''")))
+
+
+def send_signal(cur, game_id, from_user, to_user, signal_type, signal_data):
+    """Со шлюзом сигнал целиком уходит в NOTIFY и хранится в ящиках воркеров;
+    в webrtc_signals пишутся слишком большие для NOTIFY сигналы, сигналы без шлюза
+    и пока ящик воркера не готов (нет подписки на NOTIFY)."""
+    sid = uuid.uuid4().hex[:12]
+    if signal_mailbox is not None and signal_mailbox.is_ready():
+        payload = {'id': sid, 'to': to_user, 'from': from_user, 'type': signal_type, 'data': signal_data}
+        if len(json.dumps(dict(payload, game_id=game_id, op='put'))) <= MAX_NOTIFY_PAYLOAD:
+            notify_signal(cur, game_id, 'put', **payload)
+            return
+    cur.execute(
+        "INSERT INTO webrtc_signals (game_id, from_user_id, to_user_id, signal_type, signal_data) VALUES (%d, '%s', '%s', '%s', '%s') RETURNING id"
+        % (game_id, from_user.replace("'", "''"), to_user.replace("'", "''"),
+           signal_type.replace("'", "''"), signal_data.replace("'", "''"))
+    )
+    ref = cur.fetchone()[0]
+    if signal_mailbox is not None:
+        notify_signal(cur, game_id, 'put', id=sid, to=to_user, ref=ref)
+    # Заодно убираем протухшие строки партии
+    cur.execute(
+        "DELETE FROM webrtc_signals WHERE game_id = %d AND created_at < NOW() - INTERVAL '%d seconds'"
+        % (game_id, SIGNAL_TTL_SECONDS)
+    )
+
+
+def has_pending_signals(cur, game_id, user_id):
+    if signal_mailbox is not None and signal_mailbox.is_ready():
+        return signal_mailbox.has_pending(game_id, user_id)
+    cur.execute(
+        "SELECT 1 FROM webrtc_signals WHERE game_id = %d AND to_user_id = '%s' AND created_at > NOW() - INTERVAL '%d seconds' LIMIT 1"
+        % (game_id, user_id.replace("'", "''"), SIGNAL_TTL_SECONDS)
+    )
+    return cur.fetchone() is not None
+
+
+def take_signals(cur, conn, game_id, user_id):
+    """Забирает сигналы получателя: из ящика воркера или, без шлюза, одним
+    DELETE ... RETURNING из webrtc_signals."""
+    delete_sql = "DELETE FROM webrtc_signals WHERE id IN (%s) RETURNING id, from_user_id, signal_type, signal_data"
+    if signal_mailbox is not None and signal_mailbox.is_ready():
+        drained = signal_mailbox.drain(game_id, user_id, SIGNAL_BATCH)
+        if not drained:
+            return []
+        refs = [str(s['ref']) for _, s in drained if 'ref' in s]
+        stored = {}
+        if refs:
+            cur.execute(delete_sql % ','.join(refs))
+            stored = {r[0]: {'from': r[1], 'type': r[2], 'data': r[3]} for r in cur.fetchall()}
+        signals = []
+        for sid, s in drained:
+            if 'ref' in s:
+                s = stored.get(s['ref'])
+                if s is None:
+                    continue
+            signals.append(dict(s, id=sid))
+        notify_signal(cur, game_id, 'drained', to=user_id, ids=[sid for sid, _ in drained])
+        conn.commit()
+        return signals
+    cur.execute(
+        delete_sql % (
+            "SELECT id FROM webrtc_signals WHERE game_id = %d AND to_user_id = '%s' AND created_at > NOW() - INTERVAL '%d seconds' ORDER BY id LIMIT %d FOR UPDATE SKIP LOCKED"
+            % (game_id, user_id.replace("'", "''"), SIGNAL_TTL_SECONDS, SIGNAL_BATCH))
+    )
+    rows = sorted(cur.fetchall())
+    conn.commit()
+    return [{'id': str(r[0]), 'from': r[1], 'type': r[2], 'data': r[3]} for r in rows]
+
+
+def history_sql(game_id):
+    """move_history партии: в online_games он записывается только при завершении,
+    до этого собирается из журнала online_game_moves."""
+    return (
+        "CASE WHEN move_history <> '' THEN move_history ELSE "
+        "(SELECT COALESCE(string_agg(move, ',' ORDER BY ply), '') FROM online_game_moves WHERE game_id = %d) END"
+        % game_id
+    )
+
+
+def load_position(cur, game_id, board_state, move_number):
+    """Позиция партии: из FEN в board_state, для старых партий и битого FEN — по журналу
+    ходов. None, если журнал неполон (не move_number ходов) или не проигрывается."""
+    if board_state and '/' in board_state:
+        try:
+            return chess_core.Position.from_fen(board_state)
+        except (chess_core.IllegalMove, ValueError):
+            pass
+    cur.execute("SELECT move FROM online_game_moves WHERE game_id = %d ORDER BY ply" % game_id)
+    moves = [r[0] for r in cur.fetchall()]
+    if len(moves) != move_number:
+        return None
+    try:
+        return chess_core.replay(moves)
+    except (chess_core.IllegalMove, ValueError):
+        return None
+
+
+def repetition_count(cur, game_id, ply, position):
+    """Сколько раз позиция после хода ply встречалась с последнего необратимого хода
+    (взятие или ход пешкой), включая текущий раз. Поиск — по индексу (game_id, position_hash)."""
+    first_ply = ply - position.halfmove
+    cur.execute(
+        "SELECT COUNT(*) FROM online_game_moves WHERE game_id = %d AND position_hash = %d AND ply >= %d"
+        % (game_id, chess_core.signed64(position.key), first_ply)
+    )
+    count = cur.fetchone()[0] + 1
+    if first_ply <= 0 and position.key == START_KEY:
+        count += 1
+    return count
+
+
+def settle_game(cur, game_id):
+    """Рейтинг обоих игроков и их строки game_history — в текущей транзакции,
+    одним UPDATE users ... FROM (VALUES ...) и одним INSERT на две строки.
+    Партия с ботом и уже учтённая партия пропускаются: результат пишется в
+    online_games (*_rating_change), повторный вызов ничего не меняет.
+    Возвращает {user_id: {rating_before, rating_after, rating_change}} или None."""
+    cur.execute(
+        """SELECT white_user_id, white_username, white_avatar, white_rating,
+                  black_user_id, black_username, black_avatar, black_rating,
+                  winner, end_reason, time_control, opponent_type, move_number,
+                  %s, EXTRACT(EPOCH FROM (NOW() - created_at))::int
+        FROM online_games
+        WHERE id = %d AND status = 'finished' AND is_bot_game = FALSE
+          AND white_rating_change IS NULL AND COALESCE(end_reason, '') <> 'abandoned'
+        FOR UPDATE""" % (history_sql(game_id), game_id)
+    )
+    game = cur.fetchone()
+    if not game or game[0] == game[4]:
+        return None
+    w_uid, w_name, w_avatar, w_start, b_uid, b_name, b_avatar, b_start = game[:8]
+    winner, end_reason, tc, opponent_type, move_number, move_history, duration = game[8:]
+
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    engine = rating_engine.get_engine(settings)
+    initial_rating = int(settings.get('initial_rating', '1200'))
+    min_rating = int(settings.get('min_rating', '500'))
+    decay = abs(int(settings.get('daily_decay', '1')))
+    today = time_module.strftime('%Y-%m-%d', time_module.gmtime(time_module.time() + 3 * 3600))
+
+    def esc(val):
+        return str(val or '').replace("'", "''")
+
+    cur.execute(
+        "INSERT INTO users (id, username, avatar, rating, games_played, wins, losses, draws) VALUES ('%s', '%s', '%s', %d, 0, 0, 0, 0), ('%s', '%s', '%s', %d, 0, 0, 0, 0) ON CONFLICT (id) DO NOTHING"
+        % (esc(w_uid), esc(w_name), esc(w_avatar), initial_rating, esc(b_uid), esc(b_name), esc(b_avatar), initial_rating)
+    )
+    # Блокировки строк в порядке id — встречный settle не даст взаимоблокировку.
+    # Рейтинг читается вместе с накопленным ежедневным снижением (decay_anchor_date)
+    cur.execute(
+        "SELECT id, CASE WHEN rating > %d THEN GREATEST(rating - %d * GREATEST(DATE '%s' - decay_anchor_date, 0), %d) ELSE rating END, "
+        "games_played, rating_deviation, rating_volatility FROM users WHERE id IN ('%s', '%s') ORDER BY id FOR UPDATE"
+        % (min_rating, decay, today, min_rating, esc(w_uid), esc(b_uid))
+    )
+    players = {r[0]: r[1:] for r in cur.fetchall()}
+
+    sides = []
+    for uid, color, opp_uid, opp_name in ((w_uid, 'white', b_uid, b_name), (b_uid, 'black', w_uid, w_name)):
+        result = 'draw' if not winner else ('win' if winner == uid else 'loss')
+        before, games_played, rd, volatility = players.get(uid, (initial_rating, 0, None, None))
+        opp_rating, _, opp_rd, _ = players.get(opp_uid, (initial_rating, 0, None, None))
+        rated = engine.rate(rating_engine.PlayerRating(before, games_played, rd, volatility),
+                            result, opp_rating, opp_rd)
+        after, rd, volatility = rated.rating, rated.rd, rated.volatility
+        after = max(after, min_rating)
+        sides.append({'user_id': uid, 'color': color, 'result': result, 'opponent_name': opp_name,
+                      'opponent_rating': opp_rating, 'rd': rd, 'volatility': volatility,
+                      'rating_before': before, 'rating_after': after, 'rating_change': after - before})
+
+    cur.execute(
+        """UPDATE users u SET
+            rating = v.rating_after,
+            games_played = u.games_played + 1,
+            wins = u.wins + v.win,
+            losses = u.losses + v.loss,
+            draws = u.draws + v.draw,
+            rating_deviation = v.rd,
+            rating_volatility = v.volatility,
+            decay_anchor_date = DATE '%s',
+            updated_at = NOW()
+        FROM (VALUES %s) AS v(id, rating_after, win, loss, draw, rd, volatility)
+        WHERE u.id = v.id"""
+        % (today, ', '.join("('%s', %d, %d, %d, %d, %s::real, %s::real)" % (
+            esc(s['user_id']), s['rating_after'], s['result'] == 'win', s['result'] == 'loss', s['result'] == 'draw',
+            'NULL' if s['rd'] is None else '%.4f' % s['rd'],
+            'NULL' if s['volatility'] is None else '%.6f' % s['volatility']) for s in sides))
+    )
+    cur.execute(
+        """INSERT INTO game_history
+        (user_id, opponent_name, opponent_type, opponent_rating, result, user_color, time_control, moves_count, move_history, rating_before, rating_after, rating_change, duration_seconds, end_reason)
+        VALUES %s"""
+        % ', '.join("('%s', '%s', '%s', %d, '%s', '%s', '%s', %d, '%s', %d, %d, %d, %d, '%s')" % (
+            esc(s['user_id']), esc(s['opponent_name']), esc(opponent_type), s['opponent_rating'], s['result'],
+            s['color'], esc(tc), move_number or 0, esc(move_history), s['rating_before'], s['rating_after'],
+            s['rating_change'], duration or 0, esc(end_reason or 'checkmate')) for s in sides)
+    )
+    white, black = sides
+    cur.execute(
+        "UPDATE online_games SET white_rating_after = %d, white_rating_change = %d, black_rating_after = %d, black_rating_change = %d WHERE id = %d"
+        % (white['rating_after'], white['rating_change'], black['rating_after'], black['rating_change'], game_id)
+    )
+    return {s['user_id']: {k: s[k] for k in ('rating_before', 'rating_after', 'rating_change')} for s in sides}
+
+
+def settled_fields(ratings, white_uid, black_uid):
+    """Поля состояния партии после settle_game — для ответа и кэша."""
+    if not ratings:
+        return {}
+    return {
+        'white_rating_after': ratings[white_uid]['rating_after'], 'white_rating_change': ratings[white_uid]['rating_change'],
+        'black_rating_after': ratings[black_uid]['rating_after'], 'black_rating_change': ratings[black_uid]['rating_change'],
+    }
+
+
+def finish_on_time(cur, game_id, winner, move_number):
+    cur.execute(
+        "UPDATE online_games SET status = 'finished', winner = '%s', end_reason = 'timeout', move_history = %s, updated_at = NOW() WHERE id = %d AND status = 'playing'"
+        % (winner.replace("'", "''"), history_sql(game_id), game_id)
+    )
+    ratings = settle_game(cur, game_id) if cur.rowcount else None
+    notify_game(cur, game_id, 'timeout', move_number)
+    return ratings
+
+
+def load_game_state(cur, game_id):
+    """Состояние партии для GET: часы — остаток на момент последнего хода плюс
+    монотонная отметка этого хода, ходы — списком. Такой снимок можно держать в
+    кэше воркера и отдавать много раз, пересчитывая только часы."""
+    cur.execute(
+        """SELECT id, white_user_id, white_username, white_avatar, white_rating,
+                  black_user_id, black_username, black_avatar, black_rating,
+                  time_control, status, is_bot_game, current_player,
+                  move_history, board_state, winner, end_reason, move_number,
+                  rematch_offered_by, rematch_status, rematch_game_id,
+                  COALESCE(white_clock_ms, white_time * 1000), COALESCE(black_clock_ms, black_time * 1000),
+                  (EXTRACT(EPOCH FROM (NOW() - last_move_at)) * 1000)::bigint,
+                  white_rating_after, white_rating_change, black_rating_after, black_rating_change
+        FROM online_games WHERE id = %d""" % game_id
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    if row[13]:
+        moves = row[13].split(',')
+    else:
+        cur.execute("SELECT move FROM online_game_moves WHERE game_id = %d ORDER BY ply" % game_id)
+        moves = [r[0] for r in cur.fetchall()]
+
+    # В партиях с ботом ходы бота на сервер не приходят, board_state так и остаётся
+    # начальной позицией — такую позицию не отдаём
+    board_state = row[14] if not row[11] else None
+    if '/' not in (board_state or '') and not row[11]:
+        try:
+            board_state = chess_core.replay(moves).fen()
+        except (chess_core.IllegalMove, ValueError):
+            pass
+    position_hash = None
+    if '/' in (board_state or ''):
+        position_hash = '%016x' % chess_core.Position.from_fen(board_state).key
+
+    return {
+        'id': row[0],
+        'white_user_id': row[1], 'white_username': row[2], 'white_avatar': row[3], 'white_rating': row[4],
+        'black_user_id': row[5], 'black_username': row[6], 'black_avatar': row[7], 'black_rating': row[8],
+        'time_control': row[9], 'status': row[10], 'is_bot_game': row[11], 'current_player': row[12],
+        'moves': moves, 'board_state': board_state, 'position_hash': position_hash,
+        'winner': row[15], 'end_reason': row[16], 'move_number': row[17] or 0,
+        'rematch_offered_by': row[18], 'rematch_status': row[19], 'rematch_game_id': row[20],
+        'white_clock_ms': row[21], 'black_clock_ms': row[22],
+        'last_move_mono': time_module.monotonic() - max(0, row[23] or 0) / 1000.0,
+        'white_rating_after': row[24], 'white_rating_change': row[25],
+        'black_rating_after': row[26], 'black_rating_change': row[27],
+    }
+
+
+def render_game(state, since):
+    """game для ответа GET: часы стороны, чей ход, идут с момента последнего хода.
+    since_move=N: только ходы после N; полный снимок — если клиент отстал
+    слишком сильно, знает больше сервера или партия уже завершена."""
+    ms_since_move = max(0, int((time_module.monotonic() - state['last_move_mono']) * 1000))
+    status = state['status']
+    white_time_ms = state['white_clock_ms']
+    black_time_ms = state['black_clock_ms']
+    if status == 'playing':
+        if state['current_player'] == 'white':
+            white_time_ms = max(0, white_time_ms - ms_since_move)
+        else:
+            black_time_ms = max(0, black_time_ms - ms_since_move)
+
+    move_number = state['move_number']
+    game_data = {
+        'id': state['id'],
+        'white_user_id': state['white_user_id'], 'white_username': state['white_username'],
+        'white_avatar': state['white_avatar'], 'white_rating': state['white_rating'],
+        'black_user_id': state['black_user_id'], 'black_username': state['black_username'],
+        'black_avatar': state['black_avatar'], 'black_rating': state['black_rating'],
+        'time_control': state['time_control'], 'status': status, 'is_bot_game': state['is_bot_game'],
+        'current_player': state['current_player'],
+        'white_time': white_time_ms // 1000, 'black_time': black_time_ms // 1000,
+        'white_time_ms': white_time_ms, 'black_time_ms': black_time_ms,
+        'winner': state['winner'], 'end_reason': state['end_reason'],
+        'move_number': move_number,
+        'seconds_since_move': ms_since_move // 1000,
+        'rematch_offered_by': state['rematch_offered_by'], 'rematch_status': state['rematch_status'],
+        'rematch_game_id': state['rematch_game_id'],
+        'white_rating_after': state['white_rating_after'], 'white_rating_change': state['white_rating_change'],
+        'black_rating_after': state['black_rating_after'], 'black_rating_change': state['black_rating_change']
+    }
+    if status == 'playing' and 0 <= since <= move_number and move_number - since <= SINCE_MOVE_MAX_DELTA:
+        game_data['since_move'] = since
+        game_data['moves'] = state['moves'][since:]
+    else:
+        game_data['move_history'] = ','.join(state['moves'])
+        game_data['board_state'] = state['board_state']
+    if state['position_hash']:
+        # Контрольная сумма позиции: клиент сверяет её со своей, чтобы заметить рассинхрон
+        game_data['position_hash'] = state['position_hash']
+    return game_data
+
+
+def game_etag(game_id, move_number, status, rematch_status):
+    return '"%d-%d-%s-%s"' % (game_id, move_number or 0, status or '', rematch_status or '')
+
+
+def get_if_none_match(event):
+    hdrs = event.get('headers') or {}
+    return hdrs.get('If-None-Match', hdrs.get('if-none-match', ''))
 
 
 def get_client_ip(event):
@@ -46,11 +471,11 @@ def check_rate_limit(cur, conn, ip, endpoint, max_requests, window_seconds):
 def handler(event: dict, context) -> dict:
     """Ходы и состояние онлайн-партии: отправка хода, получение состояния, завершение игры"""
     if event.get('httpMethod') == 'OPTIONS':
-        return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
+        return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id, If-None-Match', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
-    headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
+    headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json', 'Access-Control-Expose-Headers': 'ETag'}
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -68,69 +493,84 @@ def handler(event: dict, context) -> dict:
             conn.close()
             return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'game_id required'})}
 
-        cur.execute(
-            """SELECT id, white_user_id, white_username, white_avatar, white_rating,
-                      black_user_id, black_username, black_avatar, black_rating,
-                      time_control, status, is_bot_game, current_player,
-                      white_time, black_time, move_history, board_state,
-                      winner, end_reason,
-                      EXTRACT(EPOCH FROM (NOW() - last_move_at))::int as seconds_since_move,
-                      move_number,
-                      rematch_offered_by, rematch_status, rematch_game_id
-            FROM online_games WHERE id = %d""" % int(game_id)
-        )
-        row = cur.fetchone()
-
-        if not row:
-            cur.close()
-            conn.close()
-            return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'game not found'})}
-
-        seconds_since_move = row[19] or 0
-        status = row[10]
-        current_player = row[12]
-        white_time = row[13]
-        black_time = row[14]
-        move_number = row[20] or 0
+        req_user_id = qs.get('user_id', '')
 
-        if status == 'playing' and seconds_since_move > 0:
-            if current_player == 'white':
-                white_time = max(0, white_time - seconds_since_move)
+        # Long-poll: держим запрос, пока move_number не станет больше N,
+        # не придёт сигнал или любое другое событие партии, либо не истечёт timeout
+        # Нечисловой wait_for_move_number — обычный GET, нечисловой timeout — по умолчанию
+        try:
+            wait_for = int(qs.get('wait_for_move_number', ''))
+        except (TypeError, ValueError):
+            wait_for = None
+        if wait_for is not None:
+            try:
+                timeout = float(qs.get('timeout', LONG_POLL_MAX_TIMEOUT))
+            except (TypeError, ValueError):
+                timeout = LONG_POLL_MAX_TIMEOUT
+            if timeout != timeout:
+                timeout = LONG_POLL_MAX_TIMEOUT
+            timeout = min(max(timeout, 0), LONG_POLL_MAX_TIMEOUT)
+            watch = open_game_watch(int(game_id))
+            try:
+                cached = game_cache.get(int(game_id)) if game_cache else None
+                if cached is not None:
+                    head = (cached['move_number'],)
+                else:
+                    cur.execute("SELECT move_number FROM online_games WHERE id = %d" % int(game_id))
+                    head = cur.fetchone()
+                has_signals = bool(head and req_user_id) and has_pending_signals(cur, int(game_id), req_user_id)
+                if head and (head[0] or 0) <= wait_for and not has_signals and timeout > 0:
+                    # Соединение возвращаем в пул на время ожидания
+                    conn.rollback()
+                    cur.close()
+                    conn.close()
+                    watch.wait(timeout)
+                    conn = get_connection()
+                    cur = conn.cursor()
+            finally:
+                watch.close()
+
+        # Состояние берётся из кэша воркера шлюза; в БД — только при промахе
+        state = game_cache.get(int(game_id)) if game_cache else None
+
+        # If-None-Match: без кэша — узкий запрос по PK, широкую строку не читаем
+        if_none_match = get_if_none_match(event)
+        if if_none_match:
+            if state is not None:
+                head = (state['move_number'], state['status'], state['rematch_status'])
             else:
-                black_time = max(0, black_time - seconds_since_move)
-
-        signals = []
-        req_user_id = qs.get('user_id', '')
-        if req_user_id:
-            safe_uid = req_user_id.replace("'", "''")
-            cur.execute(
-                "SELECT id, from_user_id, signal_type, signal_data FROM webrtc_signals WHERE game_id = %d AND to_user_id = '%s' AND consumed = FALSE ORDER BY id ASC LIMIT 20"
-                % (int(game_id), safe_uid)
-            )
-            sig_rows = cur.fetchall()
-            if sig_rows:
-                sig_ids = ','.join(str(r[0]) for r in sig_rows)
-                cur.execute("UPDATE webrtc_signals SET consumed = TRUE WHERE id IN (%s)" % sig_ids)
-                conn.commit()
-                signals = [{'from': r[1], 'type': r[2], 'data': r[3]} for r in sig_rows]
+                cur.execute(
+                    "SELECT move_number, status, rematch_status FROM online_games WHERE id = %d" % int(game_id)
+                )
+                head = cur.fetchone()
+            if head and game_etag(int(game_id), *head) == if_none_match:
+                if not (req_user_id and has_pending_signals(cur, int(game_id), req_user_id)):
+                    cur.close()
+                    conn.close()
+                    return {'statusCode': 304, 'headers': dict(headers, ETag=if_none_match), 'body': ''}
+
+        if state is None:
+            token = game_cache.load_token(int(game_id)) if game_cache else None
+            state = load_game_state(cur, int(game_id))
+            if state is None:
+                cur.close()
+                conn.close()
+                return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'game not found'})}
+            if game_cache:
+                game_cache.put(state, token)
+
+        signals = take_signals(cur, conn, int(game_id), req_user_id) if req_user_id else []
 
         cur.close()
         conn.close()
 
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
-            'game': {
-                'id': row[0],
-                'white_user_id': row[1], 'white_username': row[2], 'white_avatar': row[3], 'white_rating': row[4],
-                'black_user_id': row[5], 'black_username': row[6], 'black_avatar': row[7], 'black_rating': row[8],
-                'time_control': row[9], 'status': status, 'is_bot_game': row[11],
-                'current_player': current_player,
-                'white_time': white_time, 'black_time': black_time,
-                'move_history': row[15], 'board_state': row[16],
-                'winner': row[17], 'end_reason': row[18],
-                'move_number': move_number,
-                'seconds_since_move': seconds_since_move,
-                'rematch_offered_by': row[21], 'rematch_status': row[22], 'rematch_game_id': row[23]
-            },
+        since_move = qs.get('since_move', '')
+        since = int(since_move) if since_move.lstrip('-').isdigit() else -1
+        game_data = render_game(state, since)
+
+        etag = game_etag(state['id'], state['move_number'], state['status'], state['rematch_status'])
+        return {'statusCode': 200, 'headers': dict(headers, ETag=etag), 'body': json.dumps({
+            'game': game_data,
             'signals': signals
         })}
 
@@ -151,9 +591,10 @@ def handler(event: dict, context) -> dict:
 
     cur.execute(
         """SELECT id, white_user_id, black_user_id, current_player, status,
-                  white_time, black_time, move_history, is_bot_game, time_control,
-                  EXTRACT(EPOCH FROM (NOW() - last_move_at))::int as seconds_since_move,
-                  move_number
+                  white_time, black_time, is_bot_game, time_control,
+                  (EXTRACT(EPOCH FROM (NOW() - last_move_at)) * 1000)::bigint as ms_since_move,
+                  move_number, board_state,
+                  COALESCE(white_clock_ms, white_time * 1000), COALESCE(black_clock_ms, black_time * 1000)
         FROM online_games WHERE id = %d""" % int(game_id)
     )
     game = cur.fetchone()
@@ -163,7 +604,8 @@ def handler(event: dict, context) -> dict:
         conn.close()
         return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'game not found'})}
 
-    g_id, white_uid, black_uid, current_player, status, white_time, black_time, move_hist, is_bot, tc, secs_since, db_move_number = game
+    g_id, white_uid, black_uid, current_player, status, white_time, black_time, is_bot, tc, ms_since, db_move_number, db_board_state, white_ms, black_ms = game
+    ms_since = max(0, ms_since or 0)
     db_move_number = db_move_number or 0
 
     if user_id != white_uid and user_id != black_uid:
@@ -184,10 +626,8 @@ def handler(event: dict, context) -> dict:
             conn.close()
             return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'signal_type and signal_data required'})}
         to_user = black_uid if user_id == white_uid else white_uid
-        cur.execute(
-            "INSERT INTO webrtc_signals (game_id, from_user_id, to_user_id, signal_type, signal_data) VALUES (%d, '%s', '%s', '%s', '%s')"
-            % (g_id, esc(user_id), esc(to_user), esc(signal_type), esc(signal_data))
-        )
+        send_signal(cur, g_id, user_id, to_user, str(signal_type), str(signal_data))
+        notify_game(cur, g_id, 'signal', to=to_user)
         conn.commit()
         cur.close()
         conn.close()
@@ -198,9 +638,13 @@ def handler(event: dict, context) -> dict:
             "UPDATE online_games SET rematch_offered_by = '%s', rematch_status = 'pending', rematch_offered_at = NOW(), updated_at = NOW() WHERE id = %d"
             % (esc(user_id), g_id)
         )
+        notify_game(cur, g_id, 'rematch_offer')
         conn.commit()
         cur.close()
         conn.close()
+        if game_cache:
+            game_cache.write_through(g_id, db_move_number, 'rematch_offer',
+                                     rematch_offered_by=user_id, rematch_status='pending')
         return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'rematch_offered'})}
 
     if action in ('rematch_decline', 'rematch_expired'):
@@ -208,9 +652,12 @@ def handler(event: dict, context) -> dict:
         cur.execute(
             "UPDATE online_games SET rematch_status = '%s', updated_at = NOW() WHERE id = %d" % (new_rs, g_id)
         )
+        notify_game(cur, g_id, action)
         conn.commit()
         cur.close()
         conn.close()
+        if game_cache:
+            game_cache.write_through(g_id, db_move_number, action, rematch_status=new_rs)
         return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'rematch_' + new_rs})}
 
     if action == 'rematch_accept':
@@ -240,11 +687,11 @@ def handler(event: dict, context) -> dict:
         cur.execute(
             """INSERT INTO online_games (white_user_id, white_username, white_avatar, white_rating,
                 black_user_id, black_username, black_avatar, black_rating,
-                time_control, opponent_type, is_bot_game, white_time, black_time)
-            VALUES ('%s', '%s', '%s', %d, '%s', '%s', '%s', %d, '%s', '%s', FALSE, %d, %d) RETURNING id"""
+                time_control, opponent_type, is_bot_game, white_time, black_time, rematch_of)
+            VALUES ('%s', '%s', '%s', %d, '%s', '%s', '%s', %d, '%s', '%s', FALSE, %d, %d, %d) RETURNING id"""
             % (esc(ob_uid), esc(ob_name), esc(ob_avatar), ob_rating,
                esc(ow_uid), esc(ow_name), esc(ow_avatar), ow_rating,
-               esc(otc), esc(oop), init_time, init_time)
+               esc(otc), esc(oop), init_time, init_time, g_id)
         )
         new_game_id = cur.fetchone()[0]
 
@@ -252,9 +699,13 @@ def handler(event: dict, context) -> dict:
             "UPDATE online_games SET rematch_status = 'accepted', rematch_game_id = %d, updated_at = NOW() WHERE id = %d"
             % (new_game_id, g_id)
         )
+        notify_game(cur, g_id, 'rematch_accept', rematch_game_id=new_game_id)
         conn.commit()
         cur.close()
         conn.close()
+        if game_cache:
+            game_cache.write_through(g_id, db_move_number, 'rematch_accept',
+                                     rematch_status='accepted', rematch_game_id=new_game_id)
         return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
             'status': 'rematch_accepted',
             'new_game_id': new_game_id,
@@ -262,37 +713,66 @@ def handler(event: dict, context) -> dict:
             'old_black': ob_uid
         })}
 
+    if action in ('resign', 'draw') and status != 'playing':
+        cur.close()
+        conn.close()
+        return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'game is not active'})}
+
     if action == 'resign':
         winner = black_uid if player_color == 'white' else white_uid
         cur.execute(
-            "UPDATE online_games SET status = 'finished', winner = '%s', end_reason = 'resign', updated_at = NOW() WHERE id = %d"
-            % (winner.replace("'", "''"), g_id)
+            "UPDATE online_games SET status = 'finished', winner = '%s', end_reason = 'resign', move_history = %s, updated_at = NOW() WHERE id = %d AND status = 'playing'"
+            % (winner.replace("'", "''"), history_sql(g_id), g_id)
         )
+        ratings = settle_game(cur, g_id) if cur.rowcount else None
+        notify_game(cur, g_id, 'resign', db_move_number)
         conn.commit()
         cur.close()
         conn.close()
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'winner': winner, 'end_reason': 'resign'})}
+        if game_cache:
+            game_cache.write_through(g_id, db_move_number, 'resign', db_move_number,
+                                     status='finished', winner=winner, end_reason='resign',
+                                     **settled_fields(ratings, white_uid, black_uid))
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'winner': winner, 'end_reason': 'resign', 'ratings': ratings})}
 
     if action == 'draw':
         cur.execute(
-            "UPDATE online_games SET status = 'finished', end_reason = 'draw', updated_at = NOW() WHERE id = %d" % g_id
+            "UPDATE online_games SET status = 'finished', end_reason = 'draw', move_history = %s, updated_at = NOW() WHERE id = %d AND status = 'playing'"
+            % (history_sql(g_id), g_id)
         )
+        ratings = settle_game(cur, g_id) if cur.rowcount else None
+        notify_game(cur, g_id, 'draw', db_move_number)
         conn.commit()
         cur.close()
         conn.close()
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'end_reason': 'draw'})}
+        if game_cache:
+            game_cache.write_through(g_id, db_move_number, 'draw', db_move_number,
+                                     status='finished', end_reason='draw',
+                                     **settled_fields(ratings, white_uid, black_uid))
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'end_reason': 'draw', 'ratings': ratings})}
 
     if action == 'timeout':
-        loser_color = body.get('loser_color', '')
-        winner = white_uid if loser_color == 'black' else black_uid
-        cur.execute(
-            "UPDATE online_games SET status = 'finished', winner = '%s', end_reason = 'timeout', updated_at = NOW() WHERE id = %d"
-            % (winner.replace("'", "''"), g_id)
-        )
+        # Проигрыш по времени решает сервер: проигрывает сторона, чей ход, и только
+        # если её часы истекли. Брошенные партии завершает game_sweeper
+        # (GAME_ABANDON_MINUTES). loser_color клиента больше не учитывается.
+        if status != 'playing':
+            cur.close()
+            conn.close()
+            return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'game is not active'})}
+        remaining_ms = (white_ms if current_player == 'white' else black_ms) - ms_since
+        if remaining_ms > 0:
+            cur.close()
+            conn.close()
+            return {'statusCode': 409, 'headers': headers, 'body': json.dumps({
+                'error': 'clock not expired', 'current_player': current_player, 'remaining_ms': remaining_ms})}
+        winner = black_uid if current_player == 'white' else white_uid
+        ratings = finish_on_time(cur, g_id, winner, db_move_number)
         conn.commit()
         cur.close()
         conn.close()
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'winner': winner, 'end_reason': 'timeout'})}
+        if game_cache:
+            game_cache.invalidate(g_id)
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'winner': winner, 'end_reason': 'timeout', 'ratings': ratings})}
 
     if status != 'playing':
         cur.close()
@@ -305,7 +785,6 @@ def handler(event: dict, context) -> dict:
         return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'not your turn'})}
 
     move = body.get('move', '')
-    board_state = body.get('board_state', '')
     game_status = body.get('game_status', 'playing')
     winner_id = body.get('winner_id', '')
     client_move_number = body.get('move_number', -1)
@@ -320,6 +799,41 @@ def handler(event: dict, context) -> dict:
         conn.close()
         return {'statusCode': 409, 'headers': headers, 'body': json.dumps({'error': 'move_number mismatch', 'expected': db_move_number, 'got': client_move_number})}
 
+    # Ход проверяется по серверной позиции (FEN в board_state или журнал ходов); мат
+    # и пат определяет сервер. Без позиции ход не принимается: результат клиента
+    # не используется. В партиях с ботом ходы бота на сервер не приходят —
+    # там остаётся результат, присланный клиентом.
+    new_board_state = None
+    position_hash = None
+    if not is_bot:
+        position = load_position(cur, g_id, db_board_state, db_move_number)
+        if position is None:
+            cur.close()
+            conn.close()
+            return {'statusCode': 500, 'headers': headers, 'body': json.dumps({'error': 'position unavailable'})}
+        client_hash = body.get('position_hash', '')
+        if position.side != (chess_core.WHITE if player_color == 'white' else chess_core.BLACK) \
+                or (client_hash and client_hash != '%016x' % position.key):
+            cur.close()
+            conn.close()
+            return {'statusCode': 409, 'headers': headers, 'body': json.dumps({
+                'error': 'position out of sync', 'position_hash': '%016x' % position.key})}
+        try:
+            after = position.parse_move(move)[1]
+        except chess_core.IllegalMove:
+            cur.close()
+            conn.close()
+            return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'illegal move', 'move': move})}
+        outcome = after.outcome()
+        if not outcome and after.halfmove >= 100:
+            outcome = 'fifty_moves'
+        if not outcome and after.halfmove >= 4 and repetition_count(cur, g_id, db_move_number + 1, after) >= 3:
+            outcome = 'threefold_repetition'
+        game_status = outcome or 'playing'
+        new_board_state = after.fen()
+        position_hash = after.key
+        winner_id = user_id if outcome == 'checkmate' else ''
+
     increment = 0
     if '+' in tc:
         parts = tc.split('+')
@@ -331,67 +845,116 @@ def handler(event: dict, context) -> dict:
     elif tc == 'classic':
         increment = 10
 
-    elapsed = secs_since if secs_since and secs_since > 0 else 0
+    # Время хода меряет сервер (мс с last_move_at). Клиент может сообщить задержку
+    # сети lag_ms — она вычитается, но не больше MAX_LAG_COMPENSATION_MS.
+    try:
+        lag_ms = int(body.get('lag_ms', 0) or 0)
+    except (TypeError, ValueError):
+        lag_ms = 0
+    elapsed_ms = ms_since - min(max(lag_ms, 0), MAX_LAG_COMPENSATION_MS, ms_since)
+
+    mover_ms = (white_ms if current_player == 'white' else black_ms) - elapsed_ms
+    if mover_ms <= 0:
+        # Флажок упал до хода — ход не принимается, партия проиграна по времени
+        winner = black_uid if current_player == 'white' else white_uid
+        ratings = finish_on_time(cur, g_id, winner, db_move_number)
+        conn.commit()
+        cur.close()
+        conn.close()
+        if game_cache:
+            game_cache.invalidate(g_id)
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'finished', 'winner': winner, 'end_reason': 'timeout', 'ratings': ratings})}
 
+    mover_ms += increment * 1000
     if current_player == 'white':
-        white_time = max(0, white_time - elapsed + increment)
-        new_white_time = white_time
-        new_black_time = black_time
+        new_white_ms, new_black_ms = mover_ms, black_ms
     else:
-        black_time = max(0, black_time - elapsed + increment)
-        new_white_time = white_time
-        new_black_time = black_time
+        new_white_ms, new_black_ms = white_ms, mover_ms
+    new_white_time = new_white_ms // 1000
+    new_black_time = new_black_ms // 1000
 
-    new_move_hist = (move_hist + ',' + move) if move_hist else move
     next_player = 'black' if current_player == 'white' else 'white'
     new_move_number = db_move_number + 1
 
     new_status = 'playing'
-    winner_val = 'NULL'
-    end_reason_val = 'NULL'
+    new_winner = None
+    new_end_reason = None
 
-    if game_status in ('checkmate', 'stalemate', 'finished'):
+    if game_status in ('checkmate', 'stalemate', 'fifty_moves', 'threefold_repetition', 'finished'):
         new_status = 'finished'
         if game_status == 'checkmate' and winner_id:
-            winner_val = "'%s'" % winner_id.replace("'", "''")
-            end_reason_val = "'checkmate'"
-        elif game_status == 'stalemate':
-            end_reason_val = "'stalemate'"
+            new_winner = winner_id
+            new_end_reason = 'checkmate'
         else:
-            end_reason_val = "'%s'" % game_status.replace("'", "''")
+            new_end_reason = game_status
+    winner_val = "'%s'" % esc(new_winner) if new_winner else 'NULL'
+    end_reason_val = "'%s'" % esc(new_end_reason) if new_end_reason else 'NULL'
 
+    # В online_games меняются только часы и очередь хода; сам ход дописывается
+    # в журнал online_game_moves, move_history собирается при завершении партии
     cur.execute(
         """UPDATE online_games SET
             current_player = '%s',
             white_time = %d,
             black_time = %d,
-            move_history = '%s',
-            board_state = '%s',
+            white_clock_ms = %d,
+            black_clock_ms = %d,
             status = '%s',
             winner = %s,
             end_reason = %s,
             move_number = %d,
+            board_state = %s,
             last_move_at = NOW(),
             updated_at = NOW()
         WHERE id = %d AND move_number = %d"""
-        % (next_player, new_white_time, new_black_time,
-           new_move_hist.replace("'", "''"),
-           board_state.replace("'", "''") if board_state else 'initial',
-           new_status, winner_val, end_reason_val, new_move_number, g_id, db_move_number)
+        % (next_player, new_white_time, new_black_time, new_white_ms, new_black_ms,
+           new_status, winner_val, end_reason_val, new_move_number,
+           "'%s'" % new_board_state if new_board_state else 'board_state',
+           g_id, db_move_number)
     )
 
     rows_updated = cur.rowcount
+    ratings = None
+    if rows_updated:
+        cur.execute(
+            "INSERT INTO online_game_moves (game_id, ply, move, clock_ms, position_hash) VALUES (%d, %d, '%s', %d, %s)"
+            % (g_id, new_move_number, move.replace("'", "''"), mover_ms,
+               chess_core.signed64(position_hash) if position_hash is not None else 'NULL')
+        )
+        if new_status == 'finished':
+            cur.execute("UPDATE online_games SET move_history = %s WHERE id = %d" % (history_sql(g_id), g_id))
+            ratings = settle_game(cur, g_id)
+        notify_game(cur, g_id, 'move', new_move_number)
     conn.commit()
     cur.close()
     conn.close()
 
     if rows_updated == 0:
+        if game_cache:
+            game_cache.invalidate(g_id)
         return {'statusCode': 409, 'headers': headers, 'body': json.dumps({'error': 'concurrent move detected, retry'})}
 
+    if game_cache:
+        if new_board_state:
+            game_cache.write_through(
+                g_id, db_move_number, 'move', new_move_number, append_move=move,
+                move_number=new_move_number, current_player=next_player, status=new_status,
+                winner=new_winner, end_reason=new_end_reason,
+                white_clock_ms=new_white_ms, black_clock_ms=new_black_ms,
+                board_state=new_board_state, position_hash='%016x' % position_hash,
+                last_move_mono=time_module.monotonic(), **settled_fields(ratings, white_uid, black_uid))
+        else:
+            game_cache.invalidate(g_id)
+
     return {'statusCode': 200, 'headers': headers, 'body': json.dumps({
         'status': new_status,
+        'board_state': new_board_state,
+        'position_hash': '%016x' % position_hash if position_hash is not None else None,
         'current_player': next_player,
         'move_number': new_move_number,
         'white_time': new_white_time,
-        'black_time': new_black_time
+        'black_time': new_black_time,
+        'white_time_ms': new_white_ms,
+        'black_time_ms': new_black_ms,
+        'ratings': ratings
     })}
\ No newline at end of file
@@ -3,6 +3,28 @@ import os
 import psycopg2
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+try:
+    import rating_simulator
+except ImportError:
+    rating_simulator = None
+
+try:
+    import decay_index
+except ImportError:
+    decay_index = None
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -42,19 +64,26 @@ def check_rate_limit(cur, conn, ip, endpoint, max_requests, window_seconds):
         return False
 
 
+def decay_value(value):
+    try:
+        return abs(int(value))
+    except (TypeError, ValueError):
+        return None
+
+
 def handler(event: dict, context) -> dict:
     """Получение и обновление настроек рейтинговой системы"""
     if event.get('httpMethod') == 'OPTIONS':
         return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
 
     cur = conn.cursor()
     client_ip = get_client_ip(event)
     method = event.get('httpMethod', 'GET')
-    if method == 'PUT':
-        if check_rate_limit(cur, conn, client_ip, 'rating-settings', 10, 60):
+    if method in ('PUT', 'POST'):
+        if check_rate_limit(cur, conn, client_ip, 'rating-settings' if method == 'PUT' else 'rating-settings-simulate', 10, 60):
             cur.close()
             conn.close()
             return {'statusCode': 429, 'headers': headers, 'body': json.dumps({'error': 'Too many requests'})}
@@ -62,8 +91,11 @@ def handler(event: dict, context) -> dict:
 
     if method == 'GET':
         cur = conn.cursor()
-        cur.execute("SELECT key, value, description FROM rating_settings ORDER BY id")
-        rows = cur.fetchall()
+        if settings_cache is not None:
+            rows = settings_cache.rows(cur, 'rating_settings')
+        else:
+            cur.execute("SELECT key, value, description FROM rating_settings ORDER BY id")
+            rows = cur.fetchall()
         cur.close()
         conn.close()
 
@@ -77,6 +109,7 @@ def handler(event: dict, context) -> dict:
         body = json.loads(event.get('body', '{}'))
         cur = conn.cursor()
 
+        new_decay = None
         for key, val in body.items():
             value = str(val) if not isinstance(val, dict) else str(val.get('value', ''))
             cur.execute(
@@ -84,12 +117,67 @@ def handler(event: dict, context) -> dict:
                     value.replace("'", "''"), key.replace("'", "''")
                 )
             )
+            if key == 'daily_decay':
+                new_decay = decay_value(value)
 
+        # Кэши настроек во всех воркерах шлюза сбрасываются при commit
+        cur.execute("""SELECT pg_notify('settings_events', '{"table": "rating_settings"}')""")
         conn.commit()
+        if settings_cache is not None:
+            settings_cache.invalidate('rating_settings')
+
+        result = {'ok': True}
+        # Индекс ключа сортировки leaderboard под новый daily_decay перестраивает
+        # фоновый поток шлюза (decay_index) — здесь только его состояние
+        if new_decay is not None and decay_index is not None:
+            result['decay_index'] = decay_index.status(cur, new_decay)
+            conn.rollback()
+        cur.close()
+        conn.close()
+
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps(result)}
+
+    if method == 'POST':
+        raw_body = event.get('body') or '{}'
+        body = json.loads(raw_body) if isinstance(raw_body, str) and raw_body.strip() else {}
+        admin_email = str(body.get('admin_email', '')).strip().lower()
+        if not admin_email:
+            conn.close()
+            return {'statusCode': 401, 'headers': headers, 'body': json.dumps({'error': 'Unauthorized'})}
+        if body.get('action') != 'simulate':
+            conn.close()
+            return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Unknown action'})}
+
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM admins WHERE email = '%s'" % admin_email.replace("'", "''"))
+        if not cur.fetchone():
+            cur.close()
+            conn.close()
+            return {'statusCode': 403, 'headers': headers, 'body': json.dumps({'error': 'Access denied'})}
+        if rating_simulator is None:
+            cur.close()
+            conn.close()
+            return {'statusCode': 501, 'headers': headers, 'body': json.dumps({'error': 'Simulation is not available'})}
+
+        # Предлагаемые значения — в том же виде, что и тело PUT
+        proposed = {}
+        for key, val in (body.get('settings') or {}).items():
+            proposed[key] = str(val.get('value', '')) if isinstance(val, dict) else str(val)
+        try:
+            days = int(body.get('days', 7))
+        except (TypeError, ValueError):
+            days = 7
+
+        if settings_cache is not None:
+            current = settings_cache.values(cur, 'rating_settings')
+        else:
+            cur.execute("SELECT key, value FROM rating_settings")
+            current = {r[0]: r[1] for r in cur.fetchall()}
+        result = rating_simulator.compare(cur, current, proposed, days)
         cur.close()
         conn.close()
 
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'ok': True})}
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps(result)}
 
     conn.close()
     return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
\ No newline at end of file
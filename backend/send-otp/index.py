@@ -9,6 +9,13 @@ from datetime import datetime, timedelta
 import psycopg2
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -67,9 +74,8 @@ def handler(event, context):
     if event.get('httpMethod') != 'POST':
         return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
 
-    dsn = os.environ['DATABASE_URL']
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
-    conn = psycopg2.connect(dsn)
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -83,6 +89,8 @@ def handler(event, context):
     email = body.get('email', '').strip().lower()
 
     if not email or '@' not in email:
+        cur.close()
+        conn.close()
         return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'Invalid email'})}
 
     code = ''.join(random.choices(string.digits, k=6))
@@ -3,6 +3,18 @@ import os
 import psycopg2
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -48,7 +60,7 @@ def handler(event: dict, context) -> dict:
         return {'statusCode': 200, 'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS', 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Session-Id', 'Access-Control-Max-Age': '86400'}, 'body': ''}
 
     headers = {'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -59,8 +71,11 @@ def handler(event: dict, context) -> dict:
             return {'statusCode': 429, 'headers': headers, 'body': json.dumps({'error': 'Too many requests'})}
 
     if event.get('httpMethod') == 'GET':
-        cur.execute("SELECT key, value, description FROM site_settings")
-        rows = cur.fetchall()
+        if settings_cache is not None:
+            rows = settings_cache.rows(cur, 'site_settings')
+        else:
+            cur.execute("SELECT key, value, description FROM site_settings")
+            rows = cur.fetchall()
         cur.close()
         conn.close()
         result = {}
@@ -76,9 +91,13 @@ def handler(event: dict, context) -> dict:
                 "UPDATE site_settings SET value = '%s', updated_at = NOW() WHERE key = '%s'"
                 % (val.replace("'", "''"), key.replace("'", "''"))
             )
+        # Кэши настроек во всех воркерах шлюза сбрасываются при commit
+        cur.execute("""SELECT pg_notify('settings_events', '{"table": "site_settings"}')""")
         conn.commit()
         cur.close()
         conn.close()
+        if settings_cache is not None:
+            settings_cache.invalidate('site_settings')
         return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'status': 'ok'})}
 
     cur.close()
@@ -2,10 +2,40 @@ import json
 import os
 import random
 import string
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 import psycopg2
 
 
+try:
+    from db_pool import get_connection
+except ImportError:
+    def get_connection():
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+
+try:
+    import settings_cache
+except ImportError:
+    settings_cache = None
+
+
+MSK = timezone(timedelta(hours=3))
+
+
+def effective_rating_sql(cur, prefix=''):
+    """Выражение рейтинга с накопленным ежедневным снижением: daily_decay за каждый
+    день после decay_anchor_date, но не ниже min_rating."""
+    if settings_cache is not None:
+        settings = settings_cache.values(cur, 'rating_settings')
+    else:
+        cur.execute("SELECT key, value FROM rating_settings WHERE key IN ('daily_decay', 'min_rating')")
+        settings = {r[0]: r[1] for r in cur.fetchall()}
+    decay = abs(int(settings.get('daily_decay', '1')))
+    min_rating = int(settings.get('min_rating', '500'))
+    today = datetime.now(MSK).strftime('%Y-%m-%d')
+    return "CASE WHEN {p}rating > {m} THEN GREATEST({p}rating - {d} * GREATEST(DATE '{t}' - {p}decay_anchor_date, 0), {m}) ELSE {p}rating END".format(
+        p=prefix, d=decay, m=min_rating, t=today)
+
+
 def get_client_ip(event):
     hdrs = event.get('headers') or {}
     ip = hdrs.get('X-Forwarded-For', hdrs.get('x-forwarded-for', ''))
@@ -69,8 +99,7 @@ def handler(event, context):
     if event.get('httpMethod') != 'POST':
         return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
 
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    conn = get_connection()
     cur = conn.cursor()
 
     client_ip = get_client_ip(event)
@@ -124,8 +153,8 @@ def handler(event, context):
     user_id = 'u_' + email.replace("'", "''")
 
     cur.execute(
-        "SELECT id, username, rating, city, games_played, wins, losses, draws, user_code FROM {schema}.users WHERE id = '{uid}'".format(
-            schema=schema, uid=user_id.replace("'", "''")
+        "SELECT id, username, {rating}, city, games_played, wins, losses, draws, user_code FROM {schema}.users WHERE id = '{uid}'".format(
+            schema=schema, rating=effective_rating_sql(cur), uid=user_id.replace("'", "''")
         )
     )
     existing = cur.fetchone()
@@ -0,0 +1 @@
+ALTER TABLE matchmaking_queue ADD COLUMN IF NOT EXISTS search_stage VARCHAR(20) DEFAULT 'city';
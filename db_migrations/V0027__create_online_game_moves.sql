@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS online_game_moves (
+    game_id INTEGER NOT NULL,
+    ply INTEGER NOT NULL,
+    move VARCHAR(16) NOT NULL,
+    clock_ms INTEGER,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (game_id, ply)
+);
+
+INSERT INTO online_game_moves (game_id, ply, move)
+SELECT g.id, m.ply, m.move
+FROM online_games g, unnest(string_to_array(g.move_history, ',')) WITH ORDINALITY AS m(move, ply)
+WHERE g.status = 'playing' AND g.move_history <> ''
+ON CONFLICT DO NOTHING;
+
+UPDATE online_games SET move_history = '' WHERE status = 'playing';
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_online_games_etag ON online_games (id) INCLUDE (move_number, status, rematch_status);
@@ -0,0 +1,2 @@
+ALTER TABLE online_games ALTER COLUMN board_state SET DEFAULT 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1';
+UPDATE online_games SET board_state = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1' WHERE status = 'playing' AND move_number = 0 AND board_state = 'initial';
@@ -0,0 +1,2 @@
+ALTER TABLE online_game_moves ADD COLUMN IF NOT EXISTS position_hash BIGINT;
+CREATE INDEX IF NOT EXISTS idx_online_game_moves_hash ON online_game_moves (game_id, position_hash);
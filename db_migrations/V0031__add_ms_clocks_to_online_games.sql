@@ -0,0 +1,3 @@
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS white_clock_ms INTEGER;
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS black_clock_ms INTEGER;
+UPDATE online_games SET white_clock_ms = white_time * 1000, black_clock_ms = black_time * 1000 WHERE status = 'playing';
@@ -0,0 +1,4 @@
+-- Сигналы теперь удаляются при чтении; прочитанные строки больше не нужны
+DELETE FROM webrtc_signals WHERE consumed = TRUE OR created_at < NOW() - INTERVAL '1 minute';
+DROP INDEX IF EXISTS idx_webrtc_signals_game_to;
+CREATE INDEX IF NOT EXISTS idx_webrtc_signals_game_to_id ON webrtc_signals (game_id, to_user_id, id);
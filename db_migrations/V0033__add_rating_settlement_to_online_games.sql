@@ -0,0 +1,4 @@
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS white_rating_after INTEGER;
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS white_rating_change INTEGER;
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS black_rating_after INTEGER;
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS black_rating_change INTEGER;
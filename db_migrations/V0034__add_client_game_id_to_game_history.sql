@@ -0,0 +1,2 @@
+ALTER TABLE game_history ADD COLUMN IF NOT EXISTS client_game_id VARCHAR(64);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_game_history_user_client_game ON game_history (user_id, client_game_id) WHERE client_game_id IS NOT NULL;
@@ -0,0 +1,11 @@
+ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_deviation REAL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS rating_volatility REAL;
+
+INSERT INTO rating_settings (key, value, description) VALUES
+    ('rating_engine', 'fixed', 'Формула рейтинга: fixed (фиксированные баллы), elo или glicko2'),
+    ('elo_k', '20', 'Elo: коэффициент K'),
+    ('elo_k_provisional', '40', 'Elo: K для новичков'),
+    ('elo_provisional_games', '30', 'Elo: сколько первых партий игрок считается новичком'),
+    ('elo_k_master', '10', 'Elo: K для сильных игроков'),
+    ('elo_master_rating', '2400', 'Elo: рейтинг, с которого действует K для сильных игроков'),
+    ('glicko_tau', '0.5', 'Glicko-2: τ, ограничение изменения волатильности');
@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS rating_decay_runs (
+    run_date DATE PRIMARY KEY,
+    decay INTEGER NOT NULL,
+    min_rating INTEGER NOT NULL,
+    last_user_id VARCHAR(64) NOT NULL DEFAULT '',
+    scanned INTEGER NOT NULL DEFAULT 0,
+    affected INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_game_history_user_created ON game_history (user_id, created_at);
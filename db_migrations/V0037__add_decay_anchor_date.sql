@@ -0,0 +1,23 @@
+-- Ленивое ежедневное снижение: рейтинг в users учитывает снижение по decay_anchor_date
+-- включительно, за последующие дни оно вычисляется при чтении
+ALTER TABLE users ADD COLUMN IF NOT EXISTS decay_anchor_date DATE;
+UPDATE users SET decay_anchor_date = COALESCE(
+    (SELECT NULLIF(value, '2000-01-01')::date FROM rating_settings WHERE key = 'last_decay_date'),
+    (NOW() AT TIME ZONE 'Europe/Moscow')::date
+) WHERE decay_anchor_date IS NULL;
+ALTER TABLE users ALTER COLUMN decay_anchor_date SET DEFAULT (NOW() AT TIME ZONE 'Europe/Moscow')::date;
+ALTER TABLE users ALTER COLUMN decay_anchor_date SET NOT NULL;
+
+-- Порядок по rating - daily_decay * (сегодня - decay_anchor_date) совпадает с порядком
+-- по ключу rating + daily_decay * (decay_anchor_date - 2000-01-01). Множитель берётся из
+-- текущей настройки (leaderboard подставляет её же); при смене daily_decay индекс
+-- пересоздаёт фоновый поток шлюза (decay_index.py). При daily_decay = 0 leaderboard сортирует по rating
+DO $$
+DECLARE
+    decay INTEGER := COALESCE((SELECT ABS(value::int) FROM rating_settings WHERE key = 'daily_decay' LIMIT 1), 1);
+BEGIN
+    IF decay > 0 THEN
+        EXECUTE format('CREATE INDEX IF NOT EXISTS idx_users_decayed_rating ON users ((rating + %s * (decay_anchor_date - DATE %L)) DESC)', decay, '2000-01-01');
+        EXECUTE format('COMMENT ON INDEX idx_users_decayed_rating IS %L', 'daily_decay=' || decay);
+    END IF;
+END $$;
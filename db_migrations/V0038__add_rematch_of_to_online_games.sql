@@ -0,0 +1 @@
+ALTER TABLE online_games ADD COLUMN IF NOT EXISTS rematch_of INTEGER;
@@ -0,0 +1,3 @@
+-- Индекс из V0028 включает move_number/status/rematch_status: каждый ход меняет
+-- проиндексированную колонку, и UPDATE перестаёт быть HOT. Запрос ETag идёт по PK.
+DROP INDEX IF EXISTS idx_online_games_etag;
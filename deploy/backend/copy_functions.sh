@@ -34,4 +34,21 @@ for pair in "${PAIRS[@]}"; do
   fi
 done
 
+# Общие модули функций кладём рядом с main.py — эта папка есть в sys.path.
+# rating_engine.py лежит и в finish-game, и в online-move (копии совпадают)
+MODULES=(
+  "online-move/chess_core.py"
+  "finish-game/rating_engine.py"
+  "finish-game/rating_replay.py"
+)
+
+for module in "${MODULES[@]}"; do
+  if [ -f "backend/${module}" ]; then
+    cp "backend/${module}" "deploy/backend/$(basename "${module}")"
+    echo "Copied ${module}"
+  else
+    echo "WARN: backend/${module} not found"
+  fi
+done
+
 echo "Done. All functions copied to deploy/backend/functions/"
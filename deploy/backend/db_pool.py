@@ -0,0 +1,188 @@
+"""Общий пул соединений с PostgreSQL для всех функций внутри FastAPI-шлюза.
+
+Функции из backend/ вызывают get_connection() вместо psycopg2.connect().
+Возвращённое соединение ведёт себя как обычное: conn.close() не рвёт TCP,
+а возвращает соединение в пул. Если пул не инициализирован (функция
+запущена как отдельная облачная функция или из скрипта), get_connection()
+открывает новое соединение, как раньше.
+"""
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+_pool = None
+
+
+class PooledConnection:
+    """Обёртка над соединением: close() возвращает его в пул."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._released = False
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._raw)
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def __del__(self):
+        # Страховка на случай ранних return без conn.close() в обработчике
+        if not self._released:
+            self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=2, max_size=20, acquire_timeout=10.0, healthcheck_idle=30.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+        self.stats = {'acquired': 0, 'created': 0, 'discarded': 0, 'healthcheck_failed': 0, 'timeouts': 0}
+
+    def _connect(self):
+        raw = psycopg2.connect(self.dsn)
+        with self._lock:
+            self._size += 1
+            self.stats['created'] += 1
+        return raw
+
+    def _discard(self, raw):
+        with self._lock:
+            self._size -= 1
+            self.stats['discarded'] += 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def fill(self):
+        for _ in range(self.min_size):
+            self._idle.put((self._connect(), time.monotonic()))
+
+    def _is_healthy(self, raw, idle_since):
+        if raw.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_idle:
+            return True
+        try:
+            cur = raw.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            raw.rollback()
+            return True
+        except Exception:
+            self.stats['healthcheck_failed'] += 1
+            return False
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            self.stats['timeouts'] += 1
+            raise psycopg2.OperationalError('connection pool exhausted (max %d)' % self.max_size)
+        try:
+            while True:
+                try:
+                    raw, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    raw = self._connect()
+                    break
+                if self._is_healthy(raw, idle_since):
+                    break
+                self._discard(raw)
+        except Exception:
+            self._slots.release()
+            raise
+        self.stats['acquired'] += 1
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        try:
+            if raw.closed:
+                self._discard(raw)
+                return
+            status = raw.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(raw)
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+            if raw.autocommit:
+                raw.autocommit = False
+            self._idle.put((raw, time.monotonic()))
+        except Exception:
+            self._discard(raw)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                raw, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(raw)
+
+    def snapshot(self):
+        with self._lock:
+            size = self._size
+        return dict(self.stats, size=size, idle=self._idle.qsize(), min_size=self.min_size, max_size=self.max_size)
+
+
+def init_pool(dsn=None):
+    """Создаёт пул один раз на процесс (воркер uvicorn)."""
+    global _pool
+    if _pool is not None:
+        return _pool
+    _pool = ConnectionPool(
+        dsn or os.environ['DATABASE_URL'],
+        min_size=int(os.environ.get('DB_POOL_MIN', '2')),
+        max_size=int(os.environ.get('DB_POOL_MAX', '20')),
+        acquire_timeout=float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+        healthcheck_idle=float(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30')),
+    )
+    _pool.fill()
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close_all()
+        _pool = None
+
+
+def get_connection():
+    if _pool is None:
+        return psycopg2.connect(os.environ['DATABASE_URL'])
+    return _pool.acquire()
+
+
+def stats():
+    if _pool is None:
+        return None
+    return _pool.snapshot()
@@ -0,0 +1,159 @@
+"""Фоновая перестройка индекса ключа сортировки leaderboard под daily_decay.
+
+Leaderboard сортирует по rating + daily_decay * (decay_anchor_date - 2000-01-01),
+и индекс idx_users_decayed_rating годится только при том же множителе. Для
+какого daily_decay построен индекс, записано в его комментарии
+('daily_decay=N'). Раз в DECAY_INDEX_CHECK_SECONDS (по умолчанию 60 с) и сразу
+по NOTIFY settings_events для rating_settings поток сверяет комментарий с
+настройкой и при расхождении строит новый индекс CREATE INDEX CONCURRENTLY под
+временным именем, затем удаляет старый и переименовывает новый. При
+daily_decay = 0 индекс не нужен (сортировка по rating) и удаляется.
+
+Постройка на большой таблице идёт минутами, поэтому она не в запросе PUT
+rating-settings — тот лишь сообщает состояние (status()). Неудачная попытка
+оставляет недостроенный индекс _new — следующая проверка удаляет его и
+начинает заново. Проверка идёт в каждом воркере, но advisory lock пропускает
+только один; CONCURRENTLY работает только вне транзакции, поэтому lock
+сессионный, а соединение на время перестройки — в autocommit.
+"""
+import os
+import threading
+import time
+
+import db_pool
+import pg_notify
+import settings_cache
+
+INDEX_NAME = 'idx_users_decayed_rating'
+REBUILD_LOCK_KEY = 7303
+
+STATUS_SQL = """SELECT
+    (SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('{name}')),
+    obj_description(to_regclass('{name}'), 'pg_class'),
+    to_regclass('{name}_new') IS NOT NULL""".format(name=INDEX_NAME)
+
+_thread = None
+_stop = None
+_wake = None
+_sub = None
+stats = {'checks': 0, 'rebuilds': 0, 'errors': 0, 'last_status': None, 'last_error': None,
+         'last_rebuild_ms': 0.0}
+
+
+def status(cur, decay):
+    """ready — индекс построен под decay; not_needed — decay = 0 и индекса нет;
+    rebuilding — идёт постройка; pending — индекс не совпадает с настройкой."""
+    cur.execute(STATUS_SQL)
+    valid, comment, building = cur.fetchone()
+    if not decay:
+        return 'not_needed' if valid is None else 'pending'
+    if valid and comment == 'daily_decay=%d' % decay:
+        return 'ready'
+    return 'rebuilding' if building else 'pending'
+
+
+def current_decay(cur):
+    cur.execute("SELECT value FROM rating_settings WHERE key = 'daily_decay'")
+    row = cur.fetchone()
+    try:
+        return abs(int(row[0])) if row else 1
+    except (TypeError, ValueError):
+        return None
+
+
+def rebuild(conn):
+    """Одна проверка; перестраивает индекс, если он не совпадает с daily_decay. Возвращает состояние."""
+    raw = conn.raw
+    raw.autocommit = True
+    cur = raw.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_lock(%d)" % REBUILD_LOCK_KEY)
+        if not cur.fetchone()[0]:
+            return 'rebuilding'
+        try:
+            decay = current_decay(cur)
+            if decay is None:
+                return 'pending'
+            state = status(cur, decay)
+            if state in ('ready', 'not_needed'):
+                return state
+            started = time.monotonic()
+            cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s_new" % INDEX_NAME)
+            if decay:
+                cur.execute(
+                    "CREATE INDEX CONCURRENTLY %s_new ON users ((rating + %d * (decay_anchor_date - DATE '2000-01-01')) DESC)"
+                    % (INDEX_NAME, decay)
+                )
+                cur.execute("COMMENT ON INDEX %s_new IS 'daily_decay=%d'" % (INDEX_NAME, decay))
+            cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % INDEX_NAME)
+            if decay:
+                cur.execute("ALTER INDEX %s_new RENAME TO %s" % (INDEX_NAME, INDEX_NAME))
+            stats['rebuilds'] += 1
+            stats['last_rebuild_ms'] = round((time.monotonic() - started) * 1000, 2)
+            return status(cur, decay)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%d)" % REBUILD_LOCK_KEY)
+    finally:
+        cur.close()
+        raw.autocommit = False
+
+
+def _on_notify(payload):
+    if payload.get('table') in (None, 'rating_settings') and _wake is not None:
+        _wake.set()
+
+
+def _loop(interval, stop, wake):
+    while not stop.is_set():
+        wake.wait(interval)
+        wake.clear()
+        if stop.is_set():
+            break
+        conn = None
+        try:
+            conn = db_pool.get_connection()
+            stats['last_status'] = rebuild(conn)
+            stats['last_error'] = None
+        except Exception as e:
+            stats['errors'] += 1
+            stats['last_status'] = 'failed'
+            stats['last_error'] = str(e)
+            print(f"[WARN] decay index rebuild failed: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        stats['checks'] += 1
+
+
+def start():
+    global _thread, _stop, _wake, _sub
+    interval = float(os.environ.get('DECAY_INDEX_CHECK_SECONDS', '60'))
+    if _thread is not None or interval <= 0:
+        return
+    _stop = threading.Event()
+    _wake = threading.Event()
+    # Первая проверка — сразу при старте
+    _wake.set()
+    _sub = pg_notify.subscribe(settings_cache.SETTINGS_CHANNEL, _on_notify)
+    _thread = threading.Thread(target=_loop, args=(interval, _stop, _wake), name='decay-index', daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread, _stop, _wake, _sub
+    if _thread is None:
+        return
+    if _sub is not None:
+        pg_notify.unsubscribe(_sub)
+        _sub = None
+    _stop.set()
+    _wake.set()
+    # Постройка CONCURRENTLY может идти долго — поток демонический, не ждём его дольше обычного
+    _thread.join(timeout=5)
+    _thread = None
+    _stop = None
+    _wake = None
+
+
+def snapshot():
+    return dict(stats, running=_thread is not None)
@@ -0,0 +1,135 @@
+"""Выполнение синхронных обработчиков функций в ограниченных пулах потоков.
+
+Обработчики из backend/ блокирующие (psycopg2, SMTP, urllib), поэтому шлюз
+не вызывает их в event loop, а отправляет в пул потоков. Пулы разделены по
+классам функций: медленный внешний I/O (почта, геолокация) не может занять
+потоки, которые нужны ходам и матчмейкингу.
+
+Обработчики game, default и slow_io держат соединение из db_pool всё время
+работы, поэтому их потоков в сумме не больше, чем DB_POOL_MAX минус
+соединения фоновых потоков (RESERVED_DB_CONNECTIONS). Иначе лишние потоки
+ждут соединение до DB_POOL_TIMEOUT и падают с «pool exhausted». Размеры
+по умолчанию выводятся из размера пула; HANDLER_POOL_* их переопределяет.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FUNCTION_CLASSES = {
+    "online-move": "game",
+    "matchmaking": "game",
+    "invite-game": "game",
+    "send-otp": "slow_io",
+    "geo-detect": "slow_io",
+}
+
+POOL_DEFAULTS = {
+    # класс: (доля соединений db_pool или число потоков, максимальная очередь)
+    "game": (0.5, 256),
+    "default": (0.3, 128),
+    "slow_io": (0.2, 32),
+    # long-poll запросы почти всё время спят на threading.Event и отдают
+    # соединение на время ожидания, поэтому им отдельный широкий пул вне бюджета
+    "longpoll": (256, 1024),
+}
+# Соединения фоновых потоков шлюза: matchmaking_tick и game_sweeper
+RESERVED_DB_CONNECTIONS = 2
+
+
+class QueueFull(Exception):
+    pass
+
+
+class HandlerPool:
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fn-%s" % name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_queued_seen = 0
+        self.total_wait_ms = 0.0
+
+    def _run(self, enqueued_at, fn, args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait_ms += (time.monotonic() - enqueued_at) * 1000
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self.name)
+            self.queued += 1
+            self.max_queued_seen = max(self.max_queued_seen, self.queued)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, time.monotonic(), fn, args)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "max_queued_seen": self.max_queued_seen,
+                "avg_wait_ms": round(self.total_wait_ms / self.completed, 2) if self.completed else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pools = {}
+
+
+def init_pools(db_pool_size):
+    budget = max(db_pool_size - RESERVED_DB_CONNECTIONS, 1)
+    db_threads = 0
+    for name, (size, max_queue) in POOL_DEFAULTS.items():
+        env = name.upper()
+        workers = max(1, int(budget * size)) if isinstance(size, float) else size
+        workers = int(os.environ.get("HANDLER_POOL_%s" % env) or workers)
+        if isinstance(size, float):
+            db_threads += workers
+        _pools[name] = HandlerPool(name, workers, int(os.environ.get("HANDLER_QUEUE_%s" % env, max_queue)))
+    if db_threads > budget:
+        print("[WARN] handler pools use %d DB threads, db_pool allows %d (DB_POOL_MAX - %d)"
+              % (db_threads, budget, RESERVED_DB_CONNECTIONS))
+
+
+def shutdown_pools():
+    for pool in _pools.values():
+        pool.shutdown()
+    _pools.clear()
+
+
+def pool_for(func_name, event=None):
+    if func_name == "online-move" and event and event.get("httpMethod") == "GET":
+        qs = event.get("queryStringParameters") or {}
+        if qs.get("wait_for_move_number", "") != "":
+            return _pools["longpoll"]
+    return _pools[FUNCTION_CLASSES.get(func_name, "default")]
+
+
+async def run_handler(func_name, handler, event, ctx):
+    return await pool_for(func_name, event).run(handler, event, ctx)
+
+
+def stats():
+    return {name: pool.snapshot() for name, pool in _pools.items()}
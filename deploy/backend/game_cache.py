@@ -0,0 +1,156 @@
+"""Кэш состояния онлайн-партий в памяти воркера шлюза.
+
+Обе стороны опрашивают одну и ту же строку online_games несколько раз в
+секунду. online-move GET берёт состояние отсюда и идёт в БД только при
+промахе. Запись — сквозная: после commit хода/сдачи/ничьей/реванша
+обработчик обновляет запись своего воркера, а остальные воркеры узнают об
+изменении из NOTIFY online_game_events и выбрасывают устаревшую запись.
+
+Запись считается актуальной, пока не пришло событие партии, которое этот
+воркер сам не применял. Часы хранятся как остаток на момент последнего хода
+плюс монотонная отметка времени этого хода — текущие значения считаются при
+чтении. Если слушатель NOTIFY переподключался (события могли потеряться),
+кэш очищается целиком; без слушателя кэш выключен.
+
+Чтобы промах, прочитавший строку до чужого commit, не положил в кэш
+устаревшее состояние, загрузка берёт load_token() до запроса в БД, а put()
+отбрасывает состояние, если за это время по партии пришло событие.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pg_notify
+
+MAX_ENTRIES = int(os.environ.get('GAME_CACHE_SIZE', '10000'))
+TTL_SECONDS = float(os.environ.get('GAME_CACHE_TTL', '30'))
+
+_lock = threading.Lock()
+_games = OrderedDict()   # game_id -> state
+_sub = None
+_reconnects_seen = 0
+_seqs = {}               # game_id -> число событий партии, увиденных воркером
+_epoch = 0
+stats = {'hits': 0, 'misses': 0, 'writes': 0, 'invalidations': 0, 'flushes': 0}
+
+
+def _bump(game_id):
+    global _epoch
+    _seqs[game_id] = _seqs.get(game_id, 0) + 1
+    if len(_seqs) > MAX_ENTRIES * 4:
+        _seqs.clear()
+        _epoch += 1
+
+
+def _on_notify(payload):
+    if payload.get('event') == 'signal':
+        return
+    game_id = payload.get('game_id')
+    with _lock:
+        _bump(game_id)
+        state = _games.get(game_id)
+        if state is None:
+            return
+        if state.get('_applied') == (payload.get('event'), payload.get('move_number')):
+            return
+        del _games[game_id]
+        stats['invalidations'] += 1
+
+
+def start():
+    global _sub
+    if _sub is None:
+        _sub = pg_notify.subscribe(pg_notify.GAME_CHANNEL, _on_notify)
+
+
+def stop():
+    global _sub
+    if _sub is not None:
+        pg_notify.unsubscribe(_sub)
+        _sub = None
+    with _lock:
+        _games.clear()
+
+
+def is_ready():
+    global _reconnects_seen, _epoch
+    if _sub is None or not pg_notify.is_running():
+        return False
+    reconnects = pg_notify.stats['reconnects']
+    if reconnects != _reconnects_seen:
+        with _lock:
+            _games.clear()
+            _seqs.clear()
+            _epoch += 1
+        _reconnects_seen = reconnects
+        stats['flushes'] += 1
+    return True
+
+
+def get(game_id):
+    """Копия состояния или None. Списки ходов не копируются — их нельзя менять снаружи."""
+    if not is_ready():
+        return None
+    with _lock:
+        state = _games.get(game_id)
+        if state is not None and time.monotonic() - state['_cached_at'] > TTL_SECONDS:
+            del _games[game_id]
+            state = None
+        if state is None:
+            stats['misses'] += 1
+            return None
+        _games.move_to_end(game_id)
+        stats['hits'] += 1
+        return dict(state)
+
+
+def load_token(game_id):
+    with _lock:
+        return (_epoch, _seqs.get(game_id, 0))
+
+
+def put(state, token):
+    if not is_ready():
+        return
+    entry = dict(state, _cached_at=time.monotonic(), _applied=None)
+    with _lock:
+        if token != (_epoch, _seqs.get(state['id'], 0)):
+            return
+        _games[state['id']] = entry
+        _games.move_to_end(state['id'])
+        while len(_games) > MAX_ENTRIES:
+            _games.popitem(last=False)
+
+
+def write_through(game_id, expected_move_number, event, event_move_number=None, append_move=None, **fields):
+    """Применяет уже закоммиченное изменение. event и event_move_number — то же,
+    что ушло в NOTIFY: своё уведомление воркер узнаёт и запись не выбрасывает.
+    Если в кэше другая версия партии — запись выбрасывается, следующий GET
+    перечитает её из БД."""
+    with _lock:
+        state = _games.get(game_id)
+        if state is None:
+            return
+        if state['move_number'] != expected_move_number:
+            del _games[game_id]
+            stats['invalidations'] += 1
+            return
+        if append_move is not None:
+            state['moves'] = state['moves'] + [append_move]
+        state.update(fields)
+        state['_applied'] = (event, event_move_number)
+        state['_cached_at'] = time.monotonic()
+        stats['writes'] += 1
+
+
+def invalidate(game_id):
+    with _lock:
+        if _games.pop(game_id, None) is not None:
+            stats['invalidations'] += 1
+
+
+def snapshot():
+    with _lock:
+        size = len(_games)
+    return dict(stats, size=size, ready=_sub is not None and pg_notify.is_running())
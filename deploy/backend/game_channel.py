@@ -0,0 +1,217 @@
+"""WebSocket-канал онлайн-партии: /ws/game/{game_id}?user_id=...
+
+Сокет заменяет HTTP-опрос online-move. Все изменения партии по-прежнему
+проходят через обработчик online-move (те же проверки, rate limit и
+оптимистичная проверка move_number), канал лишь доставляет их:
+
+* ход, пришедший в сокет этого воркера, сразу рассылается локальным
+  сокетам партии;
+* остальные воркеры узнают о событии из NOTIFY online_game_events
+  и рассылают состояние своим сокетам.
+
+Сообщения клиента: {"action": "move" | "resign" | "draw" | "timeout" |
+"signal" | "rematch_offer" | ..., ...поля как в POST online-move} и
+{"action": "sync"} — запрос текущего состояния с часами.
+Сообщения сервера: {"type": "state", "game": {...}},
+{"type": "signal", "signals": [...]}, {"type": "ack", ...}, {"type": "error", ...}.
+"""
+import asyncio
+import json
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import dispatch
+import pg_notify
+
+FUNC_NAME = "online-move"
+
+_loop = None
+_handler = None
+_sockets = {}        # game_id -> {websocket: user_id}
+_last_sent = {}      # game_id -> сигнатура последнего разосланного состояния
+_sub = None
+stats = {"connections": 0, "broadcasts": 0, "messages_in": 0}
+
+
+class _Ctx:
+    request_id = "ws"
+
+
+def _event(method, websocket, qs=None, body=None):
+    hdrs = dict(websocket.headers)
+    return {
+        "httpMethod": method,
+        "headers": hdrs,
+        "queryStringParameters": qs,
+        "body": json.dumps(body) if body is not None else "",
+        "isBase64Encoded": False,
+        "requestContext": {
+            "identity": {"sourceIp": websocket.client.host if websocket.client else "unknown"}
+        },
+    }
+
+
+async def _call(websocket, method, qs=None, body=None):
+    result = await dispatch.run_handler(FUNC_NAME, _handler.handler, _event(method, websocket, qs, body), _Ctx())
+    try:
+        data = json.loads(result.get("body") or "{}")
+    except ValueError:
+        data = {}
+    return result.get("statusCode", 200), data
+
+
+def _signature(game):
+    return (game.get("move_number"), game.get("status"), game.get("rematch_status"), game.get("rematch_game_id"))
+
+
+async def _send(websocket, message):
+    try:
+        await websocket.send_text(json.dumps(message))
+    except Exception:
+        pass
+
+
+async def broadcast_state(game_id, websocket=None, force=False):
+    """Одно чтение состояния на воркер и рассылка всем локальным сокетам партии."""
+    peers = _sockets.get(game_id)
+    if not peers:
+        return
+    any_ws = websocket or next(iter(peers))
+    try:
+        status, data = await _call(any_ws, "GET", {"game_id": str(game_id)})
+    except dispatch.QueueFull:
+        # Пул занят — клиенты получат состояние со следующим событием или sync
+        return
+    if status != 200 or not data.get("game"):
+        return
+    sig = _signature(data["game"])
+    if not force and _last_sent.get(game_id) == sig:
+        return
+    _last_sent[game_id] = sig
+    stats["broadcasts"] += 1
+    for ws in list(peers):
+        await _send(ws, {"type": "state", "game": data["game"]})
+
+
+async def _deliver_signals(game_id, to_user):
+    for ws, uid in list((_sockets.get(game_id) or {}).items()):
+        if uid != to_user:
+            continue
+        # GET с user_id забирает непрочитанные сигналы получателя; при занятом пуле
+        # или ошибке обработчика сигналы остаются в ящике до следующего события или sync
+        try:
+            status, data = await _call(ws, "GET", {"game_id": str(game_id), "user_id": uid})
+        except dispatch.QueueFull:
+            await _send(ws, {"type": "error", "action": "signal", "status": 503, "error": "Server busy, retry later"})
+            continue
+        except Exception as e:
+            print(f"[WARN] game_channel signal delivery failed: {e}")
+            await _send(ws, {"type": "error", "action": "signal", "status": 500, "error": "Internal error"})
+            continue
+        if status == 200 and data.get("signals"):
+            await _send(ws, {"type": "signal", "signals": data["signals"]})
+
+
+async def _on_game_event(payload):
+    game_id = payload.get("game_id")
+    if game_id not in _sockets:
+        return
+    if payload.get("event") == "signal":
+        await _deliver_signals(game_id, payload.get("to"))
+    else:
+        await broadcast_state(game_id)
+
+
+def _on_notify(payload):
+    # Вызывается из потока pg_notify — переносим обработку в event loop
+    if _loop is not None and payload.get("game_id") in _sockets:
+        asyncio.run_coroutine_threadsafe(_on_game_event(payload), _loop)
+
+
+def start(handler_module):
+    global _loop, _handler, _sub
+    _loop = asyncio.get_event_loop()
+    _handler = handler_module
+    if _sub is None:
+        _sub = pg_notify.subscribe(pg_notify.GAME_CHANNEL, _on_notify)
+
+
+def stop():
+    global _sub
+    if _sub is not None:
+        pg_notify.unsubscribe(_sub)
+        _sub = None
+
+
+async def serve(websocket: WebSocket, game_id: int):
+    user_id = websocket.query_params.get("user_id", "")
+    await websocket.accept()
+    if _handler is None or not user_id:
+        await websocket.close(code=4400)
+        return
+
+    try:
+        status, data = await _call(websocket, "GET", {"game_id": str(game_id), "user_id": user_id})
+    except dispatch.QueueFull:
+        # 1013 Try Again Later — клиент переподключится позже
+        await websocket.close(code=1013)
+        return
+    game = data.get("game")
+    if status != 200 or not game:
+        await websocket.close(code=4404)
+        return
+    if user_id not in (game.get("white_user_id"), game.get("black_user_id")):
+        await websocket.close(code=4403)
+        return
+
+    _sockets.setdefault(game_id, {})[websocket] = user_id
+    stats["connections"] += 1
+    await _send(websocket, {"type": "state", "game": game})
+    if data.get("signals"):
+        await _send(websocket, {"type": "signal", "signals": data["signals"]})
+
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            stats["messages_in"] += 1
+            try:
+                msg = json.loads(raw)
+            except ValueError:
+                await _send(websocket, {"type": "error", "error": "invalid json"})
+                continue
+            action = msg.get("action", "move")
+            if action == "sync":
+                try:
+                    status, data = await _call(websocket, "GET", {"game_id": str(game_id)})
+                except dispatch.QueueFull:
+                    await _send(websocket, {"type": "error", "action": action, "status": 503, "error": "Server busy, retry later"})
+                    continue
+                if status == 200:
+                    await _send(websocket, {"type": "state", "game": data.get("game")})
+                continue
+            body = dict(msg, action=action, game_id=game_id, user_id=user_id)
+            try:
+                status, data = await _call(websocket, "POST", body=body)
+            except dispatch.QueueFull:
+                await _send(websocket, {"type": "error", "action": action, "status": 503, "error": "Server busy, retry later"})
+                continue
+            if status != 200:
+                await _send(websocket, dict(data, type="error", action=action, status=status))
+                continue
+            await _send(websocket, {"type": "ack", "action": action, "data": data})
+            if action != "signal":
+                await broadcast_state(game_id, websocket)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        peers = _sockets.get(game_id)
+        if peers is not None:
+            peers.pop(websocket, None)
+            if not peers:
+                _sockets.pop(game_id, None)
+                _last_sent.pop(game_id, None)
+        stats["connections"] -= 1
+
+
+def snapshot():
+    return dict(stats, games=len(_sockets))
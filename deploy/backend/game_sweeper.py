@@ -0,0 +1,138 @@
+"""Фоновая уборка зависших онлайн-партий.
+
+Раз в GAME_SWEEP_SECONDS (по умолчанию 5 с) один UPDATE завершает все
+партии в статусе playing, у которых:
+
+* у стороны, чей ход, истекли часы (с запасом FLAG_GRACE_MS на задержку
+  сети) — end_reason = 'timeout', победа сопернику;
+* не было ни ходов, ни других изменений дольше GAME_ABANDON_MINUTES —
+  end_reason = 'abandoned', без победителя.
+
+Партии с ботом по часам не завершаются: ходы бота на сервер не приходят.
+Тот же запрос собирает move_history из журнала и отправляет NOTIFY
+online_game_events, так что сокеты и long-poll узнают о конце партии сразу.
+Проигрыш по времени сразу учитывается в рейтинге — settle_game() обработчика
+online-move в той же транзакции. Брошенные партии в рейтинг не идут.
+Уборка идёт в каждом воркере, но advisory lock пропускает только один.
+
+Там же удаляются строки webrtc_signals старше SIGNAL_TTL_SECONDS — большие
+сигналы, которые получатель так и не забрал.
+"""
+import os
+import threading
+import time
+
+import db_pool
+
+SWEEP_LOCK_KEY = 7302
+FLAG_GRACE_MS = 2000
+SIGNAL_TTL_SECONDS = 60
+
+SWEEP_SQL = """
+WITH due AS (
+    SELECT id,
+           CASE WHEN GREATEST(last_move_at, updated_at) < NOW() - INTERVAL '%(abandon)d minutes'
+                THEN 'abandoned' ELSE 'timeout' END AS reason
+    FROM online_games
+    WHERE status = 'playing'
+      AND (
+        GREATEST(last_move_at, updated_at) < NOW() - INTERVAL '%(abandon)d minutes'
+        OR (is_bot_game = FALSE
+            AND CASE current_player
+                    WHEN 'white' THEN COALESCE(white_clock_ms, white_time * 1000)
+                    ELSE COALESCE(black_clock_ms, black_time * 1000)
+                END + %(grace)d < EXTRACT(EPOCH FROM (NOW() - last_move_at)) * 1000)
+      )
+    FOR UPDATE SKIP LOCKED
+), done AS (
+    UPDATE online_games g SET
+        status = 'finished',
+        end_reason = due.reason,
+        winner = CASE WHEN due.reason = 'timeout'
+                      THEN CASE g.current_player WHEN 'white' THEN g.black_user_id ELSE g.white_user_id END
+                 END,
+        move_history = CASE WHEN g.move_history <> '' THEN g.move_history ELSE
+            (SELECT COALESCE(string_agg(m.move, ',' ORDER BY m.ply), '') FROM online_game_moves m WHERE m.game_id = g.id) END,
+        updated_at = NOW()
+    FROM due
+    WHERE g.id = due.id
+    RETURNING g.id, g.end_reason, g.move_number
+)
+SELECT id, end_reason, pg_notify('online_game_events',
+                             json_build_object('game_id', id, 'event', end_reason, 'move_number', move_number)::text)
+FROM done
+"""
+
+_thread = None
+_stop = None
+stats = {'sweeps': 0, 'timeout': 0, 'abandoned': 0, 'settled': 0, 'signals_purged': 0, 'errors': 0,
+         'last_rows': 0, 'last_sweep_ms': 0.0}
+
+
+def sweep(conn, abandon_minutes, handler_module=None):
+    """Один проход; возвращает {end_reason: число партий}."""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_xact_lock(%d)" % SWEEP_LOCK_KEY)
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        cur.close()
+        return {}
+    cur.execute(SWEEP_SQL % {'abandon': abandon_minutes, 'grace': FLAG_GRACE_MS})
+    counts = {}
+    for game_id, reason, _ in cur.fetchall():
+        counts[reason] = counts.get(reason, 0) + 1
+        if reason == 'timeout' and handler_module is not None and handler_module.settle_game(cur, game_id):
+            stats['settled'] += 1
+    cur.execute("DELETE FROM webrtc_signals WHERE created_at < NOW() - INTERVAL '%d seconds'" % SIGNAL_TTL_SECONDS)
+    stats['signals_purged'] += cur.rowcount
+    conn.commit()
+    cur.close()
+    return counts
+
+
+def _loop(handler_module, interval, abandon_minutes, stop):
+    while not stop.wait(interval):
+        started = time.monotonic()
+        conn = None
+        try:
+            conn = db_pool.get_connection()
+            counts = sweep(conn, abandon_minutes, handler_module)
+            stats['last_rows'] = sum(counts.values())
+            for reason, n in counts.items():
+                stats[reason] = stats.get(reason, 0) + n
+        except Exception as e:
+            stats['errors'] += 1
+            print(f"[WARN] game sweep failed: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        stats['sweeps'] += 1
+        stats['last_sweep_ms'] = round((time.monotonic() - started) * 1000, 2)
+
+
+def start(handler_module=None):
+    global _thread, _stop
+    interval = float(os.environ.get('GAME_SWEEP_SECONDS', '5'))
+    abandon_minutes = int(os.environ.get('GAME_ABANDON_MINUTES', '30'))
+    if _thread is not None or interval <= 0:
+        return
+    _stop = threading.Event()
+    if not hasattr(handler_module, 'settle_game'):
+        handler_module = None
+    _thread = threading.Thread(target=_loop, args=(handler_module, interval, abandon_minutes, _stop),
+                               name='game-sweeper', daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread, _stop
+    if _thread is None:
+        return
+    _stop.set()
+    _thread.join(timeout=5)
+    _thread = None
+    _stop = None
+
+
+def snapshot():
+    return dict(stats, running=_thread is not None)
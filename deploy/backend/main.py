@@ -2,7 +2,7 @@ import json
 import os
 import importlib
 import sys
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Request, Response, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI(title="LigaChess API")
@@ -17,6 +17,19 @@ app.add_middleware(
 
 sys.path.insert(0, os.path.dirname(__file__))
 
+import db_pool
+import dispatch
+import pg_notify
+import game_cache
+import game_channel
+import matchmaking_engine
+import matchmaking_tick
+import game_sweeper
+import decay_index
+import signal_mailbox
+import settings_cache
+import rating_simulator
+
 FUNCTION_MODULES = {
     "admin-auth": "functions.admin_auth",
     "admin-stats": "functions.admin_stats",
@@ -44,6 +57,44 @@ for name, module_path in FUNCTION_MODULES.items():
         print(f"[WARN] Failed to load {name}: {e}")
 
 
+@app.on_event("startup")
+def startup():
+    # Пул создаётся в каждом воркере uvicorn отдельно, после fork
+    db_pool.init_pool()
+    dispatch.init_pools(db_pool.stats()['max_size'])
+    pg_notify.start([pg_notify.GAME_CHANNEL, matchmaking_engine.QUEUE_CHANNEL, signal_mailbox.SIGNAL_CHANNEL,
+                     settings_cache.SETTINGS_CHANNEL])
+    signal_mailbox.start()
+    settings_cache.start()
+    # Кэш подписывается раньше сокетов: запись выбрасывается до того, как канал перечитает партию
+    game_cache.start()
+    if "online-move" in _loaded:
+        game_channel.start(_loaded["online-move"])
+    conn = db_pool.get_connection()
+    try:
+        matchmaking_engine.start(conn)
+    finally:
+        conn.close()
+    if "matchmaking" in _loaded:
+        matchmaking_tick.start(_loaded["matchmaking"])
+    game_sweeper.start(_loaded.get("online-move"))
+    decay_index.start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    decay_index.stop()
+    game_sweeper.stop()
+    matchmaking_tick.stop()
+    game_channel.stop()
+    game_cache.stop()
+    signal_mailbox.stop()
+    settings_cache.stop()
+    pg_notify.stop_listener()
+    dispatch.shutdown_pools()
+    db_pool.close_pool()
+
+
 class FakeContext:
     def __init__(self):
         self.request_id = "local"
@@ -91,7 +142,13 @@ async def proxy(func_name: str, request: Request, path: str = ""):
     ctx = FakeContext()
 
     try:
-        result = mod.handler(event, ctx)
+        result = await dispatch.run_handler(func_name, mod.handler, event, ctx)
+    except dispatch.QueueFull:
+        return Response(
+            content=json.dumps({"error": "Server busy, retry later"}),
+            status_code=503,
+            headers={"Content-Type": "application/json", "Access-Control-Allow-Origin": "*", "Retry-After": "1"},
+        )
     except Exception as e:
         return Response(
             content=json.dumps({"error": str(e)}),
@@ -102,6 +159,16 @@ async def proxy(func_name: str, request: Request, path: str = ""):
     return _make_response(result)
 
 
+@app.websocket("/ws/game/{game_id}")
+async def game_ws(websocket: WebSocket, game_id: int):
+    await game_channel.serve(websocket, game_id)
+
+
 @app.get("/health")
 async def health():
-    return {"status": "ok", "functions": list(_loaded.keys())}
+    return {"status": "ok", "functions": list(_loaded.keys()), "db_pool": db_pool.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {"handler_pools": dispatch.stats(), "db_pool": db_pool.stats(), "pg_notify": pg_notify.snapshot(), "game_ws": game_channel.snapshot(), "game_cache": game_cache.snapshot(), "signals": signal_mailbox.snapshot(), "settings_cache": settings_cache.snapshot(), "rating_simulator": rating_simulator.snapshot(), "matchmaking": matchmaking_engine.snapshot(), "matchmaking_tick": matchmaking_tick.snapshot(), "game_sweeper": game_sweeper.snapshot(), "decay_index": decay_index.snapshot()}
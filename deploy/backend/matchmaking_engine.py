@@ -0,0 +1,241 @@
+"""In-memory индекс очереди матчмейкинга для воркера шлюза.
+
+Очередь по-прежнему хранится в matchmaking_queue — это долговременная
+запись. Индекс держит живые заявки в отсортированных по рейтингу списках:
+по контролю времени, по (контроль, город), по (контроль, регион) и общий
+список для стадии «любой». Поиск ближайшего по рейтингу — bisect + обход
+в обе стороны, вместо ORDER BY ABS(rating - X), который не использует индекс.
+
+Воркеры синхронизируются через NOTIFY matchmaking_queue_events: каждое
+изменение очереди в matchmaking публикует событие, и все индексы его
+применяют. При старте индекс перестраивается из matchmaking_queue. После
+переподключения pg_notify события за время разрыва потеряны: индекс считается
+неготовым (поиск идёт через SQL), пока фоновый поток не перестроит его заново.
+"""
+import bisect
+import threading
+import time
+
+import db_pool
+import pg_notify
+
+QUEUE_CHANNEL = 'matchmaking_queue_events'
+LIVE_SECONDS = 10
+PURGE_SECONDS = 15
+SWEEP_INTERVAL = 5
+PURGE_INTERVAL = 5
+
+_lock = threading.RLock()
+_entries = {}
+_index = {}
+_ready = False
+_last_sweep = 0.0
+_last_purge = 0.0
+_reconnects_seen = 0
+_rebuilding = False
+stats = {'lookups': 0, 'events': 0, 'rebuilds': 0, 'rebuild_errors': 0}
+
+
+class Entry:
+    __slots__ = ('user_id', 'username', 'avatar', 'rating', 'time_control', 'city', 'region', 'seen_at')
+
+    def __init__(self, user_id, username, avatar, rating, time_control, city, region, seen_at):
+        self.user_id = user_id
+        self.username = username
+        self.avatar = avatar
+        self.rating = rating
+        self.time_control = time_control
+        self.city = city or ''
+        self.region = region or ''
+        self.seen_at = seen_at
+
+    def keys(self):
+        keys = [('all',), ('tc', self.time_control)]
+        if self.city:
+            keys.append(('city', self.time_control, self.city))
+        if self.region:
+            keys.append(('region', self.time_control, self.region))
+        return keys
+
+    def as_row(self):
+        return (self.user_id, self.username, self.avatar, self.rating, self.time_control)
+
+
+def _index_add(entry):
+    for key in entry.keys():
+        bisect.insort(_index.setdefault(key, []), (entry.rating, entry.user_id))
+
+
+def _index_remove(entry):
+    for key in entry.keys():
+        lst = _index.get(key)
+        if not lst:
+            continue
+        item = (entry.rating, entry.user_id)
+        i = bisect.bisect_left(lst, item)
+        if i < len(lst) and lst[i] == item:
+            del lst[i]
+        if not lst:
+            del _index[key]
+
+
+def _upsert(user_id, username, avatar, rating, time_control, city, region, seen_at):
+    with _lock:
+        old = _entries.pop(user_id, None)
+        if old is not None:
+            _index_remove(old)
+        entry = Entry(user_id, username, avatar, int(rating), time_control, city, region, seen_at)
+        _entries[user_id] = entry
+        _index_add(entry)
+
+
+def _remove(user_id):
+    with _lock:
+        old = _entries.pop(user_id, None)
+        if old is not None:
+            _index_remove(old)
+
+
+def apply_event(payload):
+    op = payload.get('op')
+    now = time.monotonic()
+    stats['events'] += 1
+    if op == 'join':
+        _upsert(payload['user_id'], payload.get('username', ''), payload.get('avatar', ''),
+                payload.get('rating', 1200), payload.get('time_control', ''),
+                payload.get('city', ''), payload.get('region', ''), now)
+    elif op == 'beat':
+        with _lock:
+            entry = _entries.get(payload.get('user_id'))
+            if entry is not None:
+                entry.seen_at = now
+    elif op == 'leave':
+        for uid in payload.get('user_ids') or []:
+            _remove(uid)
+
+
+def rebuild(conn):
+    """Полная перестройка индекса из matchmaking_queue (при старте воркера и после переподключения pg_notify)."""
+    global _ready, _reconnects_seen
+    # Счётчик запоминается до чтения: разрыв во время перестройки запустит следующую
+    reconnects = pg_notify.stats['reconnects']
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT user_id, username, avatar, rating, time_control, city, region,
+                  EXTRACT(EPOCH FROM (NOW() - last_heartbeat))
+        FROM matchmaking_queue WHERE last_heartbeat > NOW() - INTERVAL '%d seconds'""" % PURGE_SECONDS
+    )
+    rows = cur.fetchall()
+    cur.close()
+    conn.rollback()
+    now = time.monotonic()
+    with _lock:
+        _entries.clear()
+        _index.clear()
+        for r in rows:
+            _upsert(r[0], r[1], r[2] or '', r[3], r[4], r[5], r[6], now - float(r[7] or 0))
+        _reconnects_seen = reconnects
+        _ready = True
+    stats['rebuilds'] += 1
+
+
+def start(conn):
+    pg_notify.subscribe(QUEUE_CHANNEL, apply_event)
+    rebuild(conn)
+
+
+def _rebuild_async():
+    global _rebuilding
+    conn = None
+    try:
+        conn = db_pool.get_connection()
+        rebuild(conn)
+    except Exception as e:
+        stats['rebuild_errors'] += 1
+        print(f"[WARN] matchmaking index rebuild failed: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+        with _lock:
+            _rebuilding = False
+
+
+def is_ready():
+    global _rebuilding
+    if not _ready or not pg_notify.is_running():
+        return False
+    if pg_notify.stats['reconnects'] == _reconnects_seen:
+        return True
+    # Были разрывы LISTEN — join/leave могли потеряться, индекс перестраивается в фоне
+    with _lock:
+        if not _rebuilding:
+            _rebuilding = True
+            threading.Thread(target=_rebuild_async, name='matchmaking-rebuild', daemon=True).start()
+    return False
+
+
+def _purge(now):
+    """Удаляет заявки без heartbeat дольше PURGE_SECONDS; полный обход — не чаще раза в PURGE_INTERVAL.
+
+    Между чистками устаревшие заявки отсекает проверка LIVE_SECONDS в nearest().
+    """
+    global _last_purge
+    if now - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    dead = [uid for uid, e in _entries.items() if now - e.seen_at > PURGE_SECONDS]
+    for uid in dead:
+        _remove(uid)
+
+
+def nearest(key, rating, exclude, rating_min=None, rating_max=None, limit=5):
+    """До limit живых заявок из списка key, ближайших к rating."""
+    stats['lookups'] += 1
+    now = time.monotonic()
+    result = []
+    with _lock:
+        _purge(now)
+        lst = _index.get(key) or []
+        hi = bisect.bisect_left(lst, (rating, ''))
+        lo = hi - 1
+        while len(result) < limit and (lo >= 0 or hi < len(lst)):
+            take_hi = lo < 0 or (hi < len(lst) and lst[hi][0] - rating <= rating - lst[lo][0])
+            if take_hi:
+                r, uid = lst[hi]
+                hi += 1
+                if rating_max is not None and r > rating_max:
+                    hi = len(lst)
+                    continue
+            else:
+                r, uid = lst[lo]
+                lo -= 1
+                if rating_min is not None and r < rating_min:
+                    lo = -1
+                    continue
+            if uid in exclude:
+                continue
+            entry = _entries.get(uid)
+            if entry is not None and now - entry.seen_at <= LIVE_SECONDS:
+                result.append(entry.as_row())
+    return result
+
+
+def count(time_control):
+    with _lock:
+        return len(_index.get(('tc', time_control)) or [])
+
+
+def should_sweep():
+    """Чистка мёртвых строк в БД нужна не чаще раза в SWEEP_INTERVAL секунд на воркер."""
+    global _last_sweep
+    now = time.monotonic()
+    with _lock:
+        if now - _last_sweep < SWEEP_INTERVAL:
+            return False
+        _last_sweep = now
+        return True
+
+
+def snapshot():
+    with _lock:
+        return dict(stats, ready=_ready, entries=len(_entries), indexes=len(_index))
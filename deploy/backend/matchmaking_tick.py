@@ -0,0 +1,60 @@
+"""Фоновый тик пакетного подбора пар для матчмейкинга.
+
+Раз в MATCHMAKING_TICK_SECONDS (по умолчанию 1 с) поток вызывает
+run_pairing_tick() обработчика matchmaking: тот читает все живые заявки
+одним запросом, строит глобальные пары и создаёт партии. Тик запускается
+в каждом воркере, но advisory lock в БД пропускает за раз только один,
+поэтому проход по очереди один на весь кластер. Поиск по запросу клиента
+продолжает работать как раньше — тик лишь подбирает пары за него.
+"""
+import os
+import threading
+import time
+
+import db_pool
+
+_thread = None
+_stop = None
+stats = {'ticks': 0, 'games_created': 0, 'errors': 0, 'last_tick_ms': 0.0}
+
+
+def _loop(handler_module, interval, stop):
+    while not stop.wait(interval):
+        started = time.monotonic()
+        conn = None
+        try:
+            conn = db_pool.get_connection()
+            stats['games_created'] += handler_module.run_pairing_tick(conn)
+        except Exception as e:
+            stats['errors'] += 1
+            print(f"[WARN] matchmaking tick failed: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        stats['ticks'] += 1
+        stats['last_tick_ms'] = round((time.monotonic() - started) * 1000, 2)
+
+
+def start(handler_module):
+    global _thread, _stop
+    interval = float(os.environ.get('MATCHMAKING_TICK_SECONDS', '1'))
+    if _thread is not None or interval <= 0 or not hasattr(handler_module, 'run_pairing_tick'):
+        return
+    _stop = threading.Event()
+    _thread = threading.Thread(target=_loop, args=(handler_module, interval, _stop),
+                               name='matchmaking-tick', daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread, _stop
+    if _thread is None:
+        return
+    _stop.set()
+    _thread.join(timeout=5)
+    _thread = None
+    _stop = None
+
+
+def snapshot():
+    return dict(stats, running=_thread is not None)
@@ -0,0 +1,150 @@
+"""Приём PostgreSQL NOTIFY внутри воркера шлюза.
+
+Один фоновый поток держит отдельное autocommit-соединение с LISTEN на нужных
+каналах и раздаёт события подписчикам. Так сотни ожидающих long-poll
+запросов не держат по соединению с БД: они ждут threading.Event, который
+будит этот поток. Полезная нагрузка уведомлений — JSON-объект.
+"""
+import json
+import os
+import select
+import threading
+import time
+
+import psycopg2
+
+GAME_CHANNEL = 'online_game_events'
+
+_lock = threading.Lock()
+_subscribers = {}
+_next_token = 0
+_listener = None
+_channels = set()
+stats = {'received': 0, 'reconnects': 0, 'connected': False}
+
+
+def subscribe(channel, callback):
+    """callback(payload: dict) вызывается из потока слушателя — он должен быть быстрым."""
+    global _next_token
+    with _lock:
+        _next_token += 1
+        token = _next_token
+        _subscribers.setdefault(channel, {})[token] = callback
+    return (channel, token)
+
+
+def unsubscribe(sub):
+    channel, token = sub
+    with _lock:
+        subs = _subscribers.get(channel)
+        if subs:
+            subs.pop(token, None)
+
+
+class Watch:
+    """Подписка на события одной партии. Создаётся до проверки состояния в БД,
+    чтобы уведомление между проверкой и ожиданием не потерялось."""
+
+    def __init__(self, channel, key):
+        self.key = key
+        self._fired = threading.Event()
+        self._sub = subscribe(channel, self._on_event)
+
+    def _on_event(self, payload):
+        if payload.get('game_id') == self.key:
+            self._fired.set()
+
+    def wait(self, timeout):
+        return self._fired.wait(timeout)
+
+    def close(self):
+        if self._sub is not None:
+            unsubscribe(self._sub)
+            self._sub = None
+
+
+def watch(channel, key):
+    """Возвращает Watch или None, если слушатель в этом процессе не запущен."""
+    if not is_running():
+        return None
+    return Watch(channel, key)
+
+
+def is_running():
+    return _listener is not None and stats['connected']
+
+
+def _dispatch(channel, raw_payload):
+    try:
+        payload = json.loads(raw_payload) if raw_payload else {}
+    except ValueError:
+        return
+    with _lock:
+        callbacks = list((_subscribers.get(channel) or {}).values())
+    stats['received'] += 1
+    for cb in callbacks:
+        try:
+            cb(payload)
+        except Exception as e:
+            print(f"[WARN] pg_notify subscriber failed: {e}")
+
+
+def _listen_loop(dsn, stop):
+    while not stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.autocommit = True
+            cur = conn.cursor()
+            for channel in sorted(_channels):
+                cur.execute('LISTEN %s' % channel)
+            stats['connected'] = True
+            while not stop.is_set():
+                if select.select([conn], [], [], 5.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    _dispatch(n.channel, n.payload)
+        except Exception as e:
+            print(f"[WARN] pg_notify listener error: {e}")
+        finally:
+            stats['connected'] = False
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        if not stop.is_set():
+            stats['reconnects'] += 1
+            time.sleep(1.0)
+
+
+def start(channels, dsn=None):
+    global _listener
+    if _listener is not None:
+        return
+    _channels.update(channels)
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_listen_loop, args=(dsn or os.environ['DATABASE_URL'], stop),
+        name='pg-notify', daemon=True,
+    )
+    _listener = (thread, stop)
+    thread.start()
+
+
+def stop_listener():
+    global _listener
+    if _listener is None:
+        return
+    thread, stop = _listener
+    stop.set()
+    thread.join(timeout=6)
+    _listener = None
+
+
+def snapshot():
+    with _lock:
+        subs = sum(len(s) for s in _subscribers.values())
+    return dict(stats, subscribers=subs, channels=sorted(_channels))
@@ -0,0 +1,188 @@
+"""Оценка новых настроек рейтинга до сохранения («что будет, если»).
+
+Берёт текущие рейтинги всех игроков и партии game_history за последние
+days дней и проигрывает эти дни дважды вперёд от текущих рейтингов: с
+действующими настройками и с предложенными. Правила те же, что в
+finish-game (движок rating_engine, ограничение min_rating) и у ежедневного
+снижения (кто не играл в этот день, теряет daily_decay, но не ниже
+min_rating). Сравниваются два прогноза, а не прогноз с настоящим: так
+разница показывает только эффект настроек, а не саму активность за период.
+
+Загрузка из БД — самая дорогая часть, поэтому снимок массивов живёт в памяти
+воркера SNAPSHOT_TTL секунд: повторные прогоны с другими числами в админке
+работают только в numpy.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import rating_engine
+import rating_replay
+
+MSK = timezone(timedelta(hours=3))
+SNAPSHOT_TTL = float(os.environ.get('RATING_SIM_CACHE_TTL', '120'))
+MAX_DAYS = 90
+LEADERBOARD_SIZE = 50
+HISTOGRAM_STEP = 50
+
+_lock = threading.Lock()
+_snapshots = {}      # (days, daily_decay, min_rating) -> Snapshot
+stats = {'runs': 0, 'loads': 0, 'last_load_ms': 0, 'last_run_ms': 0}
+
+
+class Snapshot:
+    """Игроки (в порядке users.id) и партии окна в виде массивов."""
+
+    def __init__(self, days, rating, games_played, rd, volatility, user_idx, day, opponent_rating, score):
+        self.loaded_at = time.monotonic()
+        self.days = days
+        self.rating = rating
+        self.games_played = games_played
+        self.rd = rd
+        self.volatility = volatility
+        self.user_idx = user_idx
+        self.opponent_rating = opponent_rating
+        self.score = score
+        # Партии отсортированы по времени, значит дни идут подряд: границы дней
+        self.day_bounds = np.searchsorted(day, np.arange(days + 1))
+
+
+def _column(rows, i, dtype):
+    return np.fromiter((r[i] if r[i] is not None else np.nan for r in rows), dtype=dtype, count=len(rows))
+
+
+def load(cur, days, decay, min_rating):
+    today = datetime.now(MSK).date()
+    start = (today - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    # Рейтинг — с накопленным снижением по decay_anchor_date, как его видят игроки
+    cur.execute(
+        "SELECT CASE WHEN rating > %d THEN GREATEST(rating - %d * GREATEST(DATE '%s' - decay_anchor_date, 0), %d) ELSE rating END, "
+        "games_played, rating_deviation, rating_volatility FROM users ORDER BY id"
+        % (min_rating, decay, today.strftime('%Y-%m-%d'), min_rating)
+    )
+    users = cur.fetchall()
+    # Номер игрока считается в БД, чтобы не строить словарь id -> индекс на миллион строк
+    cur.execute(
+        """WITH u AS (SELECT id, (ROW_NUMBER() OVER (ORDER BY id) - 1)::int AS idx FROM users)
+        SELECT u.idx, (g.created_at::date - DATE '%s')::int, g.opponent_rating,
+               CASE g.result WHEN 'win' THEN 1.0 WHEN 'draw' THEN 0.5 ELSE 0.0 END
+        FROM game_history g JOIN u ON u.id = g.user_id
+        WHERE g.created_at >= TIMESTAMP '%s 00:00:00' AND g.result IN ('win', 'loss', 'draw')
+        ORDER BY g.created_at, g.id"""
+        % (start, start)
+    )
+    games = cur.fetchall()
+    day = _column(games, 1, np.int64)
+    # Партии «из будущего» (часы БД впереди МСК) считаются сегодняшними
+    np.minimum(day, days - 1, out=day)
+    return Snapshot(
+        days,
+        _column(users, 0, np.float64), _column(users, 1, np.float64).astype(np.int64),
+        _column(users, 2, np.float64), _column(users, 3, np.float64),
+        _column(games, 0, np.int64), day, _column(games, 2, np.float64), _column(games, 3, np.float64),
+    )
+
+
+def get_snapshot(cur, days, settings):
+    key = (days, abs(rating_engine.setting(settings, 'daily_decay', 1)), rating_engine.setting(settings, 'min_rating', 500))
+    now = time.monotonic()
+    with _lock:
+        snapshot = _snapshots.get(key)
+        if snapshot is not None and now - snapshot.loaded_at <= SNAPSHOT_TTL:
+            return snapshot, False
+    started = time.monotonic()
+    snapshot = load(cur, *key)
+    stats['loads'] += 1
+    stats['last_load_ms'] = int((time.monotonic() - started) * 1000)
+    with _lock:
+        _snapshots.clear()
+        _snapshots[key] = snapshot
+    return snapshot, True
+
+
+def run(snapshot, settings):
+    """Рейтинги всех игроков после проигрывания окна с настройками settings."""
+    engine = rating_engine.get_engine(settings)
+    min_rating = rating_engine.setting(settings, 'min_rating', 500)
+    decay = abs(rating_engine.setting(settings, 'daily_decay', 1))
+    state = rating_replay.new_state(engine, snapshot.rating, snapshot.games_played, snapshot.rd, snapshot.volatility)
+    played = np.zeros(len(snapshot.rating), dtype=bool)
+    for d in range(snapshot.days):
+        lo, hi = snapshot.day_bounds[d], snapshot.day_bounds[d + 1]
+        user_idx = snapshot.user_idx[lo:hi]
+        rating_replay.advance(state, engine, user_idx, snapshot.opponent_rating[lo:hi], snapshot.score[lo:hi],
+                              min_rating)
+        if decay:
+            played[:] = False
+            played[user_idx] = True
+            rating = state['rating']
+            inactive = ~played & (rating > min_rating)
+            rating[inactive] = np.maximum(rating[inactive] - decay, min_rating)
+    return state['rating'].astype(np.int64), min_rating
+
+
+def top(ratings, size):
+    """Индексы первых size игроков по убыванию рейтинга (при равенстве — по users.id, как в снимке)."""
+    size = min(size, len(ratings))
+    if size == 0:
+        return np.empty(0, dtype=np.int64)
+    head = np.argpartition(-ratings, size - 1)[:size]
+    return head[np.lexsort((head, -ratings[head]))]
+
+
+def summary(ratings, min_rating, edges):
+    counts, _ = np.histogram(ratings, bins=edges)
+    return {
+        'histogram': counts.tolist(),
+        'pinned_at_min': int(np.count_nonzero(ratings <= min_rating)),
+        'mean': round(float(ratings.mean()), 1) if len(ratings) else None,
+        'median': int(np.median(ratings)) if len(ratings) else None,
+    }
+
+
+def compare(cur, current_settings, proposed, days=7):
+    """Прогноз для действующих настроек и для current_settings, обновлённых proposed."""
+    days = max(1, min(int(days), MAX_DAYS))
+    snapshot, loaded = get_snapshot(cur, days, current_settings)
+    started = time.monotonic()
+    baseline, base_min = run(snapshot, current_settings)
+    proposal, new_min = run(snapshot, dict(current_settings, **proposed))
+
+    low = min(base_min, new_min)
+    high = int(max(baseline.max(initial=low), proposal.max(initial=low))) + 1
+    edges = np.arange(low - low % HISTOGRAM_STEP, high + HISTOGRAM_STEP, HISTOGRAM_STEP)
+
+    base_top = top(baseline, LEADERBOARD_SIZE)
+    new_top = top(proposal, LEADERBOARD_SIZE)
+    base_rank = {int(u): i for i, u in enumerate(base_top)}
+    shifts = [abs(i - base_rank[int(u)]) for i, u in enumerate(new_top) if int(u) in base_rank]
+    elapsed = int((time.monotonic() - started) * 1000)
+    stats['runs'] += 1
+    stats['last_run_ms'] = elapsed
+    changed = proposal != baseline
+    return {
+        'days': days,
+        'users': len(snapshot.rating),
+        'games': len(snapshot.score),
+        'histogram_edges': edges.tolist(),
+        'current': summary(baseline, base_min, edges),
+        'proposed': summary(proposal, new_min, edges),
+        'changed_users': int(np.count_nonzero(changed)),
+        'mean_change': round(float((proposal - baseline).mean()), 1) if len(proposal) else 0,
+        'leaderboard': {
+            'size': len(new_top),
+            'entered': len(new_top) - len(shifts),
+            'mean_rank_shift': round(sum(shifts) / len(shifts), 2) if shifts else 0,
+        },
+        'elapsed_ms': elapsed,
+        'snapshot_loaded': loaded,
+    }
+
+
+def snapshot():
+    with _lock:
+        cached = {key[0]: len(s.rating) for key, s in _snapshots.items()}
+    return dict(stats, cached=cached)
@@ -0,0 +1,119 @@
+"""Кэш таблиц настроек (rating_settings, site_settings) в памяти воркера шлюза.
+
+Настройки меняются раз в месяц, а читаются на каждую завершённую партию.
+Таблица читается целиком курсором вызывающего обработчика при промахе,
+дальше отдаётся из памяти: строки (key, value, description) для API настроек
+и словарь key -> значение с числами, уже приведёнными к int/float.
+
+PUT в rating-settings / site-settings и запись last_decay_date отправляют
+NOTIFY settings_events {"table": ...} — все воркеры сбрасывают таблицу.
+TTL_SECONDS — страховка на случай потерянного уведомления. Без слушателя
+NOTIFY кэш не используется, после его переподключения очищается.
+"""
+import os
+import threading
+import time
+
+import pg_notify
+
+SETTINGS_CHANNEL = 'settings_events'
+TTL_SECONDS = float(os.environ.get('SETTINGS_CACHE_TTL', '300'))
+TABLES = {
+    'rating_settings': "SELECT key, value, description FROM rating_settings ORDER BY id",
+    'site_settings': "SELECT key, value, description FROM site_settings ORDER BY key",
+}
+
+_lock = threading.Lock()
+_tables = {}         # table -> (loaded_at, rows, values)
+_generations = {}    # table -> число сбросов; загрузка, начатая до сброса, не кладётся в кэш
+_sub = None
+_reconnects_seen = 0
+stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def parse_value(value):
+    """'25' -> 25, '1.5' -> 1.5, остальное — строкой."""
+    if value is None:
+        return None
+    text = str(value).strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return value
+
+
+def invalidate(table=None):
+    with _lock:
+        for name in ([table] if table else list(TABLES)):
+            _generations[name] = _generations.get(name, 0) + 1
+            if _tables.pop(name, None) is not None:
+                stats['invalidations'] += 1
+
+
+def _on_notify(payload):
+    invalidate(payload.get('table') or None)
+
+
+def start():
+    global _sub
+    if _sub is None:
+        _sub = pg_notify.subscribe(SETTINGS_CHANNEL, _on_notify)
+
+
+def stop():
+    global _sub
+    if _sub is not None:
+        pg_notify.unsubscribe(_sub)
+        _sub = None
+    invalidate()
+
+
+def is_ready():
+    global _reconnects_seen
+    if _sub is None or not pg_notify.is_running():
+        return False
+    reconnects = pg_notify.stats['reconnects']
+    if reconnects != _reconnects_seen:
+        invalidate()
+        _reconnects_seen = reconnects
+    return True
+
+
+def _load(cur, table):
+    ready = is_ready()
+    now = time.monotonic()
+    with _lock:
+        entry = _tables.get(table)
+        if ready and entry is not None and now - entry[0] <= TTL_SECONDS:
+            stats['hits'] += 1
+            return entry
+        stats['misses'] += 1
+        generation = _generations.get(table, 0)
+    cur.execute(TABLES[table])
+    rows = cur.fetchall()
+    entry = (now, rows, {r[0]: parse_value(r[1]) for r in rows})
+    if ready:
+        with _lock:
+            if _generations.get(table, 0) == generation:
+                _tables[table] = entry
+    return entry
+
+
+def rows(cur, table):
+    """Строки (key, value, description) таблицы в порядке API настроек."""
+    return _load(cur, table)[1]
+
+
+def values(cur, table):
+    """Копия словаря key -> типизированное значение."""
+    return dict(_load(cur, table)[2])
+
+
+def snapshot():
+    with _lock:
+        cached = sorted(_tables)
+    return dict(stats, tables=cached, ready=_sub is not None and pg_notify.is_running())
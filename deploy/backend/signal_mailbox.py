@@ -0,0 +1,133 @@
+"""Почтовые ящики WebRTC-сигналов (SDP/ICE) в памяти воркера шлюза.
+
+Сигналы живут секунды, поэтому таблица webrtc_signals им не нужна. online-move
+POST action=signal публикует сигнал в NOTIFY game_signal_events, и каждый
+воркер кладёт его в ящик (партия, получатель). GET получателя забирает
+содержимое ящика на том воркере, куда пришёл, и публикует op=drained с
+идентификаторами — остальные воркеры выбрасывают свои копии.
+
+Сигнал, не влезающий в NOTIFY (больше ~8 КБ), пишется в webrtc_signals, а в
+ящик попадает только ссылка ref на строку: её забирает DELETE ... RETURNING
+того, кто читает ящик. Сигналы старше TTL_SECONDS выбрасываются.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pg_notify
+
+SIGNAL_CHANNEL = 'game_signal_events'
+TTL_SECONDS = float(os.environ.get('SIGNAL_TTL', '60'))
+MAX_PER_BOX = 200
+PURGE_INTERVAL = 10
+
+_lock = threading.Lock()
+_boxes = {}      # (game_id, user_id) -> OrderedDict id -> (expires_at, signal)
+_sub = None
+_last_purge = 0.0
+stats = {'relayed': 0, 'delivered': 0, 'dropped': 0, 'expired': 0}
+
+
+def _expire(key, box, now):
+    while box:
+        sid, (expires_at, _) = next(iter(box.items()))
+        if expires_at > now:
+            break
+        del box[sid]
+        stats['expired'] += 1
+    if not box:
+        _boxes.pop(key, None)
+
+
+def _purge(now):
+    global _last_purge
+    if now - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    for key, box in list(_boxes.items()):
+        _expire(key, box, now)
+
+
+def _on_notify(payload):
+    key = (payload.get('game_id'), payload.get('to'))
+    sid = payload.get('id')
+    op = payload.get('op')
+    now = time.monotonic()
+    with _lock:
+        if op == 'put' and sid:
+            if 'ref' in payload:
+                signal = {'ref': payload['ref']}
+            else:
+                signal = {'from': payload.get('from'), 'type': payload.get('type'), 'data': payload.get('data')}
+            box = _boxes.setdefault(key, OrderedDict())
+            box[sid] = (now + TTL_SECONDS, signal)
+            while len(box) > MAX_PER_BOX:
+                box.popitem(last=False)
+                stats['expired'] += 1
+            stats['relayed'] += 1
+            _purge(now)
+        elif op == 'drained':
+            box = _boxes.get(key)
+            if box is None:
+                return
+            for sid in payload.get('ids') or []:
+                if box.pop(sid, None) is not None:
+                    stats['dropped'] += 1
+            if not box:
+                del _boxes[key]
+
+
+def start():
+    global _sub
+    if _sub is None:
+        _sub = pg_notify.subscribe(SIGNAL_CHANNEL, _on_notify)
+
+
+def stop():
+    global _sub
+    if _sub is not None:
+        pg_notify.unsubscribe(_sub)
+        _sub = None
+    with _lock:
+        _boxes.clear()
+
+
+def is_ready():
+    return _sub is not None and pg_notify.is_running()
+
+
+def has_pending(game_id, user_id):
+    key = (game_id, user_id)
+    with _lock:
+        box = _boxes.get(key)
+        if box is None:
+            return False
+        _expire(key, box, time.monotonic())
+        return key in _boxes
+
+
+def drain(game_id, user_id, limit=20):
+    """До limit сигналов получателя в порядке отправки: [(id, signal), ...].
+    signal — {'from', 'type', 'data'} или {'ref': id строки webrtc_signals}."""
+    key = (game_id, user_id)
+    with _lock:
+        box = _boxes.get(key)
+        if box is None:
+            return []
+        _expire(key, box, time.monotonic())
+        result = []
+        while box and len(result) < limit:
+            sid, (_, signal) = box.popitem(last=False)
+            result.append((sid, signal))
+        if not box:
+            _boxes.pop(key, None)
+    stats['delivered'] += len(result)
+    return result
+
+
+def snapshot():
+    with _lock:
+        pending = sum(len(box) for box in _boxes.values())
+        boxes = len(_boxes)
+    return dict(stats, boxes=boxes, pending=pending, ready=is_ready())
@@ -16,7 +16,10 @@ CREATE TABLE IF NOT EXISTS users (
     city VARCHAR(200),
     last_online TIMESTAMP DEFAULT NOW(),
     user_code VARCHAR(20),
-    active_device_token VARCHAR(64)
+    active_device_token VARCHAR(64),
+    rating_deviation REAL,
+    rating_volatility REAL,
+    decay_anchor_date DATE NOT NULL DEFAULT (NOW() AT TIME ZONE 'Europe/Moscow')::date
 );
 
 CREATE TABLE IF NOT EXISTS admins (
@@ -52,8 +55,11 @@ CREATE TABLE IF NOT EXISTS game_history (
     duration_seconds INTEGER,
     end_reason VARCHAR(30) NOT NULL DEFAULT 'checkmate',
     created_at TIMESTAMP DEFAULT NOW(),
-    move_times TEXT
+    move_times TEXT,
+    client_game_id VARCHAR(64)
 );
+CREATE UNIQUE INDEX IF NOT EXISTS idx_game_history_user_client_game ON game_history (user_id, client_game_id) WHERE client_game_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_game_history_user_created ON game_history (user_id, created_at);
 
 CREATE TABLE IF NOT EXISTS online_games (
     id SERIAL PRIMARY KEY,
@@ -67,7 +73,7 @@ CREATE TABLE IF NOT EXISTS online_games (
     black_rating INTEGER NOT NULL DEFAULT 1200,
     time_control VARCHAR(20) NOT NULL,
     opponent_type VARCHAR(20) NOT NULL,
-    board_state TEXT NOT NULL DEFAULT 'initial',
+    board_state TEXT NOT NULL DEFAULT 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
     current_player VARCHAR(5) NOT NULL DEFAULT 'white',
     white_time INTEGER NOT NULL DEFAULT 600,
     black_time INTEGER NOT NULL DEFAULT 600,
@@ -82,10 +88,29 @@ CREATE TABLE IF NOT EXISTS online_games (
     rematch_offered_by VARCHAR(64),
     rematch_status VARCHAR(20),
     rematch_game_id INTEGER,
+    rematch_of INTEGER,
     move_number INTEGER NOT NULL DEFAULT 0,
-    rematch_offered_at TIMESTAMP
+    rematch_offered_at TIMESTAMP,
+    white_clock_ms INTEGER,
+    black_clock_ms INTEGER,
+    white_rating_after INTEGER,
+    white_rating_change INTEGER,
+    black_rating_after INTEGER,
+    black_rating_change INTEGER
 );
 
+CREATE TABLE IF NOT EXISTS online_game_moves (
+    game_id INTEGER NOT NULL,
+    ply INTEGER NOT NULL,
+    move VARCHAR(16) NOT NULL,
+    clock_ms INTEGER,
+    position_hash BIGINT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (game_id, ply)
+);
+
+CREATE INDEX IF NOT EXISTS idx_online_game_moves_hash ON online_game_moves (game_id, position_hash);
+
 CREATE TABLE IF NOT EXISTS matchmaking_queue (
     id SERIAL PRIMARY KEY,
     user_id VARCHAR(64) NOT NULL,
@@ -96,7 +121,9 @@ CREATE TABLE IF NOT EXISTS matchmaking_queue (
     time_control VARCHAR(20) NOT NULL,
     created_at TIMESTAMP DEFAULT NOW(),
     city VARCHAR(200) DEFAULT '',
-    region VARCHAR(200) DEFAULT ''
+    region VARCHAR(200) DEFAULT '',
+    last_heartbeat TIMESTAMP DEFAULT NOW(),
+    search_stage VARCHAR(20) DEFAULT 'city'
 );
 
 CREATE TABLE IF NOT EXISTS friends (
@@ -149,6 +176,18 @@ CREATE TABLE IF NOT EXISTS rating_settings (
     updated_at TIMESTAMP DEFAULT NOW()
 );
 
+CREATE TABLE IF NOT EXISTS rating_decay_runs (
+    run_date DATE PRIMARY KEY,
+    decay INTEGER NOT NULL,
+    min_rating INTEGER NOT NULL,
+    last_user_id VARCHAR(64) NOT NULL DEFAULT '',
+    scanned INTEGER NOT NULL DEFAULT 0,
+    affected INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+
 CREATE TABLE IF NOT EXISTS site_settings (
     id SERIAL PRIMARY KEY,
     key VARCHAR(100) NOT NULL,
@@ -167,6 +206,8 @@ CREATE TABLE IF NOT EXISTS webrtc_signals (
     consumed BOOLEAN NOT NULL DEFAULT FALSE,
     created_at TIMESTAMP DEFAULT NOW()
 );
+CREATE INDEX IF NOT EXISTS idx_webrtc_signals_game_to_id ON webrtc_signals (game_id, to_user_id, id);
+CREATE INDEX IF NOT EXISTS idx_webrtc_signals_created ON webrtc_signals (created_at);
 
 -- Default rating settings
 INSERT INTO rating_settings (key, value, description) VALUES
@@ -177,9 +218,27 @@ INSERT INTO rating_settings (key, value, description) VALUES
     ('initial_rating', '500', 'Начальный рейтинг нового игрока'),
     ('rating_principles', 'Рейтинг определяется на основе результатов партий. За победу начисляются баллы, за поражение — снимаются. Ничья дает небольшой бонус обоим игрокам.', 'Текстовое описание принципов рейтинга'),
     ('min_rating', '500', 'Минимальный рейтинг (ниже не опускается)'),
-    ('last_decay_date', '2000-01-01', 'Дата последнего ежедневного списания рейтинга (YYYY-MM-DD)')
+    ('last_decay_date', '2000-01-01', 'Дата последнего ежедневного списания рейтинга (YYYY-MM-DD)'),
+    ('rating_engine', 'fixed', 'Формула рейтинга: fixed (фиксированные баллы), elo или glicko2'),
+    ('elo_k', '20', 'Elo: коэффициент K'),
+    ('elo_k_provisional', '40', 'Elo: K для новичков'),
+    ('elo_provisional_games', '30', 'Elo: сколько первых партий игрок считается новичком'),
+    ('elo_k_master', '10', 'Elo: K для сильных игроков'),
+    ('elo_master_rating', '2400', 'Elo: рейтинг, с которого действует K для сильных игроков'),
+    ('glicko_tau', '0.5', 'Glicko-2: τ, ограничение изменения волатильности')
 ON CONFLICT DO NOTHING;
 
+-- Ключ сортировки leaderboard с текущим daily_decay; при его смене индекс пересоздаёт фоновый поток шлюза (decay_index.py)
+DO $$
+DECLARE
+    decay INTEGER := COALESCE((SELECT ABS(value::int) FROM rating_settings WHERE key = 'daily_decay' LIMIT 1), 1);
+BEGIN
+    IF decay > 0 THEN
+        EXECUTE format('CREATE INDEX IF NOT EXISTS idx_users_decayed_rating ON users ((rating + %s * (decay_anchor_date - DATE %L)) DESC)', decay, '2000-01-01');
+        EXECUTE format('COMMENT ON INDEX idx_users_decayed_rating IS %L', 'daily_decay=' || decay);
+    END IF;
+END $$;
+
 -- Default site settings
 INSERT INTO site_settings (key, value, description) VALUES
     ('btn_play_online', 'true', 'Видимость кнопки Играть онлайн'),
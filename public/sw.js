@@ -83,17 +83,34 @@ async function flushPendingResults() {
   let results = await existing.json();
   if (!results.length) return;
 
-  const remaining = [];
+  // Результаты одного игрока уходят пакетами: finish-game принимает до 50 партий за запрос
+  const batches = new Map();
   for (const r of results) {
-    try {
-      const res = await fetch(r.url, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(r.body)
-      });
-      if (!res.ok) remaining.push(r);
-    } catch {
-      remaining.push(r);
+    const key = r.url + '|' + (r.body && r.body.user_id);
+    if (!batches.has(key)) batches.set(key, []);
+    batches.get(key).push(r);
+  }
+
+  const remaining = [];
+  for (const group of batches.values()) {
+    for (let i = 0; i < group.length; i += 50) {
+      const chunk = group.slice(i, i + 50);
+      const first = chunk[0].body || {};
+      try {
+        const res = await fetch(chunk[0].url, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({
+            user_id: first.user_id,
+            username: first.username,
+            avatar: first.avatar,
+            games: chunk.map((r) => r.body)
+          })
+        });
+        if (!res.ok) remaining.push(...chunk);
+      } catch {
+        remaining.push(...chunk);
+      }
     }
   }
 
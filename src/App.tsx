@@ -5,25 +5,12 @@ import Index from "./pages/Index";
 import AuthGuard from "./components/AuthGuard";
 import GameInviteNotification from "./components/GameInviteNotification";
 import Icon from "@/components/ui/icon";
-import API from "@/config/api";
 
 const Game = lazy(() => import("./pages/Game"));
 const OnlineGame = lazy(() => import("./pages/OnlineGame"));
 const Admin = lazy(() => import("./pages/Admin"));
 const NotFound = lazy(() => import("./pages/NotFound"));
 
-const DailyDecayTrigger = () => {
-  useEffect(() => {
-    const lastRun = localStorage.getItem('daily_decay_last');
-    const today = new Date().toDateString();
-    if (lastRun === today) return;
-    fetch(API.applyDailyDecay, { method: 'POST' })
-      .then(() => localStorage.setItem('daily_decay_last', today))
-      .catch(() => {});
-  }, []);
-  return null;
-};
-
 const Loading = () => (
   <div className="min-h-screen flex items-center justify-center bg-gradient-to-br from-stone-800 via-stone-900 to-stone-950">
     <div className="animate-spin w-8 h-8 border-4 border-amber-400 border-t-transparent rounded-full" />
@@ -69,7 +56,6 @@ const LandscapeBlocker = () => {
 const App = () => (
   <>
     <LandscapeBlocker />
-    <DailyDecayTrigger />
     <BrowserRouter>
       <GameInviteNotification />
       <Suspense fallback={<Loading />}>
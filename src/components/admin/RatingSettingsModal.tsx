@@ -1,6 +1,6 @@
 import { useState } from 'react';
 import Icon from '@/components/ui/icon';
-import type { RatingSettings } from '@/pages/Admin';
+import type { RatingSettings, RatingSimulation } from '@/pages/Admin';
 
 const noSpinnerStyle = `
   .no-spinner::-webkit-outer-spin-button,
@@ -16,10 +16,11 @@ const noSpinnerStyle = `
 interface Props {
   settings: RatingSettings;
   onSave: (updated: Record<string, { value: string }>) => Promise<void>;
+  onSimulate: (updated: Record<string, { value: string }>) => Promise<RatingSimulation | null>;
   onClose: () => void;
 }
 
-export const RatingSettingsModal = ({ settings, onSave, onClose }: Props) => {
+export const RatingSettingsModal = ({ settings, onSave, onSimulate, onClose }: Props) => {
   const [winPoints, setWinPoints] = useState(settings.win_points.value);
   const [lossPoints, setLossPoints] = useState(settings.loss_points.value);
   const [drawPoints, setDrawPoints] = useState(settings.draw_points.value);
@@ -28,6 +29,8 @@ export const RatingSettingsModal = ({ settings, onSave, onClose }: Props) => {
   const [minRating, setMinRating] = useState(settings.min_rating.value);
   const [principles, setPrinciples] = useState(settings.rating_principles.value);
   const [saving, setSaving] = useState(false);
+  const [simulating, setSimulating] = useState(false);
+  const [simulation, setSimulation] = useState<RatingSimulation | null>(null);
 
   const handleSave = async () => {
     setSaving(true);
@@ -43,6 +46,19 @@ export const RatingSettingsModal = ({ settings, onSave, onClose }: Props) => {
     setSaving(false);
   };
 
+  const handleSimulate = async () => {
+    setSimulating(true);
+    setSimulation(await onSimulate({
+      win_points: { value: winPoints },
+      loss_points: { value: lossPoints },
+      draw_points: { value: drawPoints },
+      daily_decay: { value: dailyDecay },
+      initial_rating: { value: initialRating },
+      min_rating: { value: minRating }
+    }));
+    setSimulating(false);
+  };
+
   const fields = [
     { label: 'Баллы за победу', value: winPoints, onChange: setWinPoints, icon: 'Plus', color: 'text-green-400' },
     { label: 'Баллы за поражение', value: lossPoints, onChange: setLossPoints, icon: 'Minus', color: 'text-red-400' },
@@ -87,6 +103,25 @@ export const RatingSettingsModal = ({ settings, onSave, onClose }: Props) => {
             ))}
           </div>
 
+          <div className="bg-slate-700/40 rounded-xl p-3 border border-slate-600/30 space-y-2">
+            <button
+              onClick={handleSimulate}
+              disabled={simulating}
+              className="w-full py-2 rounded-lg bg-slate-600/50 text-slate-200 hover:bg-slate-600 transition-colors text-sm font-medium disabled:opacity-50"
+            >
+              {simulating ? 'Расчёт...' : 'Проверить на последних 7 днях'}
+            </button>
+            {simulation && (
+              <div className="text-xs text-slate-300 space-y-1">
+                <div>Игроков: {simulation.users}, партий: {simulation.games}, расчёт {simulation.elapsed_ms} мс</div>
+                <div>Рейтинг изменится у {simulation.changed_users}, в среднем на {simulation.mean_change}</div>
+                <div>На минимальном рейтинге: {simulation.current.pinned_at_min} → {simulation.proposed.pinned_at_min}</div>
+                <div>Медиана: {simulation.current.median ?? '—'} → {simulation.proposed.median ?? '—'}</div>
+                <div>Новых в топ-{simulation.leaderboard.size}: {simulation.leaderboard.entered}, средний сдвиг места {simulation.leaderboard.mean_rank_shift}</div>
+              </div>
+            )}
+          </div>
+
           <div>
             <div className="flex items-center gap-2 mb-2">
               <Icon name="FileText" size={16} className="text-slate-400" />
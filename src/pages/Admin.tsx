@@ -23,6 +23,18 @@ export interface RatingSettings {
   rating_principles: { value: string; description: string };
 }
 
+export interface RatingSimulation {
+  users: number;
+  games: number;
+  days: number;
+  changed_users: number;
+  mean_change: number;
+  current: { pinned_at_min: number; median: number | null };
+  proposed: { pinned_at_min: number; median: number | null };
+  leaderboard: { size: number; entered: number; mean_rank_shift: number };
+  elapsed_ms: number;
+}
+
 export interface SiteSettings {
   [key: string]: { value: string; description: string };
 }
@@ -87,6 +99,20 @@ const AdminPanel = ({ adminEmail, onLogout }: { adminEmail: string; onLogout: ()
     setShowRatingModal(false);
   };
 
+  const handleRatingSimulate = async (updated: Record<string, { value: string }>): Promise<RatingSimulation | null> => {
+    try {
+      const res = await fetch(API_URL, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ action: 'simulate', admin_email: adminEmail, settings: updated, days: 7 })
+      });
+      if (!res.ok) return null;
+      return await res.json();
+    } catch {
+      return null;
+    }
+  };
+
   const handleSiteSave = async (updated: Record<string, { value: string }>) => {
     await fetch(SITE_SETTINGS_URL, {
       method: 'PUT',
@@ -237,6 +263,7 @@ const AdminPanel = ({ adminEmail, onLogout }: { adminEmail: string; onLogout: ()
         <RatingSettingsModal
           settings={settings}
           onSave={handleRatingSave}
+          onSimulate={handleRatingSimulate}
           onClose={() => setShowRatingModal(false)}
         />
       )}
@@ -200,6 +200,7 @@ export const useGameLogic = (
   const serverMoveNumberRef = useRef(0);
   const pendingMoveRef = useRef<string | null>(null);
   const gameEndProcessedRef = useRef(false);
+  const serverRatedRef = useRef(false);
   const audioCtxRef = useRef<AudioContext | null>(null);
 
   const myUserId = useMemo(() => {
@@ -646,6 +647,21 @@ export const useGameLogic = (
           );
         }
 
+        if (data.game.is_bot_game === false) serverRatedRef.current = true;
+        if (data.game.status === 'finished' && serverRatedRef.current) {
+          const side = data.game.white_user_id === myUserId ? 'white' : 'black';
+          const change = data.game[`${side}_rating_change`];
+          const after = data.game[`${side}_rating_after`];
+          if (typeof change === 'number' && typeof after === 'number') {
+            setRatingChange(change);
+            setNewRating(after);
+            const savedUser = localStorage.getItem('chessUser');
+            if (savedUser) {
+              localStorage.setItem('chessUser', JSON.stringify({ ...JSON.parse(savedUser), rating: after }));
+            }
+          }
+        }
+
         if (data.game.rematch_offered_by) setRematchOfferedBy(data.game.rematch_offered_by);
         if (data.game.rematch_status) setRematchStatus(data.game.rematch_status);
         if (data.game.rematch_game_id) setRematchGameId(data.game.rematch_game_id);
@@ -679,6 +695,8 @@ export const useGameLogic = (
   const submitGameResult = useCallback(async (status: 'checkmate' | 'stalemate' | 'draw', currentPlayerAtEnd: string) => {
     if (gameFinished.current) return;
     gameFinished.current = true;
+    // Онлайн-партию с живым соперником учитывает сервер при завершении
+    if (serverRatedRef.current) return;
     const savedUser = localStorage.getItem('chessUser');
     if (!savedUser) return;
     const userData = JSON.parse(savedUser);
@@ -691,6 +709,8 @@ export const useGameLogic = (
       result = currentPlayerAtEnd === playerColor ? 'loss' : 'win';
     }
     const durationSeconds = Math.floor((Date.now() - gameStartTime.current) / 1000);
+    // Один id на партию: повтор из очереди офлайн-результатов сервер не учтёт дважды
+    const clientGameId = crypto.randomUUID();
     try {
       const res = await fetch(FINISH_GAME_URL, {
         method: 'POST',
@@ -709,7 +729,9 @@ export const useGameLogic = (
           move_history: moveHistory.join(','),
           move_times: moveTimes.join(','),
           duration_seconds: durationSeconds,
-          end_reason: status
+          end_reason: status,
+          client_game_id: clientGameId,
+          online_game_id: onlineGameId || undefined
         })
       });
       const data = await res.json();
@@ -736,10 +758,12 @@ export const useGameLogic = (
         move_history: moveHistory.join(','),
         move_times: moveTimes.join(','),
         duration_seconds: durationSeconds,
-        end_reason: status
+        end_reason: status,
+        client_game_id: clientGameId,
+        online_game_id: onlineGameId || undefined
       });
     }
-  }, [playerColor, timeControl, difficulty, moveHistory, moveTimes]);
+  }, [playerColor, timeControl, difficulty, moveHistory, moveTimes, onlineGameId]);
 
   useEffect(() => {
     if (gameStatus !== 'playing' && !gameFinished.current && moveHistory.length > 2) {
@@ -886,9 +910,7 @@ export const useGameLogic = (
           }
         });
         pendingMoveRef.current = null;
-        if (finalGameStatus !== 'playing') {
-          sendMoveToServer(moveNotation, finalGameStatus, winnerId);
-        }
+        sendMoveToServer(moveNotation, finalGameStatus, winnerId);
       } else {
         sendMoveToServer(moveNotation, finalGameStatus, winnerId);
       }